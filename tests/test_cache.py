@@ -37,3 +37,295 @@ class TestCache(object):
                 10,
                 'demand',
                 reading)
+
+
+@pytest.fixture
+def marketDB():
+    import sqlite3
+    from pathlib import Path
+    sqlPath = Path(cache.__file__).parent / 'templates' / 'TradeDangerous.sql'
+    db = sqlite3.connect(':memory:')
+    db.executescript(sqlPath.read_text(encoding = 'utf-8'))
+    db.execute("INSERT INTO System (system_id, name, pos_x, pos_y, pos_z) VALUES (1, 'SOL', 0, 0, 0)")
+    db.executemany(
+        "INSERT INTO Station (station_id, name, system_id) VALUES (?, ?, 1)",
+        [(ID, 'STN {}'.format(ID)) for ID in range(1, 6)]
+    )
+    db.execute("INSERT INTO Category (category_id, name) VALUES (1, 'Stuff')")
+    db.executemany(
+        "INSERT INTO Item (item_id, name, category_id) VALUES (?, ?, 1)",
+        [(1, 'Thing'), (2, 'Widget')]
+    )
+    db.executemany("""
+        INSERT INTO StationItem (
+            station_id, item_id, modified,
+            demand_price, demand_units, demand_level,
+            supply_price, supply_units, supply_level
+        ) VALUES (?, ?, ?, ?, 0, 0, ?, 0, 0)
+    """, [
+        (1, 1, '2020-01-01 00:00:00', 100, 0),
+        (2, 1, '2020-01-02 00:00:00', 200, 90),
+        (3, 1, '2020-01-03 00:00:00', 300, 80),
+        (4, 1, '2020-01-04 00:00:00', 400, 0),
+        (1, 2, '2020-01-03 00:00:00', 0, 50),
+    ])
+    yield db
+    db.close()
+
+
+class TestMarketSummaries(object):
+    def test_station_summary(self, marketDB):
+        cache.updateStationMarketSummary(marketDB)
+        assert marketDB.execute("""
+            SELECT station_id, item_count, min_modified, avg_modified, max_modified
+              FROM StationMarketSummary
+             WHERE station_id = 1
+        """).fetchone() == (1, 2, 1577836800, 1577923200.0, 1578009600)
+        marketDB.execute("DELETE FROM StationItem WHERE station_id = 1")
+        cache.updateStationMarketSummary(marketDB, [1])
+        assert marketDB.execute("""
+            SELECT station_id FROM StationMarketSummary ORDER BY 1
+        """).fetchall() == [(2,), (3,), (4,)]
+    
+    def test_item_price_stats(self, marketDB):
+        cache.updateItemPriceStats(marketDB)
+        rows = {row[0]: row[1:] for row in cache.itemPriceStatsRows(marketDB)}
+        assert rows[1] == (
+            4, 250.0, 100, 100, 200, 300, 400,
+            2, 85.0, 80, 80, 80, 90, 90,
+        )
+        assert rows[2] == (
+            0, None, None, None, None, None, None,
+            1, 50.0, 50, 50, 50, 50, 50,
+        )
+        marketDB.execute("DELETE FROM StationItem WHERE item_id = 2")
+        cache.updateItemPriceStats(marketDB, [2])
+        assert marketDB.execute("""
+            SELECT item_id, demand_count FROM ItemPriceStats
+        """).fetchall() == [(1, 4)]
+
+
+class TestIndexesDropped(object):
+    def test_indexes_restored(self, marketDB):
+        def indexes():
+            return marketDB.execute("""
+                SELECT name, sql FROM sqlite_master
+                 WHERE type = 'index' AND tbl_name = 'StationItem'
+                 ORDER BY 1
+            """).fetchall()
+        before = indexes()
+        with cache.indexesDropped(marketDB, ['StationItem']):
+            # only the index behind the primary key is left
+            assert [sql for _, sql in indexes()] == [None]
+        assert indexes() == before
+
+
+class TestBulkLoad(object):
+    @pytest.fixture
+    def fileDB(self, tmp_path):
+        import sqlite3
+        db = sqlite3.connect(str(tmp_path / 'bulk.db'))
+        db.execute("CREATE TABLE T (a INTEGER PRIMARY KEY, b)")
+        db.execute("CREATE INDEX t_by_b ON T (b)")
+        db.commit()
+        yield db
+        db.close()
+    
+    def settings(self, db):
+        return [
+            db.execute("PRAGMA {}".format(name)).fetchone()[0]
+            for name in ('journal_mode', 'synchronous', 'cache_size', 'locking_mode')
+        ]
+    
+    def indexes(self, db):
+        return db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        ).fetchall()
+    
+    def test_load(self, fileDB):
+        before = self.settings(fileDB)
+        with cache.bulkLoad(fileDB, ['T']):
+            # Loading in place keeps the DB's journal and syncing.
+            assert self.settings(fileDB) == before[:2] + [-262144, 'exclusive']
+            assert self.indexes(fileDB) == []
+            fileDB.executemany("INSERT INTO T VALUES (?, ?)", [(1, 'x'), (2, 'y')])
+        assert self.settings(fileDB) == before
+        assert self.indexes(fileDB) == [('t_by_b',)]
+        assert fileDB.execute("SELECT COUNT(*) FROM T").fetchone()[0] == 2
+        assert fileDB.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0]
+    
+    def test_new_db(self, fileDB):
+        before = self.settings(fileDB)
+        with cache.bulkLoad(fileDB, ['T'], journalMode = 'OFF'):
+            assert self.settings(fileDB) == ['off', 0, -262144, 'exclusive']
+            fileDB.execute("INSERT INTO T VALUES (1, 'x')")
+        assert self.settings(fileDB) == before
+        assert fileDB.execute("SELECT COUNT(*) FROM T").fetchone()[0] == 1
+    
+    def test_failed_load(self, fileDB):
+        before = self.settings(fileDB)
+        with pytest.raises(ValueError):
+            with cache.bulkLoad(fileDB, ['T']):
+                fileDB.execute("INSERT INTO T VALUES (1, 'x')")
+                raise ValueError("failed")
+        assert self.settings(fileDB) == before
+        assert self.indexes(fileDB) == [('t_by_b',)]
+        assert fileDB.execute("SELECT COUNT(*) FROM T").fetchone()[0] == 0
+    
+    def test_wal_with_reader(self, fileDB, tmp_path):
+        import sqlite3
+        fileDB.execute("PRAGMA journal_mode = WAL")
+        reader = sqlite3.connect(str(tmp_path / 'bulk.db'))
+        reader.execute("SELECT COUNT(*) FROM T").fetchone()
+        before = self.settings(fileDB)
+        with cache.bulkLoad(fileDB, ['T']):
+            assert self.settings(fileDB) == before[:2] + [-262144, 'normal']
+            fileDB.executemany("INSERT INTO T VALUES (?, ?)", [(1, 'x'), (2, 'y')])
+            assert reader.execute("SELECT COUNT(*) FROM T").fetchone()[0] == 0
+        assert self.settings(fileDB)[0] == 'wal'
+        assert self.indexes(fileDB) == [('t_by_b',)]
+        assert reader.execute("SELECT COUNT(*) FROM T").fetchone()[0] == 2
+        reader.close()
+    
+    def test_system_triggers(self, marketDB):
+        def triggers():
+            return marketDB.execute("""
+                SELECT COUNT(*) FROM sqlite_master
+                 WHERE type = 'trigger' AND tbl_name = 'System'
+            """).fetchone()[0]
+        
+        before = triggers()
+        marketDB.execute("INSERT INTO SystemRange VALUES (1, 10, x'', x'')")
+        marketDB.commit()
+        with cache.bulkLoad(marketDB, ['System']):
+            assert triggers() == 0
+            marketDB.execute("""
+                INSERT INTO System (system_id, name, pos_x, pos_y, pos_z)
+                VALUES (2, 'ALPHA', 1, 2, 3)
+            """)
+            assert marketDB.execute("SELECT COUNT(*) FROM SystemRange").fetchone()[0] == 1
+        assert triggers() == before
+        assert marketDB.execute("SELECT COUNT(*) FROM SystemRange").fetchone()[0] == 0
+        assert marketDB.execute("""
+            SELECT system_id, min_x, min_y, min_z FROM SystemPosition ORDER BY 1
+        """).fetchall() == [(1, 0, 0, 0), (2, 1, 2, 3)]
+
+
+class TestProcessImportFile(object):
+    header = (
+        "!name@System.system_id,name@Station.station_id,"
+        "name@Category.category_id,unq:name,cost,max_allocation,"
+        "illegal,suppressed\n"
+    )
+    
+    def importRares(self, marketDB, tmp_path, lines, batchSize = 10000):
+        from tradedangerous.tradeenv import TradeEnv
+        importPath = tmp_path / 'RareItem.csv'
+        importPath.write_text(self.header + "".join(lines), encoding = 'utf-8')
+        cache.processImportFile(
+            TradeEnv(), marketDB, importPath, 'RareItem', batchSize
+        )
+        return marketDB.execute("""
+            SELECT name, station_id, category_id, cost
+              FROM RareItem
+             ORDER BY name
+        """).fetchall()
+    
+    def test_resolves_names(self, marketDB, tmp_path):
+        assert self.importRares(marketDB, tmp_path, [
+            "'Sol','stn 2','STUFF','Rare One',100,1,'N','N'\n",
+            "'sol','Stn 4','Stuff','Rare Two',200,2,'N','N'\n",
+        ]) == [('Rare One', 2, 1, 100), ('Rare Two', 4, 1, 200)]
+    
+    def test_unknown_key(self, marketDB, tmp_path, capsys):
+        assert self.importRares(marketDB, tmp_path, [
+            "'Sol','Stn 1','Stuff','Rare One',100,1,'N','N'\n",
+            "'Sol','Nowhere','Stuff','Rare Two',200,2,'N','N'\n",
+            "'Sol','Stn 3','Stuff','Rare Three',300,3,'N','N'\n",
+        ], batchSize = 2) == [('Rare One', 1, 1, 100), ('Rare Three', 3, 1, 300)]
+        out, err = capsys.readouterr()
+        assert "RareItem.csv:3\n" in out + err
+
+
+class TestReloadTables(object):
+    def test_dependent_tables(self, marketDB):
+        assert cache.dependentTables(
+            marketDB, ['Station'],
+            ['System', 'Station', 'Ship', 'ShipVendor', 'Item', 'StationItem'],
+        ) == {'Station', 'ShipVendor', 'StationItem'}
+    
+    @pytest.fixture
+    def tdb(self, marketDB, tmp_path):
+        from types import SimpleNamespace
+        dbPath = tmp_path / 'TradeDangerous.db'
+        dbPath.touch()
+        return SimpleNamespace(
+            getDB = lambda: marketDB,
+            dbFilename = str(dbPath),
+            pricesPath = tmp_path / 'TradeDangerous.prices',
+            importTables = [
+                (str(tmp_path / 'Ship.csv'), 'Ship'),
+                (str(tmp_path / 'ShipVendor.csv'), 'ShipVendor'),
+            ],
+        )
+    
+    def writeShips(self, tmp_path, vendors):
+        (tmp_path / 'Ship.csv').write_text(
+            "unq:ship_id,unq:name,cost\n"
+            "1,'Sidewinder',32000\n"
+            "2,'Eagle',44800\n"
+        )
+        (tmp_path / 'ShipVendor.csv').write_text(
+            "unq:ship_id@Ship.ship_id,unq:station_id@Station.station_id,modified\n"
+            + "".join(vendors)
+        )
+    
+    def test_reload_keeps_prices(self, marketDB, tdb, tmp_path):
+        from tradedangerous.tradeenv import TradeEnv
+        self.writeShips(tmp_path, [
+            "1,2,'2020-01-01 00:00:00'\n",
+            "2,2,'2020-01-01 00:00:00'\n",
+        ])
+        cache.reloadTables(tdb, TradeEnv(), ['Ship'])
+        assert marketDB.execute("""
+            SELECT ship_id, station_id FROM ShipVendor ORDER BY 1
+        """).fetchall() == [(1, 2), (2, 2)]
+        assert marketDB.execute(
+            "SELECT COUNT(*) FROM StationItem"
+        ).fetchone()[0] == 5
+    
+    def test_failed_reload(self, marketDB, tdb, tmp_path):
+        from tradedangerous.tradeenv import TradeEnv
+        marketDB.execute("INSERT INTO Ship (ship_id, name, cost) VALUES (9, 'Old', 1)")
+        marketDB.commit()
+        self.writeShips(tmp_path, [
+            "1,2,'2020-01-01 00:00:00'\n",
+            "1,2,'2020-01-01 00:00:00'\n",
+        ])
+        with pytest.raises(cache.DuplicateKeyError):
+            cache.reloadTables(tdb, TradeEnv(), ['Ship'])
+        assert marketDB.execute(
+            "SELECT ship_id FROM Ship"
+        ).fetchall() == [(9,)]
+
+
+class TestFileStamp(object):
+    def test_stamp(self, marketDB, tmp_path):
+        import os
+        path = tmp_path / 'TradeDangerous.prices'
+        assert cache.getFileStamp(marketDB, path) is None
+        path.write_text("")
+        os.utime(str(path), (1000, 1000))
+        cache.stampFile(marketDB, path)
+        assert cache.getFileStamp(marketDB, path) == (1000, False)
+        # a stale file keeps the time it had when the cache matched it
+        os.utime(str(path), (2000, 2000))
+        cache.stampFile(marketDB, path, stale = True)
+        assert cache.getFileStamp(marketDB, path) == (1000, True)
+        cache.stampFile(marketDB, path)
+        assert cache.getFileStamp(marketDB, path) == (2000, False)
+    
+    def test_no_table(self, tmp_path):
+        import sqlite3
+        db = sqlite3.connect(':memory:')
+        assert cache.getFileStamp(db, tmp_path / 'TradeDangerous.prices') is None
@@ -0,0 +1,41 @@
+from functools import partial
+
+from tradedangerous import chunkparse
+
+
+def parseNumbers(offset, lines):
+    return [int(line) + offset for line in lines]
+
+
+class TestChunkParse(object):
+
+    def writeLines(self, path, count):
+        path.write_bytes(b"".join(b"%d\n" % i for i in range(count)))
+        return path
+    
+    def test_chunk_offsets_end_on_lines(self, tmp_path):
+        path = self.writeLines(tmp_path / "lines.txt", 1000)
+        data = path.read_bytes()
+        offsets = chunkparse.chunkOffsets(path, chunkSize = 100, start = 2)
+        assert offsets[0][0] == 2
+        assert offsets[-1][1] == len(data)
+        for (_, end), (start, _) in zip(offsets, offsets[1:]):
+            assert end == start
+            assert data[end - 1:end] == b"\n"
+    
+    def test_serial_matches_parallel(self, tmp_path):
+        path = self.writeLines(tmp_path / "lines.txt", 20000)
+        parse = partial(parseNumbers, 1)
+        serial = list(chunkparse.parseFile(
+            path, parse, chunkSize = 4096, workers = 1
+        ))
+        parallel = list(chunkparse.parseFile(
+            path, parse, chunkSize = 4096, workers = 2
+        ))
+        assert len(serial) > 2
+        assert serial == parallel
+        rows = [row for chunk in serial for row in chunk.rows]
+        assert rows == list(range(1, 20001))
+        # each chunk knows the line it starts on
+        for chunk in serial:
+            assert chunk.rows[0] == chunk.lineNo
@@ -0,0 +1,69 @@
+import sqlite3
+import threading
+
+import pytest
+
+from tradedangerous.dbpool import ReadConnectionPool
+
+
+@pytest.fixture
+def pool(tmp_path):
+    dbPath = str(tmp_path / "pool.db")
+    with sqlite3.connect(dbPath) as conn:
+        conn.execute("CREATE TABLE Thing (thing_id INTEGER PRIMARY KEY)")
+        conn.executemany("INSERT INTO Thing VALUES (?)", [(1,), (2,), (3,)])
+    pool = ReadConnectionPool(
+        lambda: sqlite3.connect(dbPath, check_same_thread=False), maxIdle=2
+    )
+    yield pool
+    pool.close()
+
+
+class TestReadConnectionPool(object):
+    def test_reuses_connections(self, pool):
+        with pool.connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM Thing").fetchone() == (3,)
+        with pool.connection() as again:
+            assert again is conn
+    
+    def test_max_idle(self, pool):
+        conns = [pool.checkout() for _ in range(3)]
+        assert len(set(map(id, conns))) == 3
+        for conn in conns:
+            pool.checkin(conn)
+        assert len(pool.idle) == 2
+        with pytest.raises(sqlite3.ProgrammingError):
+            conns[-1].execute("SELECT 1")
+    
+    def test_thread_connections(self, pool):
+        seen, errors = {}, []
+        
+        def work(name):
+            try:
+                conn = pool.threadConnection()
+                assert pool.threadConnection() is conn
+                seen[name] = conn
+                conn.execute("SELECT SUM(thing_id) FROM Thing").fetchone()
+            except Exception as e:
+                errors.append(e)
+        
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert len(set(map(id, seen.values()))) == 4
+    
+    def test_closed(self, pool):
+        pool.close()
+        with pytest.raises(ValueError):
+            pool.checkout()
+    
+    def test_close_thread_connections(self, pool):
+        conn = pool.threadConnection()
+        pool.close()
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+        with pytest.raises(ValueError):
+            pool.threadConnection()
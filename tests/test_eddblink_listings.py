@@ -0,0 +1,103 @@
+from datetime import datetime, timezone
+import sqlite3
+
+import pytest
+
+from tradedangerous.plugins import eddblink_plug as module
+from .test_tradedb import dataDir, makeTradeDB  # noqa: F401
+
+
+OLD, NOW, NEW = 1000000000, 1500000000, 1600000000
+
+HEADER = "id,station_id,commodity_id,supply,supply_bracket,buy_price,sell_price,demand,demand_bracket,collected_at"
+
+
+def stamp(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def listing(stationID, itemID, price, collectedAt):
+    return "0,{},{},100,2,{},0,0,,{}".format(stationID, itemID, price, collectedAt)
+
+
+@pytest.fixture
+def plugin(dataDir, monkeypatch):
+    # Station 1's data is older than its listings, station 2's newer,
+    # station 3's from the same time and station 4 has none.
+    with sqlite3.connect(str(dataDir / 'TradeDangerous.db')) as db:
+        db.execute("INSERT INTO Category (category_id, name) VALUES (1, 'Stuff')")
+        db.executemany("""
+            INSERT INTO Item (item_id, name, category_id) VALUES (?, ?, 1)
+        """, [(1, 'Thing'), (2, 'Other Thing')])
+        db.executemany("""
+            INSERT INTO Station (station_id, name, system_id) VALUES (?, ?, 1)
+        """, [(1, 'Older'), (2, 'Newer'), (3, 'Same'), (4, 'Empty')])
+        db.executemany("""
+            INSERT INTO StationItem (
+                station_id, item_id,
+                demand_price, demand_units, demand_level,
+                supply_price, supply_units, supply_level,
+                modified, from_live
+            ) VALUES (?, 1, 0, 0, 0, 50, 10, 1, ?, 1)
+        """, [(1, stamp(OLD)), (2, stamp(NEW)), (3, stamp(NOW))])
+    eddbPath = dataDir / 'eddb'
+    eddbPath.mkdir()
+    lines = [
+        HEADER,
+        listing(1, 1, 100, NOW),
+        listing(1, 2, 110, NOW),
+        listing(1, 99, 120, NOW),
+        listing(2, 1, 200, NOW),
+        listing(3, 1, 300, NOW),
+        listing(4, 2, 400, NOW),
+        listing(99, 1, 500, NOW),
+    ]
+    for name in (module.LISTINGS, module.LIVE_LISTINGS):
+        (eddbPath / name).write_text("\n".join(lines) + "\n")
+    monkeypatch.delitem(module.os.environ, 'TD_EDDB', raising = False)
+    tdb = makeTradeDB(dataDir)
+    yield module.ImportPlugin(tdb, tdb.tdenv)
+    tdb.close()
+
+
+def stationItems(plugin):
+    return plugin.tdb.getDB().execute("""
+        SELECT station_id, item_id, supply_price, modified, from_live
+          FROM StationItem
+         ORDER BY station_id, item_id
+    """).fetchall()
+
+
+class TestImportListings(object):
+    def test_listings(self, plugin):
+        plugin.importListings(plugin.listingsPath)
+        assert stationItems(plugin) == [
+            (1, 1, 100, stamp(NOW), 0),
+            (1, 2, 110, stamp(NOW), 0),
+            (2, 1, 50, stamp(NEW), 1),
+            (3, 1, 50, stamp(NOW), 0),
+            (4, 2, 400, stamp(NOW), 0),
+        ]
+        assert plugin.updated['Listings']
+    
+    def test_live_listings(self, plugin):
+        plugin.importListings(plugin.liveListingsPath)
+        assert stationItems(plugin) == [
+            (1, 1, 100, stamp(NOW), 1),
+            (1, 2, 110, stamp(NOW), 1),
+            (2, 1, 50, stamp(NEW), 1),
+            (3, 1, 50, stamp(NOW), 1),
+            (4, 2, 400, stamp(NOW), 1),
+        ]
+    
+    def test_summaries(self, plugin):
+        plugin.importListings(plugin.listingsPath)
+        db = plugin.tdb.getDB()
+        assert db.execute("""
+            SELECT station_id, item_count FROM StationMarketSummary
+             WHERE station_id IN (1, 4)
+             ORDER BY station_id
+        """).fetchall() == [(1, 2), (4, 1)]
+        assert db.execute("""
+            SELECT item_id, supply_count FROM ItemPriceStats ORDER BY item_id
+        """).fetchall() == [(1, 3), (2, 2)]
@@ -0,0 +1,64 @@
+import pytest
+
+from tradedangerous.nameindex import NameIndex, editDistance
+from tradedangerous.tradedb import NameNotFoundError, TradeDB
+
+
+def makeIndex(names):
+    return NameIndex(names, lambda name: name, TradeDB.normalizeTrans, TradeDB.trimTrans)
+
+
+class TestNameIndex(object):
+    def test_exact(self):
+        index = makeIndex(["Sol", "Alpha Centauri", "ALPHACENTAURI"])
+        assert index.exact("SOL") == ["Sol"]
+        assert index.exact("ALPHACENTAURI") == ["Alpha Centauri", "ALPHACENTAURI"]
+        assert index.exact("ALPHA") == []
+    
+    def test_search_matches_linear_scan(self):
+        names = [
+            "Sol", "Alpha Centauri", "Barnard's Star", "Ross 128",
+            "Ross 154", "Wolf 359", "", "Lalande 21185", "Epsilon Eridani",
+        ]
+        index = makeIndex(names)
+        for needle in ("ROSS", "S", "NARDS", "A", "", "1", "ERIDANI", "XYZ", "I"):
+            expected = [name for name in names if needle in TradeDB.normalizedStr(name)]
+            assert index.search(needle) == expected
+    
+    def test_entries(self):
+        index = makeIndex(["Ross 128", "Wolf 359"])
+        assert index.entries("ROSS1") == [("Ross 128", "ROSS 128")]
+    
+    def test_listSearch_with_index(self):
+        names = ["bread", "water", "biscuits", "It"]
+        index = makeIndex(names)
+        for lookup in ("ea", "WaT", "bisc", "it"):
+            assert TradeDB.listSearch("Item", lookup, names, index=index) == \
+                TradeDB.listSearch("Item", lookup, names)
+    
+    def test_suggest(self):
+        index = makeIndex(["Ross 128", "Ross 154", "Wolf 359", "Sol"])
+        suggested = [name for _, name in index.suggest("ros 182")]
+        assert suggested[0] == "Ross 128"
+        assert "Wolf 359" not in suggested
+        assert index.suggest("zzzz") == []
+        assert index.suggest("") == []
+    
+    def test_suggest_transposed(self):
+        index = makeIndex(["Altair", "Alioth", "Achenar", "Sol"])
+        assert [name for _, name in index.suggest("Altiar")] == ["Altair"]
+        assert [name for _, name in index.suggest("Sl")] == ["Sol"]
+    
+    def test_editDistance(self):
+        assert editDistance("ALTIAR", "ALTAIR") == 1
+        assert editDistance("KITTEN", "SITTING") == 3
+        assert editDistance("", "SOL") == 3
+        assert editDistance("SOL", "SOL") == 0
+    
+    def test_listSearch_suggestions(self):
+        names = ["bread", "water", "biscuits"]
+        with pytest.raises(NameNotFoundError) as info:
+            TradeDB.listSearch("Item", "watre", names)
+        assert [match.value for match in info.value.suggestions] == ["water"]
+        assert "did you mean water?" in str(info.value)
+        assert isinstance(info.value, LookupError)
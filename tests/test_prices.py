@@ -0,0 +1,135 @@
+import io
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from tradedangerous import prices
+
+
+@pytest.fixture
+def pricesDB(tmp_path):
+    sqlPath = Path(prices.__file__).parent / 'templates' / 'TradeDangerous.sql'
+    dbPath = tmp_path / 'prices.db'
+    db = sqlite3.connect(str(dbPath))
+    db.executescript(sqlPath.read_text(encoding = 'utf-8'))
+    db.execute("INSERT INTO System (system_id, name, pos_x, pos_y, pos_z) VALUES (1, 'Sol', 0, 0, 0)")
+    db.executemany(
+        "INSERT INTO Station (station_id, name, system_id) VALUES (?, ?, 1)",
+        [(ID, 'Stn {}'.format(ID)) for ID in range(1, 6)]
+    )
+    db.executemany(
+        "INSERT INTO Category (category_id, name) VALUES (?, ?)",
+        [(1, 'Metals'), (2, 'chemicals')]
+    )
+    db.executemany(
+        "INSERT INTO Item (item_id, name, category_id, ui_order) VALUES (?, ?, ?, ?)",
+        [(1, 'Gold', 1, 2), (2, 'Silver', 1, 1), (3, 'Water', 2, 1)]
+    )
+    db.executemany("""
+        INSERT INTO StationItem (
+            station_id, item_id, modified,
+            demand_price, demand_units, demand_level,
+            supply_price, supply_units, supply_level
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (1, 1, '2020-01-01 00:00:00', 100, 50, 2, 0, 0, 0),
+        (1, 3, '2020-01-01 00:00:00', 0, 0, 0, 20, 1000, 3),
+        (2, 2, '2020-01-02 00:00:00', 0, 0, 0, 30, -1, -1),
+        (4, 1, '2020-01-03 00:00:00', 110, -1, -1, 0, 0, 0),
+        (4, 2, '2020-01-03 00:00:00', 40, 10, 1, 0, 0, 0),
+    ])
+    db.commit()
+    db.close()
+    return dbPath
+
+
+def dump(dbPath, **kwargs):
+    out = io.StringIO()
+    prices.dumpPrices(dbPath, prices.Element.full, file = out, **kwargs)
+    return out.getvalue()
+
+
+def stationBlocks(text):
+    return [block.split("\n") for block in text.split("\n\n@ ")[1:]]
+
+
+class TestDumpPrices(object):
+    def test_dump(self, pricesDB):
+        blocks = stationBlocks(dump(pricesDB))
+        assert [block[0] for block in blocks] == ['SOL/Stn 1', 'SOL/Stn 2', 'SOL/Stn 4']
+        # categories by name, regardless of case, then items by ui_order
+        assert [line.split()[:2] for line in blocks[0][1:] if line] == [
+            ['+', 'chemicals'], ['Water', '0'], ['+', 'Metals'], ['Gold', '100'],
+        ]
+        assert blocks[2][2].split() == [
+            'Silver', '40', '0', '10L', '-', '2020-01-03', '00:00:00'
+        ]
+        assert blocks[2][3].split()[:5] == ['Gold', '110', '0', '?', '-']
+    
+    def test_since(self, pricesDB):
+        blocks = stationBlocks(dump(pricesDB, since = '2020-01-01 12:00:00'))
+        assert [block[0] for block in blocks] == ['SOL/Stn 2', 'SOL/Stn 4']
+    
+    def test_blanks(self, pricesDB):
+        out = io.StringIO()
+        prices.dumpPrices(
+            pricesDB, prices.Element.basic | prices.Element.blanks,
+            file = out, stationID = 2,
+        )
+        blocks = stationBlocks(out.getvalue())
+        assert [line.split()[0] for line in blocks[0][1:] if line] == [
+            '+', 'Water', '+', 'Silver', 'Gold'
+        ]
+    
+    def test_workers(self, pricesDB):
+        assert dump(pricesDB, batchSize = 1, workers = 2) == dump(pricesDB)
+
+
+class TestPricesBinary(object):
+    def dumpBinary(self, dbPath, path):
+        with path.open('wb') as fh:
+            prices.dumpPricesBinary(dbPath, fh, blockSize = 2)
+    
+    def stationItems(self, db):
+        return db.execute("""
+            SELECT * FROM StationItem ORDER BY station_id, item_id
+        """).fetchall()
+    
+    def test_roundtrip(self, pricesDB, tmp_path):
+        path = tmp_path / 'prices.tdprices'
+        self.dumpBinary(pricesDB, path)
+        assert prices.isBinaryPrices(path)
+        with path.open('rb') as fh:
+            rows = list(prices.readPricesBinary(fh))
+        assert len(rows) == 5
+        assert rows[2] == (2, 2, 0, 0, 0, 30, -1, -1, 1577923200)
+    
+    def test_import(self, pricesDB, tmp_path):
+        from tradedangerous import cache
+        from tradedangerous.tradeenv import TradeEnv
+        path = tmp_path / 'prices.tdprices'
+        self.dumpBinary(pricesDB, path)
+        db = sqlite3.connect(str(pricesDB))
+        before = self.stationItems(db)
+        db.execute("DELETE FROM StationItem")
+        cache.processPricesFile(TradeEnv(), db, path)
+        assert self.stationItems(db) == before
+        
+        db.execute("DELETE FROM StationItem")
+        db.execute("DELETE FROM Item WHERE item_id = 3")
+        with pytest.raises(cache.UnknownItemError):
+            cache.processPricesFile(TradeEnv(), db, path)
+    
+    def test_truncated(self, pricesDB, tmp_path):
+        from tradedangerous import cache
+        from tradedangerous.tradeenv import TradeEnv
+        from tradedangerous.tradeexcept import TradeException
+        path = tmp_path / 'prices.tdprices'
+        self.dumpBinary(pricesDB, path)
+        data = path.read_bytes()
+        db = sqlite3.connect(str(pricesDB))
+        for length in (10, 14, 40):
+            path.write_bytes(data[:length])
+            with pytest.raises(TradeException, match = "truncated"):
+                cache.processPricesFile(TradeEnv(), db, path)
@@ -0,0 +1,224 @@
+import heapq
+import random
+
+from tradedangerous import routing, stellargrid
+from tradedangerous.tradedb import System
+
+
+def makeSystems(count=400, spread=120, seed=11):
+    rng = random.Random(seed)
+    return [
+        System(
+            ID, "SYS {}".format(ID),
+            rng.uniform(-spread, spread),
+            rng.uniform(-spread / 4, spread / 4),
+            rng.uniform(-spread, spread),
+            0,
+        )
+        for ID in range(1, count + 1)
+    ]
+
+
+class GridDB(object):
+    """ Just enough of TradeDB for a JumpGraph. """
+    
+    def __init__(self, systems):
+        self.grid = stellargrid.StellarGrid(systems)
+    
+    def genSystemsInRange(self, system, ly):
+        return sorted(self.grid.query(system, ly), key=lambda ent: ent[1])
+
+
+def cheapest(graph, origin, dest, fewestJumps, avoiding=()):
+    """ Plain Dijkstra to check the searches against. """
+    jumpCost, lyCost, _ = graph.costs(fewestJumps)
+    dists, openSet, done = {origin: 0.}, [(0., origin.ID, origin)], set()
+    while openSet:
+        cost, _, system = heapq.heappop(openSet)
+        if system is dest:
+            return cost
+        if system in done:
+            continue
+        done.add(system)
+        for nSys, nDist in graph.neighbours(system):
+            newCost = cost + jumpCost + lyCost * nDist
+            if nSys not in avoiding and newCost < dists.get(nSys, float("inf")):
+                dists[nSys] = newCost
+                heapq.heappush(openSet, (newCost, nSys.ID, nSys))
+    return None
+
+
+def routeCost(graph, route, fewestJumps):
+    jumpCost, lyCost, _ = graph.costs(fewestJumps)
+    return sum(
+        jumpCost + lyCost * here.distanceTo(there)
+        for here, there in zip(route, route[1:])
+    )
+
+
+class TestFindRoute(object):
+    def test_matches_dijkstra(self):
+        systems = makeSystems()
+        graph = routing.JumpGraph(GridDB(systems), 15)
+        rng = random.Random(1)
+        for step in range(40):
+            origin, dest = rng.sample(systems, 2)
+            fewestJumps = bool(step % 2)
+            route = routing.findRoute(graph, origin, dest, fewestJumps=fewestJumps)
+            expected = cheapest(graph, origin, dest, fewestJumps)
+            if expected is None:
+                assert route is None
+                continue
+            assert route[0] is origin and route[-1] is dest
+            for here, there in zip(route, route[1:]):
+                assert here.distanceTo(there) <= 15
+            assert abs(routeCost(graph, route, fewestJumps) - expected) < 1e-6
+    
+    def test_avoiding(self):
+        systems = makeSystems()
+        graph = routing.JumpGraph(GridDB(systems), 15)
+        rng = random.Random(3)
+        route = None
+        while not route or len(route) < 4:
+            origin, dest = rng.sample(systems, 2)
+            route = routing.findRoute(graph, origin, dest)
+        avoiding = set(route[1:-1])
+        detour = routing.findRoute(graph, origin, dest, avoiding=avoiding)
+        expected = cheapest(graph, origin, dest, False, avoiding)
+        if expected is None:
+            assert detour is None
+        else:
+            assert not avoiding.intersection(detour)
+            assert abs(routeCost(graph, detour, False) - expected) < 1e-6
+    
+    def test_same_system(self):
+        systems = makeSystems(10)
+        graph = routing.JumpGraph(GridDB(systems), 15)
+        assert routing.findRoute(graph, systems[0], systems[0]) == [systems[0]]
+
+
+class TestFindRouteWithStops(object):
+    def test_station_interval(self):
+        systems = makeSystems()
+        withStations = set(systems[::3])
+        graph = routing.JumpGraph(GridDB(systems), 15)
+        rng = random.Random(2)
+        for _ in range(20):
+            origin, dest = rng.sample(systems, 2)
+            route = routing.findRouteWithStops(
+                graph, origin, dest, 2, withStations.__contains__,
+            )
+            if route is None:
+                continue
+            assert route[0] is origin and route[-1] is dest
+            sinceStation = 0
+            for system in route[:-1]:
+                if system in withStations:
+                    sinceStation = 0
+                else:
+                    sinceStation += 1
+                assert sinceStation <= 2
+
+
+class TestFindRoutesFrom(object):
+    def test_matches_dijkstra(self):
+        systems = makeSystems()
+        graph = routing.JumpGraph(GridDB(systems), 15)
+        origin, avoided = systems[0], systems[1]
+        dests = systems[2:60] + [avoided]
+        for fewestJumps in (False, True):
+            routes = routing.findRoutesFrom(
+                graph, origin, dests,
+                avoiding=[avoided], fewestJumps=fewestJumps,
+            )
+            assert set(routes) == set(dests)
+            assert routes[avoided] is None
+            for dest in dests[:-1]:
+                route = routes[dest]
+                expected = cheapest(graph, origin, dest, fewestJumps, {avoided})
+                if expected is None:
+                    assert route is None
+                    continue
+                assert route[0] is origin and route[-1] is dest
+                assert avoided not in route
+                assert abs(routeCost(graph, route, fewestJumps) - expected) < 1e-6
+
+
+class TestCompactJumpGraph(object):
+    def test_bucketLy(self):
+        assert routing.bucketLy(24.73) == routing.bucketLy(25) == 25
+        assert routing.bucketLy(25.1) == 30
+    
+    def test_matches_lazy_graph(self):
+        systems = makeSystems()
+        db = GridDB(systems)
+        compact = routing.CompactJumpGraph.build(
+            systems, routing.bucketLy(12.5), db.genSystemsInRange
+        )
+        for maxLy in (7.5, 12.5, 15):
+            lazy = routing.JumpGraph(db, maxLy)
+            graph = routing.JumpGraph(db, maxLy, compact)
+            for system in systems[:50]:
+                assert graph.neighbours(system) == lazy.neighbours(system)
+    
+    def test_blobs(self):
+        systems = makeSystems(100)
+        db = GridDB(systems)
+        compact = routing.CompactJumpGraph.build(systems, 20, db.genSystemsInRange)
+        systemByID = {system.ID: system for system in systems}
+        loaded = routing.CompactJumpGraph.fromBlobs(20, systemByID, *compact.toBlobs())
+        assert len(loaded) == len(compact)
+        for system in systems:
+            assert loaded.neighbours(system, 20) == compact.neighbours(system, 20)
+        # A graph for a different set of systems is stale.
+        del systemByID[systems[0].ID]
+        assert routing.CompactJumpGraph.fromBlobs(20, systemByID, *compact.toBlobs()) is None
+
+
+class TestLandmarks(object):
+    def makeGraphs(self, maxLy):
+        systems = makeSystems()
+        db = GridDB(systems)
+        compact = routing.CompactJumpGraph.build(systems, 15, db.genSystemsInRange)
+        landmarks = routing.Landmarks.build(compact, 6)
+        return (
+            systems,
+            routing.JumpGraph(db, maxLy, compact),
+            routing.JumpGraph(db, maxLy, compact, landmarks),
+        )
+    
+    def test_estimates_are_lower_bounds(self):
+        systems, _, graph = self.makeGraphs(12)
+        assert len(graph.landmarks) == 6
+        rng = random.Random(4)
+        for step in range(30):
+            origin, dest = rng.sample(systems, 2)
+            fewestJumps = bool(step % 2)
+            expected = cheapest(graph, origin, dest, fewestJumps)
+            if expected is not None:
+                estimate = graph.estimator(fewestJumps)
+                assert estimate(origin, dest) <= expected + 1e-9
+    
+    def test_matches_plain_search(self):
+        systems, plain, graph = self.makeGraphs(12)
+        rng = random.Random(5)
+        for step in range(30):
+            origin, dest = rng.sample(systems, 2)
+            fewestJumps = bool(step % 2)
+            expected = routing.findRoute(plain, origin, dest, fewestJumps=fewestJumps)
+            route = routing.findRoute(graph, origin, dest, fewestJumps=fewestJumps)
+            if expected is None:
+                assert route is None
+                continue
+            assert abs(
+                routeCost(graph, route, fewestJumps) -
+                routeCost(plain, expected, fewestJumps)
+            ) < 1e-6
+    
+    def test_rows(self):
+        systems, _, graph = self.makeGraphs(15)
+        landmarks = graph.landmarks
+        loaded = routing.Landmarks.fromRows(graph.compact, landmarks.toRows())
+        assert loaded.systems == landmarks.systems
+        assert loaded.distances == landmarks.distances
+        assert loaded.jumps == landmarks.jumps
@@ -0,0 +1,153 @@
+import random
+import sqlite3
+
+import pytest
+
+from tradedangerous import stellargrid
+from tradedangerous.tradedb import System
+from tradedangerous.tradeexcept import TradeException
+
+
+def makeSystems(count=300, spread=150, seed=42):
+    rng = random.Random(seed)
+    return [
+        System(
+            ID, "SYS {}".format(ID),
+            rng.uniform(-spread, spread),
+            rng.uniform(-spread, spread),
+            rng.uniform(-spread, spread),
+            0,
+        )
+        for ID in range(1, count + 1)
+    ]
+
+
+def bruteForce(systems, origin, ly):
+    return sorted(
+        (candidate.ID, origin.distanceTo(candidate))
+        for candidate in systems
+        if candidate is not origin and origin.distToSq(candidate) <= ly ** 2
+    )
+
+
+def queryIDs(index, origin, ly):
+    return sorted(
+        (candidate.ID, dist) for candidate, dist in index.query(origin, ly)
+    )
+
+
+def approx(results):
+    return [(ID, pytest.approx(dist)) for ID, dist in results]
+
+
+class TestStellarGrid(object):
+    def test_makeStellarGridKey(self):
+        assert stellargrid.makeStellarGridKey(0, 31.9, -1) == (0, 0, -1)
+        assert stellargrid.makeStellarGridKey(32, 64, -33) == (1, 2, -2)
+    
+    def test_query(self):
+        systems = makeSystems()
+        grid = stellargrid.StellarGrid(systems)
+        assert len(grid) == len(systems)
+        for origin in systems[:20]:
+            for ly in (5, 20, 45, 100):
+                assert queryIDs(grid, origin, ly) == approx(
+                    bruteForce(systems, origin, ly)
+                )
+    
+    def test_add_remove_move(self):
+        systems = makeSystems()
+        grid = stellargrid.StellarGrid(systems[:200])
+        for system in systems[200:]:
+            grid.add(system)
+        for system in systems[:50]:
+            grid.remove(system)
+        for system in systems[50:100]:
+            system.posX += 70
+            grid.move(system)
+        live = systems[50:]
+        assert len(grid) == len(live)
+        assert systems[0] not in grid
+        for origin in live[:20]:
+            assert queryIDs(grid, origin, 40) == approx(
+                bruteForce(live, origin, 40)
+            )
+    
+    def test_unknown_index_type(self):
+        with pytest.raises(TradeException, match="Unknown stellar index"):
+            stellargrid.makeStellarIndex('octree', [])
+
+
+class TestMortonIndex(object):
+    @pytest.fixture(autouse=True)
+    def need_numpy(self):
+        pytest.importorskip("numpy")
+    
+    def test_mortonCode(self):
+        assert stellargrid.mortonCode(-1, -1, -1) < stellargrid.mortonCode(0, 0, 0)
+        assert stellargrid.mortonCode(1, 0, 0) == stellargrid.mortonCode(0, 0, 0) | 1
+    
+    def test_matches_grid(self):
+        systems = makeSystems()
+        grid = stellargrid.makeStellarIndex('grid', systems)
+        morton = stellargrid.makeStellarIndex('morton', systems)
+        for origin in systems[:30]:
+            for ly in (5, 20, 45, 100, 500):
+                assert queryIDs(morton, origin, ly) == queryIDs(grid, origin, ly)
+    
+    def test_incremental(self):
+        systems = makeSystems()
+        grid = stellargrid.StellarGrid(systems[:200])
+        morton = stellargrid.MortonIndex(systems[:200])
+        rng = random.Random(7)
+        for step in range(300):
+            system = rng.choice(systems)
+            if system not in grid:
+                grid.add(system)
+                morton.add(system)
+            elif rng.random() < 0.3:
+                grid.remove(system)
+                morton.remove(system)
+            else:
+                system.posY += rng.uniform(-50, 50)
+                grid.move(system)
+                morton.move(system)
+            assert len(morton) == len(grid)
+            if step % 50 == 0:
+                for origin in systems[:10]:
+                    assert queryIDs(morton, origin, 60) == queryIDs(grid, origin, 60)
+
+
+class TestRTreeIndex(object):
+    @pytest.fixture
+    def db(self):
+        db = sqlite3.connect(":memory:")
+        try:
+            db.execute(
+                "CREATE VIRTUAL TABLE SystemPosition USING rtree("
+                "system_id, min_x, max_x, min_y, max_y, min_z, max_z)"
+            )
+        except sqlite3.OperationalError:
+            pytest.skip("SQLite was built without R*Tree support")
+        yield db
+        db.close()
+    
+    def test_matches_grid(self, db):
+        systems = makeSystems()
+        db.executemany(
+            "INSERT INTO SystemPosition VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (s.ID, s.posX, s.posX, s.posY, s.posY, s.posZ, s.posZ)
+                for s in systems
+            ]
+        )
+        grid = stellargrid.makeStellarIndex('grid', systems)
+        rtree = stellargrid.makeStellarIndex('rtree', systems, getDB=lambda: db)
+        assert len(rtree) == len(systems)
+        for origin in systems[:30]:
+            for ly in (5, 20, 45, 100):
+                assert queryIDs(rtree, origin, ly) == queryIDs(grid, origin, ly)
+    
+    def test_requires_db(self):
+        with pytest.raises(TradeException, match="requires a database"):
+            stellargrid.makeStellarIndex('rtree', [])
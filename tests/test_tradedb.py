@@ -0,0 +1,211 @@
+from array import array
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from tradedangerous import tradedb
+from tradedangerous.tradedb import TradeDB
+from tradedangerous.tradeenv import TradeEnv
+
+
+# (name, x, y, z)
+SYSTEMS = [
+    ('SOL', 0, 0, 0),
+    ('ALPHA', 3, 0, 0),
+    ('BETA', 0, 6, 0),
+    ('GAMMA', 0, 0, 12),
+    ('FAR AWAY', 100, 100, 100),
+]
+
+
+def makeTradeDB(dataDir, **kwargs):
+    tdb = TradeDB(TradeEnv(dataDir = str(dataDir), quiet = 1, **kwargs), load = False)
+    tdb.load()
+    return tdb
+
+
+@pytest.fixture
+def dataDir(tmp_path):
+    sqlPath = Path(tradedb.__file__).parent / 'templates' / 'TradeDangerous.sql'
+    db = sqlite3.connect(str(tmp_path / 'TradeDangerous.db'))
+    db.executescript(sqlPath.read_text(encoding = 'utf-8'))
+    db.execute("INSERT INTO Added (added_id, name) VALUES (1, 'Local')")
+    db.executemany(
+        "INSERT INTO System (name, pos_x, pos_y, pos_z) VALUES (?, ?, ?, ?)",
+        SYSTEMS
+    )
+    db.commit()
+    db.close()
+    return tmp_path
+
+
+def neighbours(tdb, system, ly):
+    return sorted(
+        (candidate.dbname, round(dist, 3))
+        for candidate, dist in tdb.genStellarGrid(system, ly)
+    )
+
+
+def bruteForce(tdb, system, ly):
+    return sorted(
+        (candidate.dbname, round(system.distanceTo(candidate), 3))
+        for candidate in tdb.systemByID.values()
+        if candidate is not system and system.distanceTo(candidate) <= ly
+    )
+
+
+class TestStellarIndexUpkeep(object):
+    @pytest.mark.parametrize('indexType', ['grid', 'morton', 'rtree'])
+    def test_local_system_changes(self, dataDir, indexType):
+        if indexType == 'morton':
+            pytest.importorskip("numpy")
+        tdb = makeTradeDB(dataDir, stellarIndex = indexType)
+        sol = tdb.systemByName['SOL']
+        assert neighbours(tdb, sol, 10) == [('ALPHA', 3.0), ('BETA', 6.0)]
+        
+        delta = tdb.addLocalSystem("Delta", 0, 0, -4)
+        assert neighbours(tdb, sol, 10) == bruteForce(tdb, sol, 10)
+        assert ('DELTA', 4.0) in neighbours(tdb, sol, 10)
+        
+        tdb.updateLocalSystem(tdb.systemByName['GAMMA'], "Gamma", 0, 0, 8)
+        assert ('GAMMA', 8.0) in neighbours(tdb, sol, 10)
+        tdb.updateLocalSystem(tdb.systemByName['ALPHA'], "Alpha", 30, 0, 0)
+        assert neighbours(tdb, sol, 10) == bruteForce(tdb, sol, 10)
+        assert 'ALPHA' not in dict(neighbours(tdb, sol, 10))
+        
+        tdb.removeLocalSystem(delta)
+        assert neighbours(tdb, sol, 10) == [('BETA', 6.0), ('GAMMA', 8.0)]
+        for system in tdb.systemByID.values():
+            assert neighbours(tdb, system, 50) == bruteForce(tdb, system, 50)
+    
+    def test_system_position(self, dataDir):
+        tdb = makeTradeDB(dataDir)
+        
+        def position(ID):
+            return tdb.getDB().execute("""
+                SELECT min_x, min_y, min_z FROM SystemPosition
+                 WHERE system_id = ?
+            """, [ID]).fetchall()
+        
+        delta = tdb.addLocalSystem("Delta", 1, 2, 3)
+        assert position(delta.ID) == [(1, 2, 3)]
+        tdb.updateLocalSystem(delta, "Delta", 4, 5, 6)
+        assert position(delta.ID) == [(4, 5, 6)]
+        tdb.removeLocalSystem(delta)
+        assert position(delta.ID) == []
+
+
+class TestSystemRange(object):
+    def persisted(self, dataDir):
+        with sqlite3.connect(str(dataDir / 'TradeDangerous.db')) as db:
+            return {
+                name: probedLy
+                for name, probedLy in db.execute("""
+                    SELECT s.name, r.probed_ly
+                      FROM SystemRange AS r
+                           INNER JOIN System AS s USING (system_id)
+                """)
+            }
+    
+    def probe(self, tdb, name, ly = 10):
+        system = tdb.systemByName[name]
+        found = [
+            (candidate.dbname.upper(), dist)
+            for candidate, dist in tdb.genSystemsInRange(system, ly)
+        ]
+        tdb.flushPersistedRanges()
+        return found
+    
+    def test_persisted(self, dataDir):
+        tdb = makeTradeDB(dataDir, persistRanges = True)
+        found = self.probe(tdb, 'SOL')
+        assert found == [('ALPHA', 3.0), ('BETA', 6.0)]
+        assert self.persisted(dataDir) == {'SOL': 10}
+        
+        # A later run reads the neighbourhood back rather than probing,
+        # so it sees what's been stored.
+        tdb = makeTradeDB(dataDir, persistRanges = True)
+        alpha = tdb.systemByName['ALPHA']
+        tdb.getDB().execute("""
+            UPDATE SystemRange SET neighbour_ids = ?, distances = ?
+        """, [array('q', [alpha.ID]).tobytes(), array('d', [3.0]).tobytes()])
+        assert self.probe(tdb, 'SOL') == [('ALPHA', 3.0)]
+        assert self.probe(tdb, 'SOL', 5) == [('ALPHA', 3.0)]
+    
+    def test_not_persisted_by_default(self, dataDir):
+        tdb = makeTradeDB(dataDir)
+        self.probe(tdb, 'SOL')
+        assert self.persisted(dataDir) == {}
+    
+    def test_invalidation(self, dataDir):
+        tdb = makeTradeDB(dataDir, persistRanges = True)
+        self.probe(tdb, 'SOL')
+        self.probe(tdb, 'FAR AWAY')
+        assert self.persisted(dataDir) == {'SOL': 10, 'FAR AWAY': 10}
+        
+        # Only neighbourhoods reaching the change are dropped.
+        delta = tdb.addLocalSystem("Delta", 0, 0, 50)
+        assert self.persisted(dataDir) == {'SOL': 10, 'FAR AWAY': 10}
+        tdb.updateLocalSystem(delta, "Delta", 0, 0, 5)
+        assert self.persisted(dataDir) == {'FAR AWAY': 10}
+        
+        self.probe(tdb, 'SOL')
+        assert self.persisted(dataDir) == {'SOL': 10, 'FAR AWAY': 10}
+        tdb.removeLocalSystem(delta)
+        assert self.persisted(dataDir) == {'FAR AWAY': 10}
+        
+        tdb.addLocalSystem("Epsilon", 101, 100, 100)
+        assert self.persisted(dataDir) == {}
+        
+        # The next run doesn't see the dropped neighbourhoods.
+        tdb = makeTradeDB(dataDir, persistRanges = True)
+        assert self.probe(tdb, 'FAR AWAY') == [('EPSILON', 1.0)]
+
+
+class TestLookupPlace(object):
+    def test_suggests_transposed_name(self, dataDir):
+        tdb = makeTradeDB(dataDir)
+        with pytest.raises(tradedb.NameNotFoundError) as info:
+            tdb.lookupPlace("Alpah")
+        assert [place.dbname for place in info.value.suggestions] == ['ALPHA']
+
+
+class TestThreads(object):
+    def test_rtree_from_thread(self, dataDir):
+        from concurrent.futures import ThreadPoolExecutor
+        tdb = makeTradeDB(dataDir, stellarIndex = 'rtree')
+        sol = tdb.systemByName['SOL']
+        expected = neighbours(tdb, sol, 10)
+        with ThreadPoolExecutor(max_workers = 2) as pool:
+            results = list(pool.map(
+                lambda system: neighbours(tdb, system, 10), [sol] * 4
+            ))
+        assert results == [expected] * 4
+        tdb.close()
+
+
+class TestRemoveLocalStation(object):
+    def test_price_stats(self, dataDir):
+        from tradedangerous import cache
+        with sqlite3.connect(str(dataDir / 'TradeDangerous.db')) as db:
+            db.execute("INSERT INTO Category (category_id, name) VALUES (1, 'Stuff')")
+            db.execute("INSERT INTO Item (item_id, name, category_id) VALUES (1, 'Thing', 1)")
+            db.executemany("""
+                INSERT INTO Station (station_id, name, system_id) VALUES (?, ?, 1)
+            """, [(1, 'One'), (2, 'Two')])
+            db.executemany("""
+                INSERT INTO StationItem (
+                    station_id, item_id,
+                    demand_price, demand_units, demand_level,
+                    supply_price, supply_units, supply_level
+                ) VALUES (?, 1, 0, 0, 0, ?, 100, 2)
+            """, [(1, 100), (2, 300)])
+            cache.updateItemPriceStats(db)
+        tdb = makeTradeDB(dataDir)
+        assert tdb.getAverageSelling()[1] == 200
+        tdb.removeLocalStation(tdb.stationByID[1])
+        assert tdb.getAverageSelling()[1] == 300
+        assert tdb.getDB().execute("""
+            SELECT supply_count, supply_avg FROM ItemPriceStats
+        """).fetchall() == [(1, 300.0)]
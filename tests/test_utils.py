@@ -1,6 +1,7 @@
 import pytest
 
 from tradedangerous import utils
+from tradedangerous.misc import progress
 from tradedangerous import TradeEnv
 
 
@@ -25,3 +26,23 @@ class TestUtils(object):
         utils.checkForOcrDerp(tdenv, 'some', 'Aquire0')
         captured = capsys.readouterr()
         assert "Ignoring 'some/Aquire0' because it looks like OCR derp." in captured.out
+
+
+class TestProgress(object):
+    
+    def test_increment_redraws_per_step(self, capsys):
+        prog = progress.Progress(100, 10, postfix=progress.Progress.percent)
+        redraws = sum(prog.increment(1) for _ in range(100))
+        # The empty bar, then once per '='.
+        assert redraws == 11
+        assert capsys.readouterr().out.endswith("[" + "=" * 10 + "] 100% ")
+    
+    def test_file_progress(self, tmp_path, capsys):
+        path = tmp_path / "lines.txt"
+        path.write_bytes(b"".join(b"line %d\n" % i for i in range(5000)))
+        with path.open("rb") as fh:
+            prog = progress.FileProgress(fh, 20)
+            lines = list(prog.iterate(fh, interval=100))
+        assert len(lines) == 5000
+        assert prog.value == prog.maxValue == path.stat().st_size
+        assert capsys.readouterr().out.endswith("] 100% ")
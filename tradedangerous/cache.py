@@ -21,10 +21,13 @@
 #  we can tell how old data for a specific system is.
 
 from collections import namedtuple
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
 from .tradeexcept import TradeException
 
-from . import corrections, utils
+from . import chunkparse, corrections, utils
 import csv
 import math
 import os
@@ -32,6 +35,7 @@ from . import prices
 import re
 import sqlite3
 import sys
+import time
 
 ######################################################################
 # Regular expression patterns. Here be draegons.
@@ -607,18 +611,463 @@ def processPrices(tdenv, priceFile, db, defaultZero):
     stations = tuple((ID,) for ID in processedStations.keys())
     return stations, items, zeros, newItems, updtItems, ignItems, numSys
 
+
+def processBinaryPrices(tdenv, priceFile, db):
+    """
+        Like processPrices, but for a binary prices file, whose rows
+        are already keyed by station and item ID.
+    """
+    
+    DEBUG0, DEBUG1 = tdenv.DEBUG0, tdenv.DEBUG1
+    DEBUG0("Processing binary prices file: {}", priceFile)
+    
+    ignoreUnknown = tdenv.ignoreUnknown
+    merging = tdenv.mergeImport
+    
+    systemByStation = dict(db.execute("SELECT station_id, system_id FROM Station"))
+    knownItems = {ID for (ID,) in db.execute("SELECT item_id FROM Item")}
+    
+    if not ignoreUnknown:
+        
+        def ignoreOrWarn(error):
+            raise error
+    
+    elif not tdenv.quiet:
+        ignoreOrWarn = tdenv.WARN
+    else:
+        
+        def ignoreOrWarn(error):
+            pass
+    
+    # Rows are mostly stamped with a few times per station.
+    timestamps = {}
+    
+    def timestamp(epoch):
+        try:
+            return timestamps[epoch]
+        except KeyError:
+            text = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+            timestamps[epoch] = text
+            return text
+    
+    stationID = None
+    processedStations = {}
+    processedSystems = set()
+    processedItems = {}
+    stationItemDates = {}
+    items, zeros = [], []
+    addItem, addZero = items.append, zeros.append
+    newItems, updtItems, ignItems = 0, 0, 0
+    
+    try:
+        rows = prices.readPricesBinary(priceFile)
+        for rowNo, row in enumerate(rows, 1):
+            (
+                rowStation, itemID,
+                demandCr, demandUnits, demandLevel,
+                supplyCr, supplyUnits, supplyLevel,
+                modified,
+            ) = row
+            
+            if rowStation != stationID:
+                stationID = rowStation
+                if stationID not in systemByStation:
+                    ignoreOrWarn(
+                        UnknownStationError(priceFile, rowNo, "#{}".format(stationID))
+                    )
+                elif stationID in processedStations:
+                    raise MultipleStationEntriesError(
+                        priceFile, rowNo, "#{}".format(stationID),
+                        processedStations[stationID]
+                    )
+                else:
+                    processedSystems.add(systemByStation[stationID])
+                    processedStations[stationID] = rowNo
+                    processedItems = {}
+                    stationItemDates = dict(db.execute("""
+                        SELECT item_id, modified
+                          FROM StationItem
+                         WHERE station_id = ?
+                    """, [stationID]))
+            if stationID not in systemByStation:
+                continue
+            
+            if itemID not in knownItems:
+                ignoreOrWarn(
+                    UnknownItemError(priceFile, rowNo, "#{}".format(itemID))
+                )
+                continue
+            
+            modified = timestamp(modified)
+            lastModified = stationItemDates.get(itemID, None)
+            if lastModified and merging and modified <= lastModified:
+                DEBUG1("Ignoring #{} @ #{}: {} <= {}",
+                    itemID, stationID, modified, lastModified,
+                )
+                if modified < lastModified:
+                    ignItems += 1
+                continue
+            
+            if itemID in processedItems:
+                ignoreOrWarn(
+                    MultipleItemEntriesError(
+                        priceFile, rowNo,
+                        "#{}".format(itemID),
+                        processedItems[itemID]
+                    )
+                )
+                continue
+            processedItems[itemID] = rowNo
+            
+            if demandCr == 0 and supplyCr == 0:
+                if lastModified:
+                    addZero((stationID, itemID))
+                continue
+            if lastModified:
+                updtItems += 1
+            else:
+                newItems += 1
+            addItem((
+                stationID, itemID, modified,
+                demandCr, demandUnits, demandLevel,
+                supplyCr, supplyUnits, supplyLevel,
+            ))
+    except (ValueError, EOFError) as e:
+        raise TradeException(str(e)) from None
+    
+    stations = tuple((ID,) for ID in processedStations.keys())
+    return stations, items, zeros, newItems, updtItems, ignItems, len(processedSystems)
+
 ######################################################################
 
 
-def processPricesFile(tdenv, db, pricesPath, pricesFh = None, defaultZero = False):
-    tdenv.DEBUG0("Processing Prices file '{}'", pricesPath)
+def dropIndexes(db, tableNames):
+    """
+    Drops the secondary indexes of the named tables, returning
+    [(name, sql)] to re-create them with createIndexes().
+    """
+    tableNames = tuple(tableNames)
+    if not tableNames:
+        return []
+    # Indexes without sql are the ones behind UNIQUE and PRIMARY KEY.
+    indexes = db.execute("""
+        SELECT name, sql FROM sqlite_master
+         WHERE type = 'index' AND sql IS NOT NULL
+           AND tbl_name IN ({})
+    """.format(','.join('?' * len(tableNames))), tableNames).fetchall()
+    for name, _ in indexes:
+        db.execute("DROP INDEX {}".format(name))
+    return indexes
+
+
+def createIndexes(db, indexes):
+    """ Re-creates the indexes dropIndexes() dropped, unless they exist. """
+    existing = set(
+        name for (name,) in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )
+    )
+    for name, sql in indexes:
+        if name not in existing:
+            db.execute(sql)
+
+
+@contextmanager
+def indexesDropped(db, tableNames):
+    """
+    Context for bulk-loading tables: drops the secondary indexes of
+    the named tables on entry and re-creates them on exit, which is
+    much quicker than updating them row by row.
+    
+    Both happen in the caller's transaction, so if it is rolled back
+    the indexes are back as they were.
+    """
+    if not db.in_transaction:
+        db.execute("BEGIN")
+    indexes = dropIndexes(db, tableNames)
+    try:
+        yield
+    finally:
+        createIndexes(db, indexes)
+
+
+def dropTriggers(db, tableNames):
+    """
+    Drops the triggers on the named tables, returning [(name, sql)]
+    to re-create them with createTriggers().
+    """
+    tableNames = tuple(tableNames)
+    if not tableNames:
+        return []
+    triggers = db.execute("""
+        SELECT name, sql FROM sqlite_master
+         WHERE type = 'trigger'
+           AND tbl_name IN ({})
+    """.format(','.join('?' * len(tableNames))), tableNames).fetchall()
+    for name, _ in triggers:
+        db.execute("DROP TRIGGER {}".format(name))
+    return triggers
+
+
+def createTriggers(db, triggers):
+    """ Re-creates the triggers dropTriggers() dropped, unless they exist. """
+    existing = set(
+        name for (name,) in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+        )
+    )
+    for name, sql in triggers:
+        if name not in existing:
+            db.execute(sql)
+
+
+# What the triggers on each table keep up to date, done once for the
+# whole table after bulkLoad() has loaded it with the triggers dropped.
+# Only tables listed here have their triggers dropped.
+bulkLoadRefresh = {
+    'System': (
+        "DELETE FROM SystemPosition",
+        """
+        INSERT INTO SystemPosition
+        SELECT  system_id, pos_x, pos_x, pos_y, pos_y, pos_z, pos_z
+          FROM  System
+        """,
+        "DELETE FROM SystemRange",
+        "DELETE FROM JumpGraph",
+        "DELETE FROM JumpLandmark",
+    ),
+}
+
+
+# Settings bulkLoad() uses in place of the connection's own.
+bulkLoadPragmas = (
+    ('cache_size', -262144),
+    ('locking_mode', 'EXCLUSIVE'),
+)
+
+# And those it adds when given a journal mode, for a new DB that is
+# rebuilt from scratch if the load fails. They give up the safety of
+# the DB on a crash or power loss for speed.
+bulkLoadUnsafePragmas = (
+    ('synchronous', 'OFF'),
+)
+
+
+@contextmanager
+def bulkLoad(db, tableNames = (), journalMode = None):
+    """
+    Context for loading a large amount of data into 'db'. Applies
+    the bulkLoadPragmas, drops the secondary indexes of the named
+    tables and the triggers of those in bulkLoadRefresh, and on exit
+    does the triggers' work in one go, re-creates the triggers and
+    indexes, runs ANALYZE and puts the connection's settings back.
+    
+    The changes are committed on exit, or rolled back if the load
+    fails. The load may commit along the way, so any open transaction
+    is committed on entry.
+    
+    journalMode, with the bulkLoadUnsafePragmas, is only for a DB
+    nothing else has seen yet, such as the one buildCache fills: a
+    crash part way through can corrupt it. Without it the DB keeps its
+    journal and stays safe to load in place.
+    
+    A DB in WAL mode isn't locked exclusively, since other
+    connections may be reading it.
+    """
+    db.commit()
+    pragmas = bulkLoadPragmas
+    if journalMode:
+        pragmas = (('journal_mode', journalMode),) + bulkLoadUnsafePragmas + pragmas
+    elif db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+        pragmas = tuple(
+            (name, value) for name, value in pragmas
+            if name != 'locking_mode'
+        )
+    saved = [
+        (name, db.execute("PRAGMA {}".format(name)).fetchone()[0])
+        for name, _ in pragmas
+    ]
+    for name, value in pragmas:
+        db.execute("PRAGMA {} = {}".format(name, value))
+    refreshTables = [name for name in tableNames if name in bulkLoadRefresh]
+    indexes, triggers, loaded = [], [], False
+    try:
+        indexes = dropIndexes(db, tableNames)
+        triggers = dropTriggers(db, refreshTables)
+        yield
+        loaded = True
+    finally:
+        if db.in_transaction and not loaded:
+            db.rollback()
+        # Even a failed load may have committed some of its changes,
+        # and the triggers and indexes still need putting back.
+        for name in refreshTables:
+            for stmt in bulkLoadRefresh[name]:
+                db.execute(stmt)
+        createTriggers(db, triggers)
+        createIndexes(db, indexes)
+        if loaded:
+            db.execute("ANALYZE")
+        db.commit()
+        for name, value in reversed(saved):
+            db.execute("PRAGMA {} = {}".format(name, value))
+        # Exclusive locks are only given up on the next access.
+        db.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+
+def updateStationMarketSummary(db, stationIDs = None):
+    """
+    Recomputes the StationMarketSummary rows of the given stations,
+    or of every station if stationIDs is None, from StationItem.
+    Call it after changing StationItem, before committing.
+    """
+    summarySelect = """
+        SELECT  station_id, COUNT(*),
+                MIN(CAST(STRFTIME('%s', modified) AS INTEGER)),
+                AVG(CAST(STRFTIME('%s', modified) AS INTEGER)),
+                MAX(CAST(STRFTIME('%s', modified) AS INTEGER))
+          FROM  StationItem
+    """
+    if stationIDs is None:
+        db.execute("DELETE FROM StationMarketSummary")
+        db.execute("""
+            INSERT INTO StationMarketSummary (
+                station_id, item_count,
+                min_modified, avg_modified, max_modified
+            )
+        """ + summarySelect + " GROUP BY station_id")
+        return
+    
+    stationIDs = [(ID,) for ID in set(stationIDs)]
+    db.executemany("""
+        DELETE FROM StationMarketSummary WHERE station_id = ?
+    """, stationIDs)
+    db.executemany("""
+        INSERT INTO StationMarketSummary (
+            station_id, item_count,
+            min_modified, avg_modified, max_modified
+        )
+    """ + summarySelect + """
+         WHERE  station_id = ?
+         GROUP  BY station_id
+    """, stationIDs)
+
+
+def _priceStats(db, column, itemIDs):
+    """
+    Returns {itemID: (count, avg, min, p25, median, p75, max)} of the
+    non-zero values of a StationItem price column, with nearest-rank
+    percentiles.
     
-    with pricesFh or pricesPath.open('rU', encoding = 'utf-8') as pricesFh:
-        stations, items, zeros, newItems, updtItems, ignItems, numSys = processPrices(
-            tdenv, pricesFh, db, defaultZero
+    The prices are scanned in order rather than ranked in SQL, which
+    would need window functions (SQLite 3.25).
+    """
+    stmt = """
+        SELECT  item_id, {column}
+          FROM  StationItem
+         WHERE  {column} > 0 {itemFilter}
+         ORDER  BY item_id, {column}
+    """
+    
+    def rankedStats(rows):
+        stats = {}
+        for itemID, group in groupby(rows, key = itemgetter(0)):
+            prices = [price for _, price in group]
+            num = len(prices)
+            stats[itemID] = (
+                num, sum(prices) / num, prices[0],
+                prices[math.ceil(0.25 * num) - 1],
+                prices[math.ceil(0.50 * num) - 1],
+                prices[math.ceil(0.75 * num) - 1],
+                prices[-1],
+            )
+        return stats
+    
+    if itemIDs is None:
+        return rankedStats(
+            db.execute(stmt.format(column = column, itemFilter = ""))
+        )
+    stats = {}
+    # Keep well inside SQLite's limit on bound parameters.
+    for offset in range(0, len(itemIDs), 500):
+        chunk = itemIDs[offset:offset + 500]
+        itemFilter = "AND item_id IN ({})".format(",".join("?" * len(chunk)))
+        stats.update(rankedStats(
+            db.execute(
+                stmt.format(column = column, itemFilter = itemFilter), chunk
+            )
+        ))
+    return stats
+
+
+def itemPriceStatsRows(db, itemIDs = None):
+    """
+    Returns the ItemPriceStats rows, as tuples in column order, for
+    the given items, or for every item if itemIDs is None.
+    """
+    if itemIDs is not None:
+        itemIDs = sorted(set(itemIDs))
+    demand = _priceStats(db, 'demand_price', itemIDs)
+    supply = _priceStats(db, 'supply_price', itemIDs)
+    none = (0, None, None, None, None, None, None)
+    return [
+        (itemID,) + demand.get(itemID, none) + supply.get(itemID, none)
+        for itemID in sorted(demand.keys() | supply.keys())
+    ]
+
+
+def updateItemPriceStats(db, itemIDs = None):
+    """
+    Recomputes the ItemPriceStats rows of the given items, or of every
+    item if itemIDs is None, from StationItem. Call it after changing
+    StationItem, before committing.
+    """
+    rows = itemPriceStatsRows(db, itemIDs)
+    if itemIDs is None:
+        db.execute("DELETE FROM ItemPriceStats")
+    else:
+        db.executemany("""
+            DELETE FROM ItemPriceStats WHERE item_id = ?
+        """, [(ID,) for ID in set(itemIDs)])
+    db.executemany("""
+        INSERT INTO ItemPriceStats (
+            item_id,
+            demand_count, demand_avg, demand_min,
+            demand_p25, demand_median, demand_p75, demand_max,
+            supply_count, supply_avg, supply_min,
+            supply_p25, supply_median, supply_p75, supply_max
+        ) VALUES (
+            ?,
+            ?, ?, ?, ?, ?, ?, ?,
+            ?, ?, ?, ?, ?, ?, ?
         )
+    """, rows)
+
+
+def processPricesFile(
+        tdenv, db, pricesPath, pricesFh = None, defaultZero = False,
+        commit = True,
+        ):
+    tdenv.DEBUG0("Processing Prices file '{}'", pricesPath)
+    
+    if not pricesFh and prices.isBinaryPrices(pricesPath):
+        with pricesPath.open('rb') as pricesFh:
+            processed = processBinaryPrices(tdenv, pricesFh, db)
+    else:
+        with pricesFh or pricesPath.open('rU', encoding = 'utf-8') as pricesFh:
+            processed = processPrices(tdenv, pricesFh, db, defaultZero)
+    stations, items, zeros, newItems, updtItems, ignItems, numSys = processed
     
+    # The price stats of every item gained or lost need refreshing.
+    touchedItems = {item[1] for item in items}
+    touchedItems.update(itemID for (_, itemID) in zeros)
     if not tdenv.mergeImport:
+        for station in stations:
+            touchedItems.update(
+                itemID for (itemID,) in db.execute("""
+                    SELECT item_id FROM StationItem WHERE station_id = ?
+                """, station)
+            )
         db.executemany("""
             DELETE FROM StationItem
              WHERE station_id = ?
@@ -645,6 +1094,14 @@ def processPricesFile(tdenv, db, pricesPath, pricesFh = None, defaultZero = Fals
         """, items)
     updatedItems = len(items)
     
+    tdenv.DEBUG0("Updating station market summaries")
+    updateStationMarketSummary(
+        db,
+        [ID for (ID,) in stations] + [ID for (ID, _) in zeros]
+    )
+    tdenv.DEBUG0("Updating item price stats")
+    updateItemPriceStats(db, touchedItems)
+    
     tdenv.DEBUG0("Marking populated stations as having a market")
     db.execute(
         "UPDATE Station SET market = 'Y'"
@@ -654,7 +1111,8 @@ def processPricesFile(tdenv, db, pricesPath, pricesFh = None, defaultZero = Fals
              ")"
     )
     
-    db.commit()
+    if commit:
+        db.commit()
     
     changes = " and ".join("{} {}".format(v, k) for k, v in {
         "new": newItems,
@@ -722,34 +1180,117 @@ def deprecationCheckItem(importPath, lineNo, line):
     )
 
 
-def processImportFile(tdenv, db, importPath, tableName):
+def parseImportLines(lines):
+    """ chunkparse parser for the .csv files of the import tables. """
+    return list(csv.reader(
+        lines, delimiter = ',', quotechar = "'", doublequote = True
+    ))
+
+
+# SQLite's NOCASE collation only folds ASCII letters.
+nocaseTable = str.maketrans(
+    "abcdefghijklmnopqrstuvwxyz", "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+)
+
+
+def fkeyText(value):
+    """ Lookup key for a COLLATE nocase name column. """
+    if isinstance(value, str):
+        return value.translate(nocaseTable)
+    return value
+
+
+def fkeyNumber(value):
+    """
+    Lookup key for an INTEGER column; like SQLite, compares text that
+    looks like a number by its value.
+    """
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return value
+
+
+def foreignKeyMap(db, table, keyColumns, joins, srcKey):
+    """
+    Loads the foreign key lookup for an import column into a dict.
+    
+    Arguments:
+        table
+            The referenced table, e.g. "Station"
+        keyColumns
+            [(table, column)] of the CSV values that identify a row,
+            e.g. [("System", "name"), ("Station", "name")]
+        joins
+            [(table, column)] tables to join in USING column
+        srcKey
+            The value to look up, e.g. "Station.station_id"
+    
+    Returns:
+        (normalizers, lookup): a function for each key column that
+        turns a CSV value into its part of the lookup key, and the
+        {key: value} dict. Key columns are either integers or names,
+        which are all COLLATE nocase in TD's schema.
+    """
+    normalizers = []
+    for keyTab, keyCol in keyColumns:
+        numeric = any(
+            row[1] == keyCol and "INT" in row[2].upper()
+            for row in db.execute("PRAGMA table_info({})".format(keyTab))
+        )
+        normalizers.append(fkeyNumber if numeric else fkeyText)
+    
+    stmt = "SELECT {columns}, {srcKey} FROM {table} {joins}".format(
+        columns = ", ".join(
+            "{}.{}".format(keyTab, keyCol) for keyTab, keyCol in keyColumns
+        ),
+        srcKey = srcKey,
+        table = table,
+        joins = " ".join(
+            "INNER JOIN {} USING({})".format(joinTab, joinCol)
+            for joinTab, joinCol in joins
+        ),
+    )
+    lookup = dict()
+    for row in db.execute(stmt):
+        key = tuple(
+            normalize(value) for normalize, value in zip(normalizers, row)
+        )
+        lookup.setdefault(key, row[-1])
+    return normalizers, lookup
+
+
+def processImportFile(
+        tdenv, db, importPath, tableName, batchSize = 10000, commit = True,
+        ):
     tdenv.DEBUG0(
         "Processing import file '{}' for table '{}'",
         str(importPath), tableName
     )
     
-    fkeySelectStr = ("("
-            "SELECT {newValue}"
-            " FROM {table}"
-            " WHERE {stmt}"
-            ")"
-    )
     uniquePfx = "unq:"
     uniqueLen = len(uniquePfx)
     ignorePfx = "!"
     
-    with importPath.open('rU', encoding = 'utf-8') as importFile:
-        csvin = csv.reader(
-            importFile, delimiter = ',', quotechar = "'", doublequote = True
-        )
+    with importPath.open('rb') as importFile:
         # first line must be the column names
-        columnDefs = next(csvin)
+        header = importFile.readline().decode('utf-8').splitlines()
+        columnDefs = next(iter(parseImportLines(header)))
         columnCount = len(columnDefs)
         
         # split up columns and values
-        # this is necessqary because the insert might use a foreign key
+        # this is necessqary because the insert might use a foreign key,
+        # which is resolved from a lookup of the referenced table
         bindColumns = []
-        bindValues = []
+        valueIndexes = []
+        fkeyColumns = []
+        foreignKeys = []
         joinHelper = []
         uniqueIndexes = []
         for (cIndex, cName) in enumerate(columnDefs):
@@ -761,7 +1302,7 @@ def processImportFile(tdenv, db, importPath, tableName):
             if not srcKey:
                 # no foreign key, straight insert
                 bindColumns.append(colName)
-                bindValues.append('?')
+                valueIndexes.append(cIndex)
                 continue
             
             queryTab, _, queryCol = srcKey.partition('.')
@@ -769,36 +1310,37 @@ def processImportFile(tdenv, db, importPath, tableName):
                 # this column is only used to resolve an FK
                 assert srcKey
                 colName = colName[len(ignorePfx):]
-                joinHelper.append((colName, queryTab, queryCol))
+                joinHelper.append((cIndex, colName, queryTab, queryCol))
                 continue
             
-            # foreign key, we need to make a select
-            joinTable = [ queryTab ]
-            joinStmt = []
-            for nextCol, nextTab, nextJoin in joinHelper:
-                joinTable.append(
-                    "INNER JOIN {} USING({})".format(nextTab, nextJoin)
-                )
-                joinStmt.append(
-                    "{}.{} = ?".format(nextTab, nextCol)
-                )
+            # foreign key, we need a lookup
+            keyColumns = [
+                (nextTab, nextCol) for _, nextCol, nextTab, _ in joinHelper
+            ]
+            keyColumns.append((queryTab, colName))
+            normalizers, lookup = foreignKeyMap(
+                db, queryTab, keyColumns,
+                [
+                    (nextTab, nextJoin)
+                    for _, _, nextTab, nextJoin in joinHelper
+                ],
+                srcKey,
+            )
+            keyIndexes = [ nextIndex for nextIndex, _, _, _ in joinHelper ]
+            keyIndexes.append(cIndex)
             joinHelper = []
-            joinStmt.append("{}.{} = ?".format(queryTab, colName))
-            bindColumns.append(queryCol)
-            bindValues.append(
-                fkeySelectStr.format(
-                    newValue = srcKey,
-                    table = " ".join(joinTable),
-                    stmt = " AND ".join(joinStmt),
-                )
+            fkeyColumns.append(queryCol)
+            foreignKeys.append(
+                (list(zip(keyIndexes, normalizers)), lookup)
             )
+        bindColumns.extend(fkeyColumns)
         # now we can make the sql statement
         sql_stmt = """
             INSERT OR REPLACE INTO {table} ({columns}) VALUES({values})
         """.format(
                 table = tableName,
                 columns = ','.join(bindColumns),
-                values = ','.join(bindValues)
+                values = ','.join(['?'] * len(bindColumns))
             )
         tdenv.DEBUG0("SQL-Statement: {}", sql_stmt)
         
@@ -812,11 +1354,55 @@ def processImportFile(tdenv, db, importPath, tableName):
         # import the data
         importCount = 0
         uniqueIndex = dict()
+        batch = []
+        
+        def insertBatch():
+            """
+            Inserts the batch with one executemany; if that fails, the
+            rows are inserted one at a time so the bad line(s) can be
+            reported.
+            """
+            nonlocal importCount
+            db.execute("SAVEPOINT importBatch")
+            try:
+                db.executemany(sql_stmt, (values for _, values in batch))
+                importCount += len(batch)
+            except Exception:
+                db.execute("ROLLBACK TO importBatch")
+                for lineNo, values in batch:
+                    try:
+                        db.execute(sql_stmt, values)
+                        importCount += 1
+                    except Exception as e:
+                        tdenv.WARN(
+                            "*** INTERNAL ERROR: {err}\n"
+                            "CSV File: {file}:{line}\n"
+                            "SQL Query: {query}\n"
+                            "Params: {params}\n"
+                            .format(
+                                err = str(e),
+                                file = str(importPath),
+                                line = lineNo,
+                                query = sql_stmt.strip(),
+                                params = values
+                            )
+                        )
+                        pass
+            db.execute("RELEASE importBatch")
+            batch.clear()
         
-        for linein in csvin:
+        # the rows are parsed in chunks, in parallel for large files
+        csvin = (
+            (lineNo, linein)
+            for chunk in chunkparse.parseFile(
+                importPath, parseImportLines,
+                start = importFile.tell(), lineNo = 2, encoding = 'utf-8',
+            )
+            for lineNo, linein in enumerate(chunk.rows, chunk.lineNo)
+        )
+        for lineNo, linein in csvin:
             if not linein:
                 continue
-            lineNo = csvin.line_num
             if len(linein) == columnCount:
                 tdenv.DEBUG1("       Values: {}", ', '.join(linein))
                 if deprecationFn:
@@ -848,24 +1434,18 @@ def processImportFile(tdenv, db, importPath, tableName):
                         )
                     uniqueIndex[key] = lineNo
                 
-                try:
-                    db.execute(sql_stmt, linein)
-                    importCount += 1
-                except Exception as e:
-                    tdenv.WARN(
-                        "*** INTERNAL ERROR: {err}\n"
-                        "CSV File: {file}:{line}\n"
-                        "SQL Query: {query}\n"
-                        "Params: {params}\n"
-                        .format(
-                            err = str(e),
-                            file = str(importPath),
-                            line = lineNo,
-                            query = sql_stmt.strip(),
-                            params = linein
-                        )
-                    )
-                    pass
+                # unknown foreign keys become NULL, as they did when
+                # they were looked up by a sub-select
+                values = [ linein[col] for col in valueIndexes ]
+                values.extend(
+                    lookup.get(tuple(
+                        normalize(linein[col]) for col, normalize in keyIndexes
+                    ))
+                    for keyIndexes, lookup in foreignKeys
+                )
+                batch.append((lineNo, values))
+                if len(batch) >= batchSize:
+                    insertBatch()
             else:
                 tdenv.NOTE(
                         "Wrong number of columns ({}:{}): {}",
@@ -873,11 +1453,37 @@ def processImportFile(tdenv, db, importPath, tableName):
                             lineNo,
                             ', '.join(linein)
                 )
-        db.commit()
+        if batch:
+            insertBatch()
+        if commit:
+            db.commit()
         tdenv.DEBUG0("{count} {table}s imported",
                             count = importCount,
                             table = tableName)
 
+
+def processImportTables(tdenv, db, importTables, commit = True):
+    """
+    Imports each (path, table) of importTables, skipping .csv files
+    that are missing or empty.
+    """
+    for (importName, importTable) in importTables:
+        try:
+            processImportFile(
+                tdenv, db, Path(importName), importTable, commit = commit
+            )
+        except FileNotFoundError:
+            tdenv.DEBUG0(
+                "WARNING: processImportFile found no {} file", importName
+            )
+        except StopIteration:
+            tdenv.NOTE(
+                "{} exists but is empty. "
+                "Remove it or add the column definition line.",
+                importName
+            )
+
+
 ######################################################################
 
 
@@ -905,6 +1511,10 @@ def buildCache(tdb, tdenv):
     sqlPath = tdb.sqlPath
     pricesPath = tdb.pricesPath
     
+    # The old cache may have prices the .prices file is still missing.
+    if dbPath.exists():
+        refreshPricesFile(tdb, tdenv)
+    
     # Create an in-memory database to populate with our data.
     tempPath = dbPath.with_suffix(".new")
     backupPath = dbPath.with_suffix(".old")
@@ -920,30 +1530,26 @@ def buildCache(tdb, tdenv):
         sqlScript = sqlFile.read()
         tempDB.executescript(sqlScript)
     
-    # import standard tables
-    for (importName, importTable) in tdb.importTables:
-        try:
-            processImportFile(tdenv, tempDB, Path(importName), importTable)
-        except FileNotFoundError:
-            tdenv.DEBUG0(
-                "WARNING: processImportFile found no {} file", importName
-            )
-        except StopIteration:
+    # Nothing else uses the new DB yet, and it's rebuilt from scratch if
+    # this fails, so it can be loaded without a journal. The imports and
+    # the .prices parser look Systems and Stations up from dicts, so
+    # their indexes aren't needed until it's loaded.
+    with bulkLoad(
+            tempDB, ['System', 'Station', 'StationItem'], journalMode = 'OFF'
+            ):
+        # import standard tables
+        processImportTables(tdenv, tempDB, tdb.importTables)
+        
+        # Parse the prices file
+        if pricesPath.exists():
+            processPricesFile(tdenv, tempDB, pricesPath)
+        else:
             tdenv.NOTE(
-                "{} exists but is empty. "
-                "Remove it or add the column definition line.",
-                importName
+                    "Missing \"{}\" file - no price data.",
+                        pricesPath,
+                        file = sys.stderr,
             )
-    
-    # Parse the prices file
-    if pricesPath.exists():
-        processPricesFile(tdenv, tempDB, pricesPath)
-    else:
-        tdenv.NOTE(
-                "Missing \"{}\" file - no price data.",
-                    pricesPath,
-                    file = sys.stderr,
-        )
+        stampFile(tempDB, pricesPath)
     
     tempDB.commit()
     tempDB.close()
@@ -961,18 +1567,188 @@ def buildCache(tdb, tdenv):
 ######################################################################
 
 
+def dependentTables(db, tableNames, candidates):
+    """
+    Returns the set of tableNames plus every table in candidates that
+    references one of them by foreign key, directly or through another
+    candidate.
+    """
+    references = {
+        table: {
+            row[2] for row in
+            db.execute("PRAGMA foreign_key_list({})".format(table))
+        }
+        for table in candidates
+    }
+    tables = set(tableNames)
+    while True:
+        dependents = {
+            table for table, parents in references.items()
+            if table not in tables and parents & tables
+        }
+        if not dependents:
+            return tables
+        tables |= dependents
+
+
+def reloadTables(tdb, tdenv, tableNames, reloadPrices = False):
+    """
+    Reloads the import tables in tableNames, and the import tables that
+    depend on them, in place rather than rebuilding the whole cache.
+    
+    StationItem is kept unless one of its parents is reloaded or
+    reloadPrices is set, in which case the .prices file is re-imported,
+    once it has caught up with the cache if it was stale.
+    Everything happens in one transaction, so a failed reload leaves the
+    cache as it was, and older than the .csv files that need loading.
+    """
+    db = tdb.getDB()
+    reloads = dependentTables(
+        db, tableNames,
+        [table for _, table in tdb.importTables] + ['StationItem']
+    )
+    importTables = [
+        (importName, importTable)
+        for importName, importTable in tdb.importTables
+        if importTable in reloads
+    ]
+    if 'StationItem' in reloads:
+        if not reloadPrices:
+            refreshPricesFile(tdb, tdenv)
+        reloadPrices = True
+    
+    tdenv.NOTE(
+        "Reloading {} in the cache.",
+        ", ".join(
+            [table for _, table in importTables]
+            + (['StationItem'] if reloadPrices else [])
+        ),
+        file = sys.stderr
+    )
+    
+    db.commit()
+    db.execute("BEGIN")
+    try:
+        # Children first, so nothing is left for the deletes to cascade.
+        if reloadPrices:
+            for table in ('ItemPriceStats', 'StationMarketSummary', 'StationItem'):
+                db.execute("DELETE FROM {}".format(table))
+        for _, importTable in reversed(importTables):
+            db.execute("DELETE FROM {}".format(importTable))
+        
+        processImportTables(tdenv, db, importTables, commit = False)
+        
+        if reloadPrices:
+            if tdb.pricesPath.exists():
+                processPricesFile(tdenv, db, tdb.pricesPath, commit = False)
+            else:
+                tdenv.NOTE(
+                        "Missing \"{}\" file - no price data.",
+                            tdb.pricesPath,
+                            file = sys.stderr,
+                )
+            stampFile(db, tdb.pricesPath)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    
+    # With a WAL journal, the commit needn't have touched the DB file.
+    os.utime(tdb.dbFilename)
+    tdenv.DEBUG0("Finished")
+
+######################################################################
+
+
+def getFileStamp(db, path):
+    """
+    Returns the (modified, stale) FileStamp of the file at 'path', or
+    None if the cache has none, e.g. because it predates FileStamp.
+    """
+    try:
+        row = db.execute("""
+            SELECT modified, stale FROM FileStamp WHERE name = ?
+        """, [path.name]).fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    if not row:
+        return None
+    return row[0], bool(row[1])
+
+
+def stampFile(db, path, stale = False):
+    """
+    Records that the cache matches the file at 'path' as it is now or,
+    if stale, that the cache has changes the file is missing, in which
+    case the file's last recorded modification time is kept.
+    """
+    modified = path.stat().st_mtime if path.exists() else None
+    if stale:
+        stamp = getFileStamp(db, path)
+        if stamp:
+            modified = stamp[0]
+    db.execute("""
+        INSERT OR REPLACE INTO FileStamp (name, modified, stale)
+        VALUES (?, ?, ?)
+    """, [path.name, modified, int(stale)])
+
+
+def pricesFileChanged(tdb, db):
+    """
+    True if the .prices file was changed since the cache last loaded
+    or wrote it, so it needs importing.
+    """
+    pricesPath = tdb.pricesPath
+    if not pricesPath.exists():
+        return False
+    stamp = getFileStamp(db, pricesPath)
+    if stamp is None:
+        # Nothing recorded, go by whether it's newer than the cache.
+        return pricesPath.stat().st_mtime > tdb.dbPath.stat().st_mtime
+    return pricesPath.stat().st_mtime != stamp[0]
+
+
+def markPricesStale(tdb):
+    """
+    Records that StationItem has changes the .prices file is missing,
+    rather than regenerating the whole file after every import; it is
+    regenerated by refreshPricesFile() when something needs to read it.
+    """
+    db = tdb.getDB()
+    stampFile(db, tdb.pricesPath, stale = True)
+    db.commit()
+
+
+def refreshPricesFile(tdb, tdenv):
+    """
+    Regenerates the .prices file if it is stale, before it is read back
+    into the cache, unless it has been changed since, in which case
+    the changes in the file win.
+    """
+    db = tdb.getDB()
+    stamp = getFileStamp(db, tdb.pricesPath)
+    if stamp and stamp[1] and not pricesFileChanged(tdb, db):
+        regeneratePricesFile(tdb, tdenv)
+
+
 def regeneratePricesFile(tdb, tdenv):
     tdenv.DEBUG0("Regenerating .prices file")
     
-    with tdb.pricesPath.open("w", encoding = 'utf-8') as pricesFile:
-        prices.dumpPrices(
-                tdb.dbFilename,
-                prices.Element.full,
-                file = pricesFile,
-                debug = tdenv.debug)
+    if tdb.pricesPath.suffix == prices.binarySuffix:
+        with tdb.pricesPath.open("wb") as pricesFile:
+            prices.dumpPricesBinary(tdb.dbFilename, pricesFile)
+    else:
+        with tdb.pricesPath.open("w", encoding = 'utf-8') as pricesFile:
+            prices.dumpPrices(
+                    tdb.dbFilename,
+                    prices.Element.full,
+                    file = pricesFile,
+                    debug = tdenv.debug,
+                    workers = None)
     
-    # Update the DB file so we don't regenerate it.
-    os.utime(tdb.dbFilename)
+    db = tdb.getDB()
+    stampFile(db, tdb.pricesPath)
+    db.commit()
 
 ######################################################################
 
@@ -993,6 +1769,8 @@ def importDataFromFile(tdb, tdenv, path, pricesFh = None, reset = False):
         tdenv.DEBUG0("Resetting price data")
         with tdb.getDB() as db:
             db.execute("DELETE FROM StationItem")
+            db.execute("DELETE FROM StationMarketSummary")
+            db.execute("DELETE FROM ItemPriceStats")
             db.commit()
     
     tdenv.DEBUG0("Importing data from {}".format(str(path)))
@@ -1002,6 +1780,11 @@ def importDataFromFile(tdb, tdenv, path, pricesFh = None, reset = False):
             pricesFh = pricesFh,
             )
     
-    # If everything worked, we may need to re-build the prices file.
+    # If everything worked, the prices file is either up to date or
+    # missing the new prices.
     if path != tdb.pricesPath:
-        regeneratePricesFile(tdb, tdenv)
+        markPricesStale(tdb)
+    else:
+        db = tdb.getDB()
+        stampFile(db, path)
+        db.commit()
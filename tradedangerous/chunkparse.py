@@ -0,0 +1,155 @@
+# --------------------------------------------------------------------
+# Copyright (C) Oliver 'kfsone' Smith 2014 <oliver@kfs.org>:
+# Copyright (C) Bernd 'Gazelle' Gollesch 2016, 2017
+# Copyright (C) Jonathan 'eyeonus' Jones 2018, 2019
+#
+# You are free to use, redistribute, or even print and eat a copy of
+# this software so long as you include this copyright notice.
+# I guarantee there is at least one bug neither of us knew about.
+# --------------------------------------------------------------------
+# TradeDangerous :: Modules :: Chunked File Parser
+#
+"""
+Parallel parsing of large line-based data files.
+
+parseFile() splits a file into chunks of whole lines and has a pool
+of worker processes parse them, while the calling thread, which owns
+the database connection, consumes the results in file order:
+
+    for chunk in chunkparse.parseFile(path, parseLines, start=headerEnd):
+        db.executemany(stmt, chunk.rows)
+
+So the parsing of later chunks overlaps with writing earlier ones,
+and SQLite only ever sees the one writer.
+
+The parse function is called with the list of lines of a chunk,
+decoded and with their line endings, and returns the chunk's rows,
+typically a list of tuples. It has to be sent to the workers, so it
+must be a module-level function or a functools.partial of one. A
+record must not span lines, which holds for the CSV and JSON-lines
+files TD reads.
+
+Files that fit in one chunk, or workers=1, are parsed in the calling
+process without starting a pool.
+"""
+
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import io
+import os
+
+__all__ = ['Chunk', 'chunkOffsets', 'parseChunk', 'parseFile']
+
+
+class Chunk(namedtuple('Chunk', [
+        'lineNo', 'start', 'end', 'rows'
+        ])):
+    """
+    One parsed chunk of a file.
+    
+    Attributes:
+        lineNo
+            Line number of the chunk's first line
+        start, end
+            Byte offsets of the chunk; end is also how much of the
+            file has been parsed, for progress bars
+        rows
+            What the parse function returned for the chunk
+    """
+    pass
+
+
+# Large enough that a worker spends far longer parsing a chunk than
+# it takes to ship the rows back.
+defaultChunkSize = 16 * 1024 * 1024
+
+
+def chunkOffsets(path, chunkSize = defaultChunkSize, start = 0):
+    """
+    Returns [(start, end)] byte offsets that split the file at 'path',
+    from 'start' on, into chunks of about chunkSize bytes that each
+    end on a line boundary.
+    """
+    size = os.path.getsize(str(path))
+    offsets = []
+    with open(str(path), "rb") as fh:
+        while start < size:
+            end = start + chunkSize
+            if end < size:
+                fh.seek(end)
+                fh.readline()
+                end = fh.tell()
+            else:
+                end = size
+            offsets.append((start, end))
+            start = end
+    return offsets
+
+
+def parseChunk(path, start, end, parse, encoding = None, errors = None):
+    """
+    Reads one chunk and returns (number of lines, parse(lines)).
+    Lines are decoded with universal newlines, like open() does.
+    """
+    with open(str(path), "rb") as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    lines = io.TextIOWrapper(
+        io.BytesIO(data), encoding = encoding, errors = errors
+    ).readlines()
+    return len(lines), parse(lines)
+
+
+def parseFile(
+        path, parse,
+        start = 0, lineNo = 1,
+        workers = None, chunkSize = defaultChunkSize,
+        encoding = None, errors = None,
+        ):
+    """
+    Generator that yields a Chunk for each chunk of the file at
+    'path' from byte offset 'start', which is on line 'lineNo', in
+    file order.
+    
+    workers
+        Number of worker processes; defaults to one per CPU.
+    encoding, errors
+        As for open().
+    """
+    path = str(path)
+    offsets = chunkOffsets(path, chunkSize, start)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(offsets))
+    
+    if workers <= 1:
+        for start, end in offsets:
+            numLines, rows = parseChunk(path, start, end, parse, encoding, errors)
+            yield Chunk(lineNo, start, end, rows)
+            lineNo += numLines
+        return
+    
+    # Keep every worker busy with a chunk queued behind it, but no
+    # more, so parsed rows can't pile up faster than they are written.
+    pending = deque()
+    offsets = iter(offsets)
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        try:
+            while True:
+                while len(pending) < workers * 2:
+                    try:
+                        start, end = next(offsets)
+                    except StopIteration:
+                        break
+                    pending.append((start, end, pool.submit(
+                        parseChunk, path, start, end, parse, encoding, errors
+                    )))
+                if not pending:
+                    break
+                start, end, future = pending.popleft()
+                numLines, rows = future.result()
+                yield Chunk(lineNo, start, end, rows)
+                lineNo += numLines
+        finally:
+            for _, _, future in pending:
+                future.cancel()
@@ -242,7 +242,41 @@ class CommandIndex(object):
                     type = float,
                     default = None, dest = 'maxSystemLinkLy',
                 )
-        
+        stdArgs.add_argument('--stellar-index',
+                    help = 'Spatial index used for range queries: '
+                            'grid, morton (requires numpy), rtree '
+                            '(uses the DB) or auto.',
+                    choices = ['auto', 'grid', 'morton', 'rtree'],
+                    default = None, dest = 'stellarIndex',
+                )
+        stdArgs.add_argument('--db-profile',
+                    help = 'SQLite connection settings: default, wal (lets '
+                            'queries run during imports) or readonly (for '
+                            'queries, best with a wal DB).',
+                    choices = ['default', 'wal', 'readonly'],
+                    default = None, dest = 'dbProfile',
+                )
+        stdArgs.add_argument('--persist-ranges',
+                    help = 'Keep the neighbours found for each system in the '
+                            'DB so later runs can reuse them.',
+                    default = False, dest = 'persistRanges',
+                    action = 'store_true',
+                )
+        stdArgs.add_argument('--persist-jumps',
+                    help = 'Keep a compact graph of the systems within jump '
+                            'range of each other in the DB so later runs '
+                            'can reuse it.',
+                    default = False, dest = 'persistJumps',
+                    action = 'store_true',
+                )
+        stdArgs.add_argument('--landmarks',
+                    help = 'Speed up long routes by measuring the jump graph '
+                            'from N landmark systems, implies --persist-jumps '
+                            'for the graph.',
+                    metavar = 'N', type = int,
+                    default = None, dest = 'landmarks',
+                )
+
         fromfilePath = _findFromFile(cmdModule.name)
         if fromfilePath:
             argv.insert(2, '{}{}'.format(fromfile_prefix, fromfilePath))
@@ -198,6 +198,17 @@ def sql_query(cmdenv, tdb, queries, mode):
             constraints.append("(supply_price > ?)")
             bindValues.append(cmdenv.gt)
     
+    # Prefilter stations using the SystemPosition R*Tree.
+    nearSystem = cmdenv.nearSystem
+    if nearSystem:
+        maxLy = cmdenv.maxLyPer or tdb.maxSystemLinkLy
+        nearClause, nearBinds = tdb.systemsNearSQL(nearSystem, maxLy)
+        constraints.append(
+            "(s.station_id IN (SELECT station_id FROM Station WHERE {}))"
+            .format(nearClause)
+        )
+        bindValues.extend(nearBinds)
+    
     whereClause = ' AND '.join(constraints)
     stmt = """SELECT DISTINCT {columns} FROM {tables} WHERE {where}""".format(
         columns = ','.join(columns),
@@ -240,14 +251,7 @@ def run(results, cmdenv, tdb):
         if mode is SHIP_MODE:
             results.summary.avg = first.cost
         else:
-            avgPrice = tdb.query("""
-                SELECT AVG(si.supply_price)
-                  FROM StationItem AS si
-                 WHERE si.item_id = ? AND si.supply_price > 0
-            """, [first.ID]).fetchone()[0]
-            if not avgPrice:
-                avgPrice = 0
-            results.summary.avg = int(avgPrice)
+            results.summary.avg = tdb.getAverageSelling().get(first.ID, 0)
     
     # System-based search
     nearSystem = cmdenv.nearSystem
@@ -1,7 +1,7 @@
 from __future__ import absolute_import, with_statement, print_function, division, unicode_literals
 
 from .exceptions import CommandLineError, PadSizeError, PlanetaryError, FleetCarrierError
-from ..tradedb import AmbiguityError, System, Station
+from ..tradedb import AmbiguityError, NameNotFoundError, System, Station
 from ..tradeenv import TradeEnv
 
 import os
@@ -9,6 +9,15 @@ import pathlib
 import sys
 
 
+def didYouMean(error):
+    """
+        Returns ", did you mean ...?" for a NameNotFoundError that has
+        suggestions, otherwise an empty string.
+    """
+    hint = error.didYouMean() if error else ""
+    return ", " + hint if hint else ""
+
+
 class CommandResults(object):
     """
         Encapsulates the results returned by running a command.
@@ -104,6 +113,10 @@ class CommandEnv(TradeEnv):
             
             try:
                 place = self.tdb.lookupPlace(key)
+            except NameNotFoundError as e:
+                raise CommandLineError(
+                        "Unrecognized {}: {}{}"
+                            .format(label, key, didYouMean(e)))
             except LookupError:
                 raise CommandLineError(
                         "Unrecognized {}: {}"
@@ -171,18 +184,23 @@ class CommandEnv(TradeEnv):
             except LookupError:
                 pass
             # Or is it a place?
+            placeError = None
             try:
                 place = tdb.lookupPlace(avoid)
                 avoidPlaces.append(place)
                 if tdb.normalizedStr(place.name()) == tdb.normalizedStr(avoid):
                     continue
                 continue
+            except NameNotFoundError as e:
+                placeError = e
             except LookupError:
                 pass
             
             # If it was none of the above, whine about it
             if not (item or place):
-                raise CommandLineError("Unknown item/system/station: {}".format(avoid))
+                raise CommandLineError("Unknown item/system/station: {}{}".format(
+                    avoid, didYouMean(placeError)
+                ))
             
             # But if it matched more than once, whine about ambiguity
             if item and place:
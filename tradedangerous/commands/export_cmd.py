@@ -83,8 +83,8 @@ def run(results, cmdenv, tdb):
     conn = tdb.getDB()
     conn.row_factory = sqlite3.Row
     
-    # some tables might be ignored
-    ignoreList = []
+    # some tables might be ignored, derived data is never exported
+    ignoreList = list(tdb.derivedTables)
     
     # extract tables from command line
     if cmdenv.tables:
@@ -108,7 +108,9 @@ def run(results, cmdenv, tdb):
                                    """.format(cmdTables=tableStmt),
                                    bindValues):
         tableName = row['name']
-        if tableName in ignoreList:
+        # virtual tables keep their data in "<name>_<suffix>" tables
+        shadowOf = tableName.rpartition('_')[0]
+        if tableName in ignoreList or shadowOf in tdb.derivedTables:
             # ignore the table
             cmdenv.NOTE("Ignore Table '{table}'", table=tableName)
             continue
@@ -146,6 +146,7 @@ def run(results, cmdenv, tdb):
         tk.withdraw()
         filetypes = (
                 ("TradeDangerous '.prices' Files", "*.prices"),
+                ("TradeDangerous binary prices", "*.tdprices"),
                 ("All Files", "*.*"),
                 )
         filename = tkfd.askopenfilename(
@@ -172,7 +173,7 @@ def run(results, cmdenv, tdb):
     
     if cmdenv.plug:
         if not plugin.finish():
-            cache.regeneratePricesFile()
+            cache.markPricesStale(tdb)
             return None
     
     cache.importDataFromFile(tdb, cmdenv, filePath, pricesFh = fh, reset = cmdenv.reset)
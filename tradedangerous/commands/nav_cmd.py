@@ -1,6 +1,10 @@
 from __future__ import absolute_import, with_statement, print_function, division, unicode_literals
+from .exceptions import CommandLineError
 from .parsing import *
+import csv
+import json
 import math
+import sys
 from ..tradedb import System, Station, TradeDB
 from ..tradeexcept import TradeException
 
@@ -12,8 +16,8 @@ name='nav'
 epilog=None
 wantsTradeDB=True
 arguments = [
-    ParseArgument('starting', help='System to start from', type=str),
-    ParseArgument('ending', help='System to end at', type=str),
+    ParseArgument('starting', help='System to start from', type=str, nargs='?'),
+    ParseArgument('ending', help='System to end at', type=str, nargs='?'),
 ]
 switches = [
     ParseArgument('--ly-per',
@@ -37,6 +41,18 @@ switches = [
         type=int,
         dest='stationInterval',
     ),
+    ParseArgument('--fewest-jumps',
+        help='Find the route with the fewest jumps rather than the shortest.',
+        action='store_true',
+        dest='fewestJumps',
+    ),
+    ParseArgument('--batch',
+        help='Instead of starting/ending, read "origin,destination[,ly-per]" '
+                'lines from FILE (or "-" for stdin) and write one JSON '
+                'object per route to stdout.',
+        metavar='FILE',
+        type=str,
+    ),
     PadSizeArgument(),
     MutuallyExclusiveGroup(
         NoPlanetSwitch(),
@@ -53,20 +69,106 @@ class NoRouteError(TradeException):
     pass
 
 
+def readBatch(cmdenv, tdb, batchFile, maxLyPer):
+    """
+    Parses the --batch lines into (origin, dest, maxLy) queries,
+    reporting the lines it can't use as it goes.
+    """
+    queries = []
+    for lineNo, fields in enumerate(csv.reader(batchFile), start=1):
+        fields = [field.strip() for field in fields]
+        if not fields or not fields[0] or fields[0].startswith('#'):
+            continue
+        failure = {'line': lineNo}
+        try:
+            if len(fields) not in (2, 3):
+                raise TradeException(
+                    "expected origin,destination[,ly-per], got {} fields"
+                    .format(len(fields))
+                )
+            origin = tdb.lookupPlace(fields[0])
+            dest = tdb.lookupPlace(fields[1])
+            maxLy = float(fields[2]) if len(fields) > 2 and fields[2] else maxLyPer
+        except (TradeException, LookupError, ValueError) as e:
+            failure['error'] = str(e)
+            print(json.dumps(failure))
+            continue
+        queries.append((origin, dest, maxLy, lineNo))
+    cmdenv.DEBUG0("{:n} routes in batch", len(queries))
+    return queries
+
+
+def runBatch(cmdenv, tdb, maxLyPer, avoiding):
+    """
+    Answers the --batch queries with TradeDB.getRoutes, which shares
+    one search between the queries from each origin, printing each
+    route as soon as it is found.
+    """
+    if cmdenv.starting or cmdenv.ending or cmdenv.viaPlaces:
+        raise CommandLineError(
+            "--batch reads the origins and destinations from the file, "
+            "it can't be used with starting/ending or --via."
+        )
+    if cmdenv.batch == '-':
+        queries = readBatch(cmdenv, tdb, sys.stdin, maxLyPer)
+    else:
+        try:
+            with open(cmdenv.batch, 'r', encoding='utf-8', newline='') as batchFile:
+                queries = readBatch(cmdenv, tdb, batchFile, maxLyPer)
+        except OSError as e:
+            raise CommandLineError("Can't read batch file: {}".format(e))
+    
+    lineNos = {}
+    for origin, dest, maxLy, lineNo in queries:
+        lineNos.setdefault((origin, dest, maxLy), []).append(lineNo)
+    
+    routes = tdb.getRoutes(
+        lineNos.keys(), avoiding,
+        stationInterval=cmdenv.stationInterval,
+        fewestJumps=cmdenv.fewestJumps,
+    )
+    for (origin, dest, maxLy), route in routes:
+        result = {
+            'origin': origin.name(),
+            'destination': dest.name(),
+            'maxLy': maxLy,
+        }
+        if route:
+            result['jumps'] = len(route) - 1
+            result['ly'] = round(route[-1][1], 2)
+            result['route'] = [system.name() for system, _ in route]
+        else:
+            result['route'] = None
+        for lineNo in lineNos[origin, dest, maxLy]:
+            print(json.dumps(dict(line=lineNo, **result)))
+    
+    return None
+
+
 ######################################################################
 # Perform query and populate result set
 
 def run(results, cmdenv, tdb):
     from .commandenv import ResultRow
     
+    maxLyPer = cmdenv.maxLyPer or tdb.maxSystemLinkLy
+    avoiding = [
+        avoid for avoid in cmdenv.avoidPlaces
+        if isinstance(avoid, System)
+    ]
+    if cmdenv.batch:
+        return runBatch(cmdenv, tdb, maxLyPer, avoiding)
+    
     srcSystem, dstSystem = cmdenv.origPlace, cmdenv.destPlace
+    if not srcSystem or not dstSystem:
+        raise CommandLineError(
+            "Specify the starting and ending systems, or --batch."
+        )
     if isinstance(srcSystem, Station):
         srcSystem = srcSystem.system
     if isinstance(dstSystem, Station):
         dstSystem = dstSystem.system
     
-    maxLyPer = cmdenv.maxLyPer or tdb.maxSystemLinkLy
-    
     cmdenv.DEBUG0("Route from {} to {} with max {}ly per jump.",
                     srcSystem.name(), dstSystem.name(), maxLyPer)
     
@@ -78,20 +180,16 @@ def run(results, cmdenv, tdb):
             hops.append([hop, None])
     hops[-1][1] = dstSystem
     
-    avoiding = [
-        avoid for avoid in cmdenv.avoidPlaces
-        if isinstance(avoid, System)
-    ]
-    
     route = [ ]
     stationInterval = cmdenv.stationInterval
     for hop in hops:
-        hopRoute = list(tdb.getRoute(
+        hopRoute = tdb.getRoute(
                 hop[0], hop[1],
                 maxLyPer,
                 avoiding,
                 stationInterval=stationInterval,
-                ))
+                fewestJumps=cmdenv.fewestJumps,
+                )
         if not hopRoute:
             raise NoRouteError(
                     "No route found between {} and {} "
@@ -99,7 +197,7 @@ def run(results, cmdenv, tdb):
                         hop[0].name(), hop[1].name(),
                         maxLyPer,
             ))
-        route = route[:-1] + hopRoute
+        route = route[:-1] + list(hopRoute)
     
     results.summary = ResultRow(
                 fromSys=srcSystem,
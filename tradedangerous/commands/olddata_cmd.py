@@ -79,6 +79,7 @@ def run(results, cmdenv, tdb):
     joins = []
     wheres = []
     havings = []
+    bindValues = []
     
     if cmdenv.minAge:
         wheres.append(
@@ -91,27 +92,21 @@ def run(results, cmdenv, tdb):
         maxLy = cmdenv.maxLyPer or tdb.maxSystemLinkLy
         maxLy2 = maxLy ** 2
         fields.append(
-                "dist2("
-                    "sys.pos_x, sys.pos_y, sys.pos_z,"
-                    "{}, {}, {}"
+                "((sys.pos_x - {0}) * (sys.pos_x - {0})"
+                " + (sys.pos_y - {1}) * (sys.pos_y - {1})"
+                " + (sys.pos_z - {2}) * (sys.pos_z - {2})"
                 ") AS d2".format(
                     nearSys.posX,
                     nearSys.posY,
                     nearSys.posZ,
         ))
         joins.append("INNER JOIN System sys USING (system_id)")
-        wheres.append("""(
-                sys.pos_x BETWEEN {} and {}
-                AND sys.pos_y BETWEEN {} and {}
-                AND sys.pos_z BETWEEN {} and {}
-        )""".format(
-                nearSys.posX - maxLy,
-                nearSys.posX + maxLy,
-                nearSys.posY - maxLy,
-                nearSys.posY + maxLy,
-                nearSys.posZ - maxLy,
-                nearSys.posZ + maxLy,
-        ))
+        # Let the SystemPosition R*Tree narrow down the systems.
+        nearClause, nearBinds = tdb.systemsNearSQL(
+            nearSys, maxLy, "stn.system_id"
+        )
+        wheres.append("(" + nearClause + ")")
+        bindValues.extend(nearBinds)
         havings.append("d2 <= {}".format(maxLy2))
     else:
         fields.append("0")
@@ -157,7 +152,7 @@ def run(results, cmdenv, tdb):
     noPlanet = cmdenv.noPlanet
     mls = cmdenv.maxLs
     
-    for (stnID, age, ls, dist2) in tdb.query(stmt):
+    for (stnID, age, ls, dist2) in tdb.query(stmt, bindValues):
         cmdenv.DEBUG2("{}:{}:{}", stnID, age, ls)
         row = ResultRow()
         row.station = tdb.stationByID[stnID]
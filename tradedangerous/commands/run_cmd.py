@@ -402,6 +402,7 @@ def expandForJumps(tdb, cmdenv, calc, origin, jumps, srcName, purpose):
     
     stations = set()
     origins, avoid = set((origin,)), set(place for place in avoidPlaces)
+    neighbours = tdb.getJumpGraph(maxLyPer).neighbours
     
     for jump in range(jumps):
         if not origins:
@@ -432,7 +433,7 @@ def expandForJumps(tdb, cmdenv, calc, origin, jumps, srcName, purpose):
                     stn.system.dbname, stn.dbname,
                 )
                 stations.add(stn)
-            for dest, dist in tdb.genSystemsInRange(sys, maxLyPer):
+            for dest, dist in neighbours(sys):
                 if dest not in avoid:
                     origins.add(dest)
     
@@ -1011,7 +1012,7 @@ def checkReachability(tdb, cmdenv):
                 if isinstance(avoid, System)
             )
             route = tdb.getRoute(
-                srcSys, dstSys, maxLyPer, avoiding,
+                srcSys, dstSys, maxLyPer, avoiding, fewestJumps=True,
             )
             if not route:
                 raise CommandLineError(
@@ -88,12 +88,7 @@ def run(results, cmdenv, tdb):
     results.summary.avoidStations = avoidStations
     
     if cmdenv.detail:
-        avgPrice = tdb.query("""
-            SELECT AVG(si.demand_price)
-              FROM StationItem AS si
-             WHERE si.item_id = ? AND si.demand_price > 0
-        """, [item.ID]).fetchone()[0]
-        results.summary.avg = int(avgPrice)
+        results.summary.avg = tdb.getAverageBuying().get(item.ID, 0)
     
     # Constraints
     tables = "StationItem AS si"
@@ -124,6 +119,13 @@ def run(results, cmdenv, tdb):
         results.summary.near = nearSystem
         results.summary.ly = maxLy
         distanceFn = nearSystem.distanceTo
+        # Prefilter stations using the SystemPosition R*Tree.
+        nearClause, nearBinds = tdb.systemsNearSQL(nearSystem, maxLy)
+        constraints.append(
+            "(si.station_id IN (SELECT station_id FROM Station WHERE {}))"
+            .format(nearClause)
+        )
+        bindValues.extend(nearBinds)
     else:
         distanceFn = None
     
@@ -316,8 +316,8 @@ def checkResultAndExportStations(tdb, cmdenv, result):
     
     if cmdenv.remove:
         if cmdenv.stationItemCount:
-            cmdenv.NOTE("Station had items, regenerating .prices file")
-            cache.regeneratePricesFile(tdb, cmdenv)
+            cmdenv.DEBUG0("Station had items, .prices file is out of date")
+            cache.markPricesStale(tdb)
     
     return None
 
@@ -563,40 +563,23 @@ class UpdateGUI(ScrollingCanvas):
         """, [station.ID])
         self.newStation = False if int(cur.fetchone()[0]) else True
         
-        cur.execute("""
-            SELECT  item.item_id,
-                    IFNULL(MIN(demand_price), 0),
-                    IFNULL(AVG(demand_price), 0),
-                    IFNULL(MAX(demand_price), 0)
-              FROM  Item
-                    LEFT OUTER JOIN StationItem AS si
-                        ON (
-                            item.item_id = si.item_id
-                            AND si.demand_price > 0
-                        )
-             GROUP  BY 1
-        """)
-        self.demandStats = {
-            ID: [ minCr, int(avgCr), maxCr ]
-            for ID, minCr, avgCr, maxCr in cur
-        }
-        cur.execute("""
-            SELECT  item.item_id,
-                    IFNULL(MIN(supply_price), 0),
-                    IFNULL(AVG(supply_price), 0),
-                    IFNULL(MAX(supply_price), 0)
-              FROM  Item
-                    LEFT OUTER JOIN StationItem AS si
-                        ON (
-                            item.item_id = si.item_id
-                            AND si.supply_price > 0
-                        )
-             GROUP  BY 1
-        """)
-        self.supplyStats = {
-            ID: [ minCr, int(avgCr), maxCr ]
-            for ID, minCr, avgCr, maxCr in cur
-        }
+        noPrices = [ 0, 0, 0 ]
+        itemPriceStats = tdb.getItemPriceStats()
+        self.demandStats, self.supplyStats = {}, {}
+        for ID in tdb.itemByID:
+            stats = itemPriceStats.get(ID)
+            if stats and stats.demand.count:
+                self.demandStats[ID] = [
+                    stats.demand.min, int(stats.demand.avg), stats.demand.max
+                ]
+            else:
+                self.demandStats[ID] = list(noPrices)
+            if stats and stats.supply.count:
+                self.supplyStats[ID] = [
+                    stats.supply.min, int(stats.supply.avg), stats.supply.max
+                ]
+            else:
+                self.supplyStats[ID] = list(noPrices)
         
         if self.newStation and not tdenv.all:
             def splashScreen():
@@ -0,0 +1,122 @@
+# --------------------------------------------------------------------
+# Copyright (C) Oliver 'kfsone' Smith 2014 <oliver@kfs.org>:
+# Copyright (C) Bernd 'Gazelle' Gollesch 2016, 2017
+# Copyright (C) Jonathan 'eyeonus' Jones 2018, 2019
+#
+# You are free to use, redistribute, or even print and eat a copy of
+# this software so long as you include this copyright notice.
+# I guarantee there is at least one bug neither of us knew about.
+# --------------------------------------------------------------------
+# TradeDangerous :: Modules :: DB Connection Pool
+#
+"""
+Pool of read connections for using one TradeDB from many threads.
+
+A sqlite3 connection can only be used by one thread at a time, so
+TradeDB keeps its own connection for the thread that loaded it (the
+writer) and hands every other thread a connection from a
+ReadConnectionPool:
+
+    with tdb.getReadPool().connection() as conn:
+        conn.execute(...)
+
+or, for code that calls tdb.query() or tdb.getDB() from a worker
+thread, a connection that stays with the thread until it exits.
+
+Connections are kept open between uses, so each keeps its cache of
+prepared statements warm; the pool is sized to the number of
+threads that query at the same time.
+"""
+
+from contextlib import contextmanager
+import threading
+
+__all__ = ['ReadConnectionPool']
+
+
+class ReadConnectionPool(object):
+    """
+    Checkout/checkin pool of connections made by connect(), which
+    must return connections that can move between threads
+    (check_same_thread=False).
+    
+    Attributes:
+        maxIdle
+            How many returned connections are kept for reuse, the
+            rest are closed.
+    """
+    
+    def __init__(self, connect, maxIdle=8):
+        self.connect = connect
+        self.maxIdle = maxIdle
+        self.idle = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.threadConns = {}
+        self.closed = False
+    
+    def checkout(self):
+        """ Returns an idle connection, or a new one if none are. """
+        with self.lock:
+            if self.closed:
+                raise ValueError("Connection pool is closed")
+            if self.idle:
+                return self.idle.pop()
+        return self.connect()
+    
+    def checkin(self, conn):
+        """ Returns a connection from checkout() to the pool. """
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            if not self.closed and len(self.idle) < self.maxIdle:
+                self.idle.append(conn)
+                return
+        conn.close()
+    
+    @contextmanager
+    def connection(self):
+        """ Context that checks a connection out and back in. """
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+    
+    def threadConnection(self):
+        """
+        Returns the calling thread's own connection, which it keeps
+        until it exits; it is closed once another thread asks for its
+        own connection, or by close().
+        """
+        try:
+            conn = self.local.conn
+        except AttributeError:
+            pass
+        else:
+            if self.closed:
+                raise ValueError("Connection pool is closed")
+            return conn
+        conn = self.local.conn = self.checkout()
+        with self.lock:
+            finished = [
+                thread for thread in self.threadConns if not thread.is_alive()
+            ]
+            finished = [self.threadConns.pop(thread) for thread in finished]
+            self.threadConns[threading.current_thread()] = conn
+        for oldConn in finished:
+            oldConn.close()
+        return conn
+    
+    def close(self):
+        """
+        Closes the idle and per-thread connections and stops handing
+        out more; connections that are checked out are closed when
+        they are checked back in.
+        """
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            threadConns, self.threadConns = self.threadConns, {}
+        for conn in idle + list(threadConns.values()):
+            conn.close()
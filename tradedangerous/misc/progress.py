@@ -1,3 +1,5 @@
+from itertools import islice
+import os
 import sys
 
 class Progress(object):
@@ -5,7 +7,7 @@ class Progress(object):
     Helper class that describes a simple text-based progress bar.
     """
     
-    def __init__(self, maxValue, width, start=0, prefix=""):
+    def __init__(self, maxValue, width, start=0, prefix="", postfix=""):
         """
         Arguments:
             maxValue
@@ -16,18 +18,28 @@ class Progress(object):
                 Initial value
             prefix
                 Something to print infront of the progress bar
+            postfix
+                Default postfix for increment() and update()
         """
         self.start = start
         self.maxValue = maxValue
         self.width = width
         self.value = start
         self.progress = -1
+        self.nextValue = start
         self.prefix = prefix
+        self.postfix = postfix
         self.textLen = 0
         self.mask = '\r' + self.prefix + "[{{:<{width}}}]".format(width=width)
 
 
-    def increment(self, value, postfix=""):
+    @staticmethod
+    def percent(value, goal):
+        """ Postfix showing how far along the bar is, e.g. ' 42%'. """
+        return " " + str(round(value / goal * 100)) + "%"
+
+
+    def increment(self, value, postfix=None):
         """
         Increment the progress bar's internal counter by 'value',
         and if this changes the progress step, re-draw the bar.
@@ -36,17 +48,42 @@ class Progress(object):
             value
                 The amount to increment the internal counter by
             postfix [optional]
-                String or callable to print after the bar
+                String or callable to print after the bar,
+                defaults to the one given to the constructor
         
         Returns:
             False if the progress bar did not redraw,
             True if the progress bar was redrawn,
         """
-        self.value = min(self.maxValue, self.value + value)
+        self.value += value
+        if self.value < self.nextValue:
+            return False
+        return self.draw(postfix)
+
+
+    def update(self, value, postfix=None):
+        """
+        Like increment(), but sets the internal counter to 'value'.
+        """
+        self.value = value
+        if value < self.nextValue:
+            return False
+        return self.draw(postfix)
+
+
+    def draw(self, postfix=None):
+        """
+        Re-draws the bar if the counter has reached a new step.
+        """
+        self.value = min(self.maxValue, self.value)
         progress = int(self.width * (self.value - self.start) / self.maxValue)
+        # The counter can't change the bar again until the next step.
+        self.nextValue = self.start + (progress + 1) * self.maxValue / self.width
         if progress == self.progress:
             return False
         
+        if postfix is None:
+            postfix = self.postfix
         if callable(postfix):
             postfixText = postfix(self.value, self.maxValue)
         else:
@@ -68,4 +105,45 @@ class Progress(object):
         if self.textLen:
             fin = "\r{:{width}}\r".format('', width=self.textLen)
             sys.stdout.write(fin)
-            sys.stdout.flush()
\ No newline at end of file
+            sys.stdout.flush()
+
+
+class FileProgress(Progress):
+    """
+    Progress bar for reading through a file, measured by how far into
+    the file the reader is, so the file doesn't have to be read once
+    beforehand just to count its lines.
+    
+        with open(path, "rb") as fh:
+            prog = FileProgress(fh, 50)
+            for row in prog.iterate(csv.reader(io.TextIOWrapper(fh))):
+                ...
+            prog.clear()
+    """
+    
+    def __init__(self, fh, width, prefix="", postfix=Progress.percent):
+        """
+        Arguments:
+            fh
+                The binary file being read; its size is the 100% mark
+                and its tell() the current value.
+            width, prefix, postfix
+                As for Progress
+        """
+        size = os.fstat(fh.fileno()).st_size
+        super().__init__(max(size, 1), width, prefix=prefix, postfix=postfix)
+        self.fh = fh
+
+
+    def iterate(self, rows, interval=1024):
+        """
+        Yields the items of 'rows', an iterator that reads from the
+        file, re-checking the file position every 'interval' items.
+        """
+        tell, update = self.fh.tell, self.update
+        while True:
+            batch = list(islice(rows, interval))
+            if not batch:
+                break
+            update(tell())
+            yield from batch
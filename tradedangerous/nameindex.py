@@ -0,0 +1,233 @@
+# --------------------------------------------------------------------
+# Copyright (C) Oliver 'kfsone' Smith 2014 <oliver@kfs.org>:
+# Copyright (C) Bernd 'Gazelle' Gollesch 2016, 2017
+# Copyright (C) Jonathan 'eyeonus' Jones 2018, 2019
+#
+# You are free to use, redistribute, or even print and eat a copy of
+# this software so long as you include this copyright notice.
+# I guarantee there is at least one bug neither of us knew about.
+# --------------------------------------------------------------------
+# TradeDangerous :: Modules :: Name Index
+#
+"""
+Prebuilt index of names used by TradeDB to resolve user-supplied
+System and Station names without normalizing every candidate on
+every lookup.
+
+Each name is normalized and trimmed once, when the index is built,
+using the same translation tables as TradeDB.listSearch. Lookups
+then use:
+
+    exact
+        a dict of trimmed name -> entries, for whole-name matches,
+    
+    positions
+        one string holding every trimmed name, walked with str.find,
+        for the partial and whole-word matches. Because a match of
+        the normalized name always implies a match of the trimmed
+        one, this yields every entry the original ranking rules
+        could accept, in their original order.
+    
+    suggest
+        an inverted index of name trigrams, built on first use, that
+        finds the names sharing trigrams with one that matched
+        nothing; the closest of those by edit distance are suggested,
+        so that typos like swapped letters, which break up several
+        trigrams, are still caught.
+"""
+
+from bisect import bisect_right
+from collections import Counter
+import heapq
+
+__all__ = ['NameIndex', 'trigrams', 'similarity', 'editDistance']
+
+
+def trigrams(normName):
+    """
+    Returns the set of trigrams of a normalized name. Each word is
+    padded first, so short words and word starts carry weight.
+    """
+    grams = set()
+    for word in normName.replace("'", "").split():
+        word = "  " + word + " "
+        grams.update(word[i:i+3] for i in range(len(word) - 2))
+    return grams
+
+
+def similarity(leftGrams, rightGrams):
+    """
+    Returns the Jaccard similarity, 0 to 1, of two trigram sets.
+    """
+    shared = len(leftGrams & rightGrams)
+    if not shared:
+        return 0.
+    return shared / (len(leftGrams) + len(rightGrams) - shared)
+
+
+def editDistance(left, right):
+    """
+    Returns the number of single character insertions, deletions,
+    substitutions or transpositions of adjacent characters that turn
+    left into right (the optimal string alignment distance).
+    """
+    if len(left) < len(right):
+        left, right = right, left
+    prevPrev, prev = None, list(range(len(right) + 1))
+    for i, leftChar in enumerate(left, 1):
+        cur = [i]
+        for j, rightChar in enumerate(right, 1):
+            cost = prev[j - 1] + (leftChar != rightChar)
+            cost = min(cost, prev[j] + 1, cur[j - 1] + 1)
+            if (i > 1 and j > 1 and leftChar == right[j - 2]
+                    and left[i - 2] == rightChar):
+                cost = min(cost, prevPrev[j - 2] + 1)
+            cur.append(cost)
+        prevPrev, prev = prev, cur
+    return prev[-1]
+
+
+class NameIndex(object):
+    """
+    Index over the names of a list of items, see module docstring.
+    
+    Attributes:
+        items
+            The items, in the order they were given,
+        normed
+            The normalized name of each item,
+        trimmed
+            The normalized name with whitespace and apostrophes removed.
+    """
+    
+    # Can't appear in a trimmed name, so matches never span two names.
+    separator = '\0'
+    
+    # Names sharing less of their trigrams than this aren't considered.
+    minGramSimilarity = 0.1
+    
+    # How many of the names sharing the most trigrams are compared by
+    # edit distance, per suggestion asked for.
+    candidatesPerSuggestion = 4
+    
+    # Names less similar than this by edit distance, 1 minus the
+    # edits needed per character, are never suggested.
+    minSimilarity = 0.6
+    
+    def __init__(self, items, key, normTrans, trimTrans):
+        self.normTrans = normTrans
+        self.grams = None
+        self.gramCounts = None
+        self.items = list(items)
+        self.normed = normed = []
+        self.trimmed = trimmed = []
+        self.byTrimmed = byTrimmed = {}
+        self.starts = starts = []
+        offset = 0
+        for pos, item in enumerate(self.items):
+            normName = key(item).translate(normTrans)
+            trimName = normName.translate(trimTrans)
+            normed.append(normName)
+            trimmed.append(trimName)
+            try:
+                byTrimmed[trimName].append(pos)
+            except KeyError:
+                byTrimmed[trimName] = [pos]
+            starts.append(offset)
+            offset += len(trimName) + 1
+        self.haystack = self.separator.join(trimmed)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def exact(self, trimName):
+        """ Returns the items whose trimmed name is exactly trimName. """
+        items = self.items
+        return [items[pos] for pos in self.byTrimmed.get(trimName, ())]
+    
+    def positions(self, trimName):
+        """
+        Returns the positions of every item whose trimmed name
+        contains trimName, in ascending order.
+        """
+        if not trimName:
+            return range(len(self.items))
+        if self.separator in trimName:
+            return []
+        haystack, starts = self.haystack, self.starts
+        last = len(starts) - 1
+        found = []
+        offset = haystack.find(trimName)
+        while offset >= 0:
+            pos = bisect_right(starts, offset) - 1
+            found.append(pos)
+            if pos >= last:
+                break
+            # Skip to the start of the next name.
+            offset = haystack.find(trimName, starts[pos + 1])
+        return found
+    
+    def search(self, trimName):
+        """ Returns the items whose trimmed name contains trimName. """
+        items = self.items
+        return [items[pos] for pos in self.positions(trimName)]
+    
+    def entries(self, trimName):
+        """
+        Returns (item, normalizedName) for every item whose trimmed
+        name contains trimName.
+        """
+        items, normed = self.items, self.normed
+        return [(items[pos], normed[pos]) for pos in self.positions(trimName)]
+    
+    def _buildGrams(self):
+        grams, gramCounts = {}, []
+        for pos, normName in enumerate(self.normed):
+            nameGrams = trigrams(normName)
+            gramCounts.append(len(nameGrams))
+            for gram in nameGrams:
+                try:
+                    grams[gram].append(pos)
+                except KeyError:
+                    grams[gram] = [pos]
+        self.grams, self.gramCounts = grams, gramCounts
+    
+    def suggest(self, name, limit=5):
+        """
+        Returns up to 'limit' (similarity, item) pairs for the items
+        whose names are most similar to 'name', best first.
+        """
+        if self.grams is None:
+            self._buildGrams()
+        normName = name.translate(self.normTrans)
+        nameGrams = trigrams(normName)
+        if not nameGrams:
+            return []
+        shared = Counter()
+        grams = self.grams
+        for gram in nameGrams:
+            shared.update(grams.get(gram, ()))
+        numGrams, gramCounts = len(nameGrams), self.gramCounts
+        minGramSimilarity = self.minGramSimilarity
+        candidates = []
+        for pos, count in shared.items():
+            score = count / (numGrams + gramCounts[pos] - count)
+            if score >= minGramSimilarity:
+                candidates.append((score, -pos))
+        candidates = heapq.nlargest(
+            limit * self.candidatesPerSuggestion, candidates
+        )
+        
+        normed, minSimilarity = self.normed, self.minSimilarity
+        scored = []
+        for _, negPos in candidates:
+            candidate = normed[-negPos]
+            edits = editDistance(normName, candidate)
+            score = 1. - edits / max(len(normName), len(candidate))
+            if score >= minSimilarity:
+                scored.append((score, negPos))
+        items = self.items
+        return [
+            (score, items[-negPos])
+            for score, negPos in heapq.nlargest(limit, scored)
+        ]
@@ -12,13 +12,15 @@ import platform
 import sqlite3
 import time
 
+from functools import partial
+from itertools import islice
 from urllib import request
 from calendar import timegm
 from pathlib import Path
 from importlib import reload
 from builtins import str
 
-from .. import plugins, cache, csvexport, tradedb, tradeenv, transfers
+from .. import plugins, cache, chunkparse, csvexport, tradedb, tradeenv, transfers
 from ..misc import progress as pbar
 from ..plugins import PluginException
 from shutil import copyfile
@@ -41,6 +43,141 @@ class DecodingError(PluginException):
     pass
 
 
+def formatModified(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def fixShipName(ship):
+    """
+    Make sure all the 'Mark N' ship names abbreviate 'Mark' as '<Name> Mk. <Number>'.
+    """
+    # Fix capitalization.
+    ship = ship.replace('MK', 'Mk').replace('mk', 'Mk').replace('mK', 'Mk')
+    # Fix no '.' in abbreviation.
+    if "Mk" in ship and "Mk." not in ship:
+        ship = ship.replace('Mk', 'Mk.')
+    # Fix no trailing space.
+    if "Mk." in ship and "Mk. " not in ship:
+        ship = ship.replace("Mk.", "Mk. ")
+    # Fix no leading space.
+    if "Mk." in ship and " Mk." not in ship:
+        ship = ship.replace("Mk.", " Mk.")
+    return ship
+
+
+def parseSystemLines(lines):
+    """
+    chunkparse parser for systems_populated.jsonl, returns
+    (system_id, name, pos_x, pos_y, pos_z, modified) rows.
+    """
+    rows = []
+    for line in lines:
+        system = json.loads(line)
+        rows.append((
+            system['id'], system['name'],
+            system['x'], system['y'], system['z'],
+            formatModified(system['updated_at']),
+        ))
+    return rows
+
+
+def parseSystemCsvLines(columns, lines):
+    """
+    chunkparse parser for systems.csv and systems_recently.csv, returns
+    the same rows as parseSystemLines. 'columns' are the positions of
+    the id, name, x, y, z and updated_at columns.
+    """
+    idCol, nameCol, xCol, yCol, zCol, updatedCol = columns
+    rows = []
+    for system in csv.reader(lines):
+        if not system:
+            continue
+        rows.append((
+            system[idCol], system[nameCol],
+            system[xCol], system[yCol], system[zCol],
+            formatModified(int(system[updatedCol])),
+        ))
+    return rows
+
+
+def parseStationLines(lines):
+    """
+    chunkparse parser for stations.jsonl, returns a row per station of
+        (station, shipyard, outfitting)
+    where station is the values of a Station row, and shipyard and
+    outfitting are None or (modified, [ship names or upgrade ids]).
+    """
+    rows = []
+    for line in lines:
+        station = json.loads(line)
+        modified = formatModified(station['updated_at'])
+        max_pad_size = station['max_landing_pad_size']
+        row = (
+            station['id'],
+            station['name'],
+            station['system_id'],
+            station['distance_to_star'] if station['distance_to_star'] else 0,
+            'Y' if station['has_blackmarket'] else 'N',
+            max_pad_size if max_pad_size and max_pad_size != 'None' else '?',
+            'Y' if station['has_market'] else 'N',
+            'Y' if station['has_shipyard'] else 'N',
+            modified,
+            'Y' if station['has_outfitting'] else 'N',
+            'Y' if station['has_rearm'] else 'N',
+            'Y' if station['has_refuel'] else 'N',
+            'Y' if station['has_repair'] else 'N',
+            'Y' if station['is_planetary'] else 'N',
+            station['type_id'] if station['type_id'] else 0,
+        )
+        shipyard = outfitting = None
+        if station['has_shipyard']:
+            shipyard = (
+                formatModified(station['shipyard_updated_at'] or station['updated_at']),
+                [fixShipName(ship) for ship in station['selling_ships']],
+            )
+        if station['has_outfitting']:
+            outfitting = (
+                formatModified(station['outfitting_updated_at'] or station['updated_at']),
+                station['selling_modules'],
+            )
+        rows.append((row, shipyard, outfitting))
+    return rows
+
+
+def parseListingLines(columns, lines):
+    """
+    chunkparse parser for listings.csv, returns rows of
+        (station_id, item_id, collected_at,
+         demand_price, demand_units, demand_level,
+         supply_price, supply_units, supply_level)
+    with an empty bracket as -1. 'columns' are the positions of those
+    values' columns in the file.
+    """
+    (
+        stationCol, itemCol, collectedCol,
+        sellCol, demandCol, demandLevelCol,
+        buyCol, supplyCol, supplyLevelCol,
+    ) = columns
+    rows = []
+    for listing in csv.reader(lines):
+        if not listing:
+            continue
+        demand_level = listing[demandLevelCol]
+        supply_level = listing[supplyLevelCol]
+        rows.append((
+            int(listing[stationCol]),
+            int(listing[itemCol]),
+            int(listing[collectedCol]),
+            int(listing[sellCol]),
+            int(listing[demandCol]),
+            int(demand_level) if demand_level != '' else -1,
+            int(listing[buyCol]),
+            int(listing[supplyCol]),
+            int(supply_level) if supply_level != '' else -1,
+        ))
+    return rows
+
+
 class ImportPlugin(plugins.ImportPluginBase):
     """
     Plugin that downloads data from eddb.
@@ -65,7 +202,8 @@ class ImportPlugin(plugins.ImportPluginBase):
                         "(Useful for updating Vendor tables if they were skipped during a '-O clean' run.)",
         'fallback':     "Fallback to using EDDB.io if Tromador's mirror isn't working.",
         'progbar':      "Does nothing, only included for backwards compatibility.",
-        'solo':         "Don't download crowd-sourced market data. (Implies '-O skipvend', supercedes '-O all', '-O clean', '-O listings'.)"
+        'solo':         "Don't download crowd-sourced market data. (Implies '-O skipvend', supercedes '-O all', '-O clean', '-O listings'.)",
+        'workers':      "Number of processes used to parse the dump files, e.g. '-O workers=4'. (Default: one per CPU.)"
     }
     
     def __init__(self, tdb, tdenv):
@@ -153,12 +291,51 @@ class ImportPlugin(plugins.ImportPluginBase):
                 yield result
     
     @staticmethod
-    def blocks(f, size = 65536):
+    def batches(rows, size = 100000):
+        """
+        Splits an iterable into lists of up to 'size' items, for executemany.
+        """
+        rows = iter(rows)
         while True:
-            b = f.read(size)
-            if not b:
+            batch = list(islice(rows, size))
+            if not batch:
                 break
-            yield b
+            yield batch
+    
+    def loadTable(self, table):
+        """
+        Context for loading 'table'. When it starts out empty, as on a
+        clean run, its secondary indexes are dropped for the load and
+        re-built afterwards.
+        """
+        db = self.tdb.getDB()
+        empty = not db.execute("SELECT 1 FROM {} LIMIT 1".format(table)).fetchone()
+        return cache.indexesDropped(db, [table] if empty else [])
+    
+    def parseFile(self, path, parse, header = False):
+        """
+        Yields the rows of the file at 'path' as parsed by 'parse', see
+        chunkparse, while drawing a progress bar. With header set, the
+        first line is read here and 'parse' is called with its column
+        names to get the parser for the rest of the file.
+        """
+        workers = self.getOption('workers')
+        try:
+            workers = int(workers) if workers else None
+        except ValueError:
+            raise PluginException("Invalid 'workers' option: {}".format(workers))
+        
+        with open(str(path), "rb") as fh:
+            start = 0
+            if header:
+                columns = next(csv.reader([fh.readline().decode()]))
+                parse = parse(columns)
+                start = fh.tell()
+            prog = pbar.FileProgress(fh, 50)
+            for chunk in chunkparse.parseFile(path, parse, start = start, workers = workers):
+                yield from chunk.rows
+                prog.update(chunk.end)
+            prog.clear()
     
     def downloadFile(self, urlTail, path):
         """
@@ -330,6 +507,31 @@ class ImportPlugin(plugins.ImportPluginBase):
         
         tdenv.NOTE("Finished processing Ships. End time = {}", self.now())
     
+    def upsertSystems(self, systems):
+        """
+        Adds the (system_id, name, pos_x, pos_y, pos_z, modified) rows
+        of 'systems' to the System table, in batches, updating systems
+        already in it unless their data is at least as recent.
+        """
+        tdenv = self.tdenv
+        
+        with self.loadTable('System'):
+            for batch in self.batches(systems):
+                # INSERT then UPDATE rather than an upsert, which needs
+                # SQLite 3.24.
+                changed = self.executemany("""INSERT OR IGNORE INTO System
+                            ( system_id,name,pos_x,pos_y,pos_z,modified ) VALUES
+                            ( ?, ?, ?, ?, ?, ? )""",
+                            batch).rowcount
+                changed += self.executemany("""UPDATE System
+                            SET name = ?, pos_x = ?, pos_y = ?, pos_z = ?, modified = ?
+                            WHERE system_id = ? AND modified < ?""",
+                            [(name, x, y, z, modified, system_id, modified)
+                             for system_id, name, x, y, z, modified in batch]).rowcount
+                tdenv.DEBUG0("{} of {} systems added or updated.", changed, len(batch))
+                if changed:
+                    self.updated['System'] = True
+    
     def importSystems(self):
         """
         Populate the System table using systems_populated.jsonl
@@ -340,46 +542,7 @@ class ImportPlugin(plugins.ImportPluginBase):
         
         tdenv.NOTE("Processing Systems: Start time = {}", self.now())
         
-        total = 1
-        
-        with open(str(self.dataPath / self.sysPopPath), "r", encoding = "utf-8", errors = 'ignore') as f:
-            total += (sum(bl.count("\n") for bl in self.blocks(f)))
-        
-        with open(str(self.dataPath / self.sysPopPath), "rU") as fh:
-            prog = pbar.Progress(total, 50)
-            for line in fh:
-                prog.increment(1, postfix = lambda value, goal: " " + str(round(value / total * 100)) + "%")
-                system = json.loads(line)
-                system_id = system['id']
-                name = system['name']
-                pos_x = system['x']
-                pos_y = system['y']
-                pos_z = system['z']
-                modified = datetime.datetime.utcfromtimestamp(system['updated_at']).strftime('%Y-%m-%d %H:%M:%S')
-                
-                result = self.execute("SELECT modified FROM System WHERE system_id = ?", (system_id,)).fetchone()
-                if result:
-                    updated = timegm(datetime.datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S').timetuple())
-                    if system['updated_at'] > updated:
-                        tdenv.DEBUG0("System '{}' has been updated: '{}' vs '{}'", name, modified, result[0])
-                        tdenv.DEBUG1("Updating: {}, {}, {}, {}, {}, {}", system_id, name, pos_x, pos_y, pos_z, modified)
-                        self.execute("""UPDATE System
-                                    SET name = ?,pos_x = ?,pos_y = ?,pos_z = ?,modified = ?
-                                    WHERE system_id = ?""",
-                                    (name, pos_x, pos_y, pos_z, modified,
-                                     system_id))
-                        self.updated['System'] = True
-                else:
-                    tdenv.DEBUG0("System '{}' has been added.", name)
-                    tdenv.DEBUG1("Inserting: {}, {}, {}, {}, {}, {}", system_id, name, pos_x, pos_y, pos_z, modified)
-                    self.execute("""INSERT INTO System
-                                ( system_id,name,pos_x,pos_y,pos_z,modified ) VALUES
-                                ( ?, ?, ?, ?, ?, ? ) """,
-                                (system_id, name, pos_x, pos_y, pos_z, modified))
-                    self.updated['System'] = True
-            while prog.value < prog.maxValue:
-                prog.increment(1, postfix = lambda value, goal: " " + str(round(value / total * 100)) + "%")
-            prog.clear()
+        self.upsertSystems(self.parseFile(self.dataPath / self.sysPopPath, parseSystemLines))
         
         tdenv.NOTE("Finished processing Systems. End time = {}", self.now())
     
@@ -393,46 +556,13 @@ class ImportPlugin(plugins.ImportPluginBase):
         
         tdenv.NOTE("Processing Systems in {}: Start time = {}", str(source), self.now())
         
-        total = 1
-                
-        with open(str(self.dataPath / source), "r", encoding = "utf-8", errors = 'ignore') as f:
-            total += (sum(bl.count("\n") for bl in self.blocks(f)))
-        
-        with open(str(self.dataPath / source), "rU") as fh:
-            sysDict = csv.DictReader(fh)
-            prog = pbar.Progress(total, 50)
-            for system in sysDict:
-                prog.increment(1, postfix = lambda value, goal: " " + str(round(value / total * 100)) + "%")
-                system_id = system['id']
-                name = system['name']
-                pos_x = system['x']
-                pos_y = system['y']
-                pos_z = system['z']
-                modified = datetime.datetime.utcfromtimestamp(int(system['updated_at'])).strftime('%Y-%m-%d %H:%M:%S')
-                
-                result = self.execute("SELECT modified FROM System WHERE system_id = ?", (system_id,)).fetchone()
-                if result:
-                    updated = timegm(datetime.datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S').timetuple())
-                    if int(system['updated_at']) > updated:
-                        tdenv.DEBUG0("System '{}' has been updated: '{}' vs '{}'", name, modified, result[0])
-                        tdenv.DEBUG1("Updating: {}, {}, {}, {}, {}, {}", system_id, name, pos_x, pos_y, pos_z, modified)
-                        self.execute("""UPDATE System
-                                    SET name = ?,pos_x = ?,pos_y = ?,pos_z = ?,modified = ?
-                                    WHERE system_id = ?""",
-                                    (name, pos_x, pos_y, pos_z, modified,
-                                     system_id))
-                        self.updated['System'] = True
-                else:
-                    tdenv.DEBUG0("System '{}' has been added.", name)
-                    tdenv.DEBUG1("Inserting: {}, {}, {}, {}, {}, {}", system_id, name, pos_x, pos_y, pos_z, modified)
-                    self.execute("""INSERT INTO System
-                                ( system_id,name,pos_x,pos_y,pos_z,modified ) VALUES
-                                ( ?, ?, ?, ?, ?, ? ) """,
-                                (system_id, name, pos_x, pos_y, pos_z, modified))
-                    self.updated['System'] = True
-            while prog.value < prog.maxValue:
-                prog.increment(1, postfix = lambda value, goal: " " + str(round(value / total * 100)) + "%")
-            prog.clear()
+        def parser(columns):
+            columns = {name: pos for pos, name in enumerate(columns)}
+            return partial(parseSystemCsvLines, tuple(
+                columns[name] for name in ('id', 'name', 'x', 'y', 'z', 'updated_at')
+            ))
+        
+        self.upsertSystems(self.parseFile(self.dataPath / source, parser, header = True))
         
         tdenv.NOTE("Finished processing Systems. End time = {}", self.now())
         
@@ -463,6 +593,59 @@ class ImportPlugin(plugins.ImportPluginBase):
         
         tdenv.NOTE("Finished purging Systems. End time = {}", self.now())
     
+    def mergeVendors(self, table, vendors):
+        """
+        Replaces what 'table', ShipVendor or UpgradeVendor, lists for
+        the stations in 'vendors', {station_id: (modified, [ships or
+        upgrades sold])}, whose data is newer than the DB's.
+        """
+        tdenv = self.tdenv
+        
+        self.execute("DELETE FROM temp.VendorStation")
+        self.execute("DELETE FROM temp.VendorItem")
+        self.executemany("INSERT INTO temp.VendorStation ( station_id,modified ) VALUES ( ?, ? )",
+                    [(station_id, modified) for station_id, (modified, _) in vendors.items()])
+        self.executemany("INSERT INTO temp.VendorItem ( station_id,item ) VALUES ( ?, ? )",
+                    [(station_id, item)
+                     for station_id, (_, items) in vendors.items()
+                     for item in items])
+        # Like the station's other data, it's compared to the first
+        # row the DB has for it.
+        self.execute("""DELETE FROM temp.VendorStation
+                    WHERE modified <= (
+                        SELECT modified FROM {table}
+                         WHERE {table}.station_id = VendorStation.station_id
+                         LIMIT 1
+                    )""".format(table = table))
+        updated = self.execute("SELECT COUNT(*) FROM temp.VendorStation").fetchone()[0]
+        tdenv.DEBUG0("Updating the {} of {} of {} stations.", table, updated, len(vendors))
+        if not updated:
+            return
+        
+        self.execute("""DELETE FROM {table}
+                    WHERE station_id IN (SELECT station_id FROM temp.VendorStation)
+                    """.format(table = table))
+        # Items that don't resolve to a ship or upgrade are skipped.
+        if table == 'ShipVendor':
+            self.execute("""INSERT OR IGNORE INTO ShipVendor
+                        ( ship_id,station_id,modified )
+                        SELECT (SELECT Ship.ship_id FROM Ship WHERE Ship.name = v.item),
+                               v.station_id, s.modified
+                          FROM temp.VendorItem AS v
+                               INNER JOIN temp.VendorStation AS s USING (station_id)
+                         ORDER BY v.rowid""")
+        else:
+            self.execute("""INSERT OR IGNORE INTO UpgradeVendor
+                        ( upgrade_id,station_id,cost,modified )
+                        SELECT v.item, v.station_id,
+                               (SELECT Upgrade.cost FROM Upgrade WHERE Upgrade.upgrade_id = v.item),
+                               s.modified
+                          FROM temp.VendorItem AS v
+                               INNER JOIN temp.VendorStation AS s USING (station_id)
+                         WHERE v.item IN (SELECT upgrade_id FROM Upgrade)
+                         ORDER BY v.rowid""")
+        self.updated[table] = True
+    
     def importStations(self):
         """
         Populate the Station table using stations.jsonl
@@ -472,165 +655,65 @@ class ImportPlugin(plugins.ImportPluginBase):
         tdb, tdenv = self.tdb, self.tdenv
         
         tdenv.NOTE("Processing Stations, this may take a bit: Start time = {}", self.now())
-        if self.getOption('shipvend'):
+        shipvend = self.getOption('shipvend')
+        if shipvend:
             tdenv.NOTE("Simultaneously processing ShipVendors.")
         
-        if self.getOption('upvend'):
+        upvend = self.getOption('upvend')
+        if upvend:
             tdenv.NOTE("Simultaneously processing UpgradeVendors, this will take quite a while.")
         
-        total = 1
-        
-        with open(str(self.dataPath / self.stationsPath), "r", encoding = "utf-8", errors = 'ignore') as f:
-            total += (sum(bl.count("\n") for bl in self.blocks(f)))
-        
-        with open(str(self.dataPath / self.stationsPath), "rU") as fh:
-            prog = pbar.Progress(total, 50)
-            for line in fh:
-                prog.increment(1, postfix = lambda value, goal: " " + str(round(value / total * 100)) + "%")
-                station = json.loads(line)
-                
-                # Import Stations
-                station_id = station['id']
-                name = station['name']
-                system_id = station['system_id']
-                ls_from_star = station['distance_to_star'] if station['distance_to_star'] else 0
-                blackmarket = 'Y' if station['has_blackmarket'] else 'N'
-                max_pad_size = station['max_landing_pad_size'] if station['max_landing_pad_size'] and station['max_landing_pad_size'] != 'None' else '?'
-                market = 'Y' if station['has_market'] else 'N'
-                shipyard = 'Y' if station['has_shipyard'] else 'N'
-                modified = datetime.datetime.utcfromtimestamp(station['updated_at']).strftime('%Y-%m-%d %H:%M:%S')
-                outfitting = 'Y' if station['has_outfitting'] else 'N'
-                rearm = 'Y' if station['has_rearm'] else 'N'
-                refuel = 'Y' if station['has_refuel'] else 'N'
-                repair = 'Y' if station['has_repair'] else 'N'
-                planetary = 'Y' if station['is_planetary'] else 'N'
-                type_id = station['type_id'] if station['type_id'] else 0
-                
-                systemList = self.execute("SELECT System.name FROM System WHERE System.system_id = ?", (system_id,)).fetchone()
-                if systemList:
-                    system = systemList[0].upper()
-                else:
-                    system = "Unknown Space"
-                    self.execute("""INSERT INTO System
-                                ( system_id,name,pos_x,pos_y,pos_z,modified ) VALUES
-                                ( ?, ?, ?, ?, ?, ? ) """,
-                                (system_id, system, 0, 0, 0, modified))
+        self.execute("CREATE TEMPORARY TABLE IF NOT EXISTS VendorStation ( station_id INTEGER PRIMARY KEY, modified )")
+        self.execute("CREATE TEMPORARY TABLE IF NOT EXISTS VendorItem ( station_id INTEGER NOT NULL, item )")
+        
+        stations = self.parseFile(self.dataPath / self.stationsPath, parseStationLines)
+        with self.loadTable('Station'):
+            for batch in self.batches(stations, 10000):
+                # Stations in systems we don't have are put in placeholders.
+                added = self.executemany("""INSERT OR IGNORE INTO System
+                            ( system_id,name,pos_x,pos_y,pos_z,modified ) VALUES
+                            ( ?, 'Unknown Space', 0, 0, 0, ? )""",
+                            [(station[2], station[8]) for station, _, _ in batch]).rowcount
+                if added:
+                    tdenv.DEBUG0("{} systems added as 'Unknown Space'.", added)
                     self.updated['System'] = True
                 
-                result = self.execute("SELECT modified FROM Station WHERE station_id = ?", (station_id,)).fetchone()
-                if result:
-                    updated = timegm(datetime.datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S').timetuple())
-                    if station['updated_at'] > updated:
-                        tdenv.DEBUG0("{}/{} has been updated: {} vs {}",
-                                    system , name, modified, result[0])
-                        tdenv.DEBUG1("Updating: {}, {}, {}, {}, {}, {}, {},"
-                                              " {}, {}, {}, {}, {}, {}, {}, {}",
-                                    station_id, name, system_id, ls_from_star, blackmarket,
-                                    max_pad_size, market, shipyard, modified, outfitting,
-                                    rearm, refuel, repair, planetary, type_id)
-                        self.execute("""UPDATE Station
-                                    SET name = ?, system_id = ?, ls_from_star = ?, blackmarket = ?,
-                                    max_pad_size = ?, market = ?, shipyard = ?, modified = ?,
-                                    outfitting = ?, rearm = ?, refuel = ?, repair = ?, planetary = ?, type_id = ?
-                                    WHERE station_id = ?""",
-                                    (name, system_id, ls_from_star, blackmarket,
-                                     max_pad_size, market, shipyard, modified,
-                                     outfitting, rearm, refuel, repair, planetary, type_id,
-                                     station_id))
-                        self.updated['Station'] = True
-                else:
-                    tdenv.DEBUG0("{}/{} has been added:", system , name)
-                    tdenv.DEBUG1("Inserting: {}, {}, {}, {}, {}, {}, {},"
-                                              " {}, {}, {}, {}, {}, {}, {}, {}",
-                        station_id, name, system_id, ls_from_star, blackmarket,
-                        max_pad_size, market, shipyard, modified, outfitting,
-                        rearm, refuel, repair, planetary, type_id)
-                    self.execute("""INSERT INTO Station (
-                                station_id,name,system_id,ls_from_star,
-                                blackmarket,max_pad_size,market,shipyard,
-                                modified,outfitting,rearm,refuel,
-                                repair,planetary,type_id ) VALUES
-                                ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? ) """,
-                                (station_id, name, system_id, ls_from_star,
-                                 blackmarket, max_pad_size, market, shipyard,
-                                 modified, outfitting, rearm, refuel,
-                                 repair, planetary, type_id))
+                stationRows = [station for station, _, _ in batch]
+                changed = self.executemany("""INSERT OR IGNORE INTO Station (
+                            station_id,name,system_id,ls_from_star,
+                            blackmarket,max_pad_size,market,shipyard,
+                            modified,outfitting,rearm,refuel,
+                            repair,planetary,type_id ) VALUES
+                            ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )""",
+                            stationRows).rowcount
+                changed += self.executemany("""UPDATE Station
+                            SET name = ?, system_id = ?, ls_from_star = ?,
+                                blackmarket = ?, max_pad_size = ?, market = ?, shipyard = ?,
+                                modified = ?, outfitting = ?, rearm = ?, refuel = ?,
+                                repair = ?, planetary = ?, type_id = ?
+                            WHERE station_id = ? AND modified < ?""",
+                            [station[1:] + (station[0], station[8])
+                             for station in stationRows]).rowcount
+                tdenv.DEBUG0("{} of {} stations added or updated.", changed, len(batch))
+                if changed:
                     self.updated['Station'] = True
                 
                 # Import shipyards into ShipVendors if shipvend is set.
-                if station['has_shipyard'] and self.getOption('shipvend'):
-                    if not station['shipyard_updated_at']:
-                        station['shipyard_updated_at'] = station['updated_at']
-                    modified = datetime.datetime.utcfromtimestamp(station['shipyard_updated_at']).strftime('%Y-%m-%d %H:%M:%S')
-                    result = self.execute("SELECT modified FROM ShipVendor WHERE station_id = ?", (station_id,)).fetchone()
-                    if result:
-                        updated = timegm(datetime.datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S').timetuple())
-                    else:
-                        updated = 0
-                    if station['shipyard_updated_at'] > updated:
-                        self.execute("DELETE FROM ShipVendor WHERE station_id = ?", (station_id,))
-                        tdenv.DEBUG1("{}/{} has shipyard, updating ships sold.", system, name)
-                        for ship in station['selling_ships']:
-                            # Make sure all the 'Mark N' ship names abbreviate 'Mark' as '<Name> Mk. <Number>'.
-                            # Fix capitalization.
-                            ship = ship.replace('MK', 'Mk').replace('mk', 'Mk').replace('mK', 'Mk')
-                            # Fix no '.' in abbreviation.
-                            if "Mk" in ship and "Mk." not in ship:
-                                ship = ship.replace('Mk', 'Mk.')
-                            # Fix no trailing space.
-                            if "Mk." in ship and "Mk. " not in ship:
-                                ship = ship.replace("Mk.", "Mk. ")
-                            # Fix no leading space.
-                            if "Mk." in ship and " Mk." not in ship:
-                                ship = ship.replace("Mk.", " Mk.")
-                            
-                            tdenv.DEBUG2("ship_id:{},station_id:{},modified:{}",
-                                 ship,
-                                 station_id,
-                                 modified)
-                            try:
-                                self.execute("""INSERT INTO ShipVendor
-                                        ( ship_id,station_id,modified ) VALUES
-                                        ( (SELECT Ship.ship_id FROM Ship WHERE Ship.name = ?), ?, ? ) """,
-                                        (ship,
-                                         station_id,
-                                         modified))
-                            except sqlite3.IntegrityError:
-                                continue
-                        self.updated['ShipVendor'] = True
+                if shipvend:
+                    self.mergeVendors('ShipVendor', {
+                        station[0]: shipyard
+                        for station, shipyard, _ in batch if shipyard
+                    })
                 
                 # Import Outfitters into UpgradeVendors if upvend is set.
-                if station['has_outfitting'] and self.getOption('upvend'):
-                    if not station['outfitting_updated_at']:
-                        station['outfitting_updated_at'] = station['updated_at']
-                    modified = datetime.datetime.utcfromtimestamp(station['outfitting_updated_at']).strftime('%Y-%m-%d %H:%M:%S')
-                    result = self.execute("SELECT modified FROM UpgradeVendor WHERE station_id = ?", (station_id,)).fetchone()
-                    if result:
-                        updated = timegm(datetime.datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S').timetuple())
-                    else:
-                        updated = 0
-                    if station['outfitting_updated_at'] > updated:
-                        self.execute("DELETE FROM UpgradeVendor WHERE station_id = ?", (station_id,))
-                        tdenv.DEBUG1("{}/{} has outfitting, updating modules sold.", system, name)
-                        for upgrade in station['selling_modules']:
-                            tdenv.DEBUG2("upgrade_id:{},station_id:{},modified:{}",
-                                 upgrade,
-                                 station['id'],
-                                 modified)
-                            try:
-                                self.execute("""INSERT INTO UpgradeVendor
-                                        ( upgrade_id,station_id,cost,modified ) VALUES
-                                        ( ?, ?, (SELECT Upgrade.cost FROM Upgrade WHERE Upgrade.upgrade_id = ?), ? ) """,
-                                        (upgrade,
-                                         station_id,
-                                         upgrade,
-                                         modified))
-                            except sqlite3.IntegrityError:
-                                continue
-                        self.updated['UpgradeVendor'] = True
-            while prog.value < prog.maxValue:
-                prog.increment(1, postfix = lambda value, goal: " " + str(round(value / total * 100)) + "%")
-            prog.clear()
+                if upvend:
+                    self.mergeVendors('UpgradeVendor', {
+                        station[0]: outfitting
+                        for station, _, outfitting in batch if outfitting
+                    })
+        
+        self.execute("DROP TABLE IF EXISTS temp.VendorStation")
+        self.execute("DROP TABLE IF EXISTS temp.VendorItem")
         
         tdenv.NOTE("Finished processing Stations. End time = {}", self.now())
     
@@ -813,6 +896,11 @@ class ImportPlugin(plugins.ImportPluginBase):
         """
         Updates the market data (AKA the StationItem table) using listings.csv
         Writes directly to database.
+        
+        The listings are staged into a temporary table in large chunks,
+        then merged into StationItem with a few set-based statements:
+        a station's listings replace what the DB has for it only if the
+        first of them was collected after the DB's data for it.
         """
         tdb, tdenv = self.tdb, self.tdenv
         
@@ -821,116 +909,216 @@ class ImportPlugin(plugins.ImportPluginBase):
             tdenv.NOTE("File not found, aborting: {}", (self.dataPath / listings_file))
             return
         
-        total = 1
-        
         from_live = 0 if listings_file == self.listingsPath else 1
         
-        # Used to check if the listings file is using the fdev_id as a temporary
-        # item_id, but the item is in the DB with a permanent item_id.
-        fdev2item = dict()
-        result = self.execute("SELECT fdev_id,item_id FROM Item ORDER BY fdev_id").fetchall()
-        for item in result:
-            fdev2item[item[0]] = item[1]
+        self.execute("DROP TABLE IF EXISTS temp.ListingImport")
+        self.execute("""
+            CREATE TEMPORARY TABLE ListingImport (
+                station_id INTEGER NOT NULL,
+                item_id INTEGER NOT NULL,
+                collected_at INTEGER NOT NULL,
+                demand_price INTEGER NOT NULL,
+                demand_units INTEGER NOT NULL,
+                demand_level INTEGER NOT NULL,
+                supply_price INTEGER NOT NULL,
+                supply_units INTEGER NOT NULL,
+                supply_level INTEGER NOT NULL
+            )
+        """)
+        stageStmt = """
+            INSERT INTO temp.ListingImport (
+                station_id, item_id, collected_at,
+                demand_price, demand_units, demand_level,
+                supply_price, supply_units, supply_level
+            ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )
+        """
         
-        with open(str(self.dataPath / listings_file), "r", encoding = "utf-8", errors = 'ignore') as f:
-            total += (sum(bl.count("\n") for bl in self.blocks(f)))
+        def parser(columns):
+            columns = {name: pos for pos, name in enumerate(columns)}
+            return partial(parseListingLines, tuple(columns[name] for name in (
+                'station_id', 'commodity_id', 'collected_at',
+                'sell_price', 'demand', 'demand_bracket',
+                'buy_price', 'supply', 'supply_bracket',
+            )))
+        
+        listings = self.parseFile(self.dataPath / listings_file, parser, header = True)
+        for batch in self.batches(listings):
+            self.executemany(stageStmt, batch)
+        
+        tdenv.NOTE("Import file processing complete, updating database. {}", self.now())
+        
+        # For each known station: when its first listing was collected
+        # and when the DB's data for it was, as the old row-by-row
+        # import compared them.
+        self.execute("DROP TABLE IF EXISTS temp.ListingStation")
+        self.execute("""
+            CREATE TEMPORARY TABLE ListingStation AS
+            SELECT  li.station_id,
+                    li.collected_at,
+                    (
+                        SELECT  CAST(STRFTIME('%s', si.modified) AS INTEGER)
+                          FROM  StationItem AS si
+                         WHERE  si.station_id = li.station_id
+                         LIMIT  1
+                    ) AS updated
+              FROM  temp.ListingImport AS li
+                    INNER JOIN (
+                        SELECT  MIN(rowid) AS first_row
+                          FROM  temp.ListingImport
+                         GROUP  BY station_id
+                    ) AS fr ON (li.rowid = fr.first_row)
+             WHERE  li.station_id IN (SELECT station_id FROM Station)
+        """)
+        self.execute("""
+            CREATE INDEX temp.idx_listing_station
+                ON ListingStation (station_id)
+        """)
+        
+        if not from_live:
+            # When the listings.csv data matches the database, update to make from_live == 0.
+            tdenv.NOTE("Marking data now in the EDDB listings.csv as no longer 'live'. {}", self.now())
+            self.execute("""
+                UPDATE  StationItem
+                   SET  from_live = 0
+                 WHERE  station_id IN (
+                            SELECT  station_id
+                              FROM  temp.ListingStation
+                             WHERE  collected_at = updated
+                        )
+            """)
+        
+        # Unless the import file data is newer, nothing else needs to be
+        # done for a station.
+        self.execute("""
+            DELETE FROM temp.ListingStation
+             WHERE updated IS NOT NULL AND collected_at <= updated
+        """)
+        stationIDs = [
+            stationID
+            for (stationID,) in self.execute("SELECT station_id FROM temp.ListingStation")
+        ]
+        
+        tdenv.NOTE("Deleting old listing data. {}", self.now())
+        self.execute("""
+            DELETE FROM StationItem
+             WHERE station_id IN (
+                    SELECT  station_id
+                      FROM  temp.ListingStation
+                     WHERE  updated IS NOT NULL
+                   )
+        """)
+        
+        # listings.csv includes rare items, which we are ignoring.
+        tdenv.NOTE("Inserting new listing data. {}", self.now())
+        self.execute("""
+            INSERT OR IGNORE INTO StationItem (
+                    station_id, item_id, modified,
+                    demand_price, demand_units, demand_level,
+                    supply_price, supply_units, supply_level, from_live
+            )
+            SELECT  li.station_id, li.item_id,
+                    DATETIME(li.collected_at, 'unixepoch'),
+                    li.demand_price, li.demand_units, li.demand_level,
+                    li.supply_price, li.supply_units, li.supply_level, ?
+              FROM  temp.ListingImport AS li
+             WHERE  li.station_id IN (SELECT station_id FROM temp.ListingStation)
+               AND  li.item_id IN (SELECT item_id FROM Item)
+             ORDER  BY li.rowid
+        """, [from_live])
+        
+        if stationIDs:
+            tdenv.DEBUG0("Updating station market summaries. {}", self.now())
+            cache.updateStationMarketSummary(tdb.getDB(), stationIDs)
+            # Listings usually cover most of the market, so
+            # refresh every item rather than working out which.
+            tdenv.DEBUG0("Updating item price stats. {}", self.now())
+            cache.updateItemPriceStats(tdb.getDB())
+        
+        self.execute("DROP TABLE temp.ListingStation")
+        self.execute("DROP TABLE temp.ListingImport")
         
-        liveList = []
-        liveStmt = """UPDATE StationItem
-                    SET from_live = 0
-                    WHERE station_id = ?"""
+        self.updated['Listings'] = True
+        tdenv.NOTE("Finished processing market data. End time = {}", self.now())
+    
+    def downloadFiles(self):
+        """
+        Downloads the dump files for the selected options, returning
+        the paths of the ones to import: those that are new, or all of
+        them with 'force'.
+        """
+        force = self.getOption("force")
+        downloads = (
+            ("upgrade", UPGRADES, self.upgradesPath),
+            ("ship", SHIPS_URL, self.shipsPath),
+            ("systemfull", SYS_FULL, self.sysFullPath),
+            ("systemrec", SYS_RECENT, self.sysRecentPath),
+            ("system", SYS_POP, self.sysPopPath),
+            ("station", STATIONS, self.stationsPath),
+            ("item", COMMODITIES, self.commoditiesPath),
+            ("listings", LISTINGS, self.listingsPath),
+        )
+        downloaded = set()
+        for option, urlTail, path in downloads:
+            if self.getOption(option):
+                if self.downloadFile(urlTail, path) or force:
+                    downloaded.add(path)
+        
+        if self.getOption("listings") and not self.getOption("fallback"):
+            if self.downloadFile(LIVE_LISTINGS, self.liveListingsPath) or force:
+                downloaded.add(self.liveListingsPath)
+        
+        return downloaded
+    
+    def updateTables(self, downloaded):
+        """
+        Imports the dump files downloadFiles() returned into the tables.
+        """
+        tdb, tdenv = self.tdb, self.tdenv
         
-        delList = []
-        delStmt = "DELETE from StationItem WHERE station_id = ?"
+        if self.upgradesPath in downloaded:
+            self.importUpgrades()
+            self.commit()
         
-        listingList = []
-        listingStmt = """INSERT OR IGNORE INTO StationItem
-                        (station_id, item_id, modified,
-                         demand_price, demand_units, demand_level,
-                         supply_price, supply_units, supply_level, from_live)
-                        VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )"""
+        if self.shipsPath in downloaded:
+            self.importShips()
+            self.commit()
         
-        items = []
-        it_result = self.execute("SELECT item_id FROM Item ORDER BY item_id").fetchall()
-        for item in it_result:
-            items.append(item[0])
+        if self.sysFullPath in downloaded:
+            self.importAllSystems(self.sysFullPath)
+            self.commit()
         
-        stationList = {
-            stationID
-            for (stationID,) in self.execute("SELECT station_id FROM Station")
-        }
+        if self.sysRecentPath in downloaded:
+            self.importAllSystems(self.sysRecentPath)
+            self.commit()
         
-        with open(str(self.dataPath / listings_file), "rU") as fh:
-            prog = pbar.Progress(total, 50)
-            listings = csv.DictReader(fh)
-            
-            cur_station = -1
-            
-            for listing in listings:
-                prog.increment(1, postfix = lambda value, goal: " " + str(round(value / total * 100)) + "%")
-                
-                station_id = int(listing['station_id'])
-                if station_id not in stationList:
-                    continue
-                
-                if station_id != cur_station:
-                    cur_station = station_id
-                    skipStation = False
-                    
-                    # Check if listing already exists in DB and needs updated.
-                    # Only need to check the date for the first item at a specific station.
-                    result = self.execute("SELECT modified FROM StationItem WHERE station_id = ?", (station_id,)).fetchone()
-                    if result:
-                        updated = timegm(datetime.datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S').timetuple())
-                        # When the listings.csv data matches the database, update to make from_live == 0.
-                        if int(listing['collected_at']) == updated and not from_live:
-                            liveList.append((cur_station,))
-                        # Unless the import file data is newer, nothing else needs to be done for this station,
-                        # so the rest of the listings for this station can be skipped.
-                        if int(listing['collected_at']) <= updated:
-                            skipStation = True
-                            continue
-                        
-                        # The data from the import file is newer, so we need to delete the old data for this station.
-                        delList.append((cur_station,))
-                
-                if skipStation:
-                    continue
-                
-                # Since this station is not being skipped, get the data and prepare for insertion into the DB.
-                item_id = int(listing['commodity_id'])
-                # listings.csv includes rare items, which we are ignoring.
-                if item_id not in items:
-                    continue
-                modified = datetime.datetime.utcfromtimestamp(int(listing['collected_at'])).strftime('%Y-%m-%d %H:%M:%S')
-                demand_price = int(listing['sell_price'])
-                demand_units = int(listing['demand'])
-                demand_level = int(listing['demand_bracket']) if listing['demand_bracket'] != '' else -1
-                supply_price = int(listing['buy_price'])
-                supply_units = int(listing['supply'])
-                supply_level = int(listing['supply_bracket']) if listing['supply_bracket'] != '' else -1
-                
-                listingList.append((station_id, item_id, modified,
-                                    demand_price, demand_units, demand_level,
-                                    supply_price, supply_units, supply_level, from_live))
-            
-            while prog.value < prog.maxValue:
-                prog.increment(1, postfix = lambda value, goal: " " + str(round(value / total * 100)) + "%")
-            prog.clear()
-            
-            tdenv.NOTE("Import file processing complete, updating database. {}", self.now())
-            if liveList:
-                tdenv.NOTE("Marking data now in the EDDB listings.csv as no longer 'live'. {}", self.now())
-                self.executemany(liveStmt, liveList)
-            if delList:
-                tdenv.NOTE("Deleting old listing data. {}", self.now())
-                self.executemany(delStmt, delList)
-            if listingList:
-                tdenv.NOTE("Inserting new listing data. {}", self.now())
-                self.executemany(listingStmt, listingList)
+        if self.sysPopPath in downloaded:
+            self.importSystems()
+            self.commit()
         
-        self.updated['Listings'] = True
-        tdenv.NOTE("Finished processing market data. End time = {}", self.now())
+        if self.stationsPath in downloaded:
+            self.importStations()
+            self.commit()
+        
+        if self.getOption("purge"):
+                self.purgeSystems()
+                self.commit()
+        
+        if self.commoditiesPath in downloaded:
+            self.importCommodities()
+            self.commit()
+        
+        # Remake the .csv files with the updated info.
+        self.regenerate()
+        
+        # (Re)make the RareItem table.
+        cache.processImportFile(tdenv, tdb.getDB(), tdb.dataPath / Path('RareItem.csv'), 'RareItem')
+        
+        if self.listingsPath in downloaded:
+            self.importListings(self.listingsPath)
+        if self.liveListingsPath in downloaded:
+            self.importListings(self.liveListingsPath)
+        
+        self.commit()
     
     def run(self):
         tdb, tdenv = self.tdb, self.tdenv
@@ -949,14 +1137,17 @@ class ImportPlugin(plugins.ImportPluginBase):
         # have been passed, enable 'listings'.
         default = True
         for option in self.options:
-            if not option in ('force', 'fallback', 'skipvend', 'progbar'):
+            if not option in ('force', 'fallback', 'skipvend', 'progbar', 'workers'):
                 default = False
         if default:
             self.options["listings"] = True
         
         # We can probably safely assume that the plugin has never been run if
-        # the prices file doesn't exist, since the plugin always generates it.
-        if not (tdb.dataPath / Path("TradeDangerous.prices")).exists():
+        # there are no prices, neither in the prices file nor in the DB waiting
+        # to be written to it, since the plugin always imports them.
+        pricesStamp = cache.getFileStamp(tdb.getDB(), tdb.pricesPath)
+        pricesWaiting = pricesStamp is not None and pricesStamp[1]
+        if not pricesWaiting and not tdb.pricesPath.exists():
             self.options["clean"] = True
         
         if self.getOption("clean"):
@@ -983,7 +1174,7 @@ class ImportPlugin(plugins.ImportPluginBase):
             except FileNotFoundError:
                 pass
             try:
-                os.remove(str(tdb.dataPath) + "/TradeDangerous.prices")
+                os.remove(str(tdb.pricesPath))
             except FileNotFoundError:
                 pass
             
@@ -1058,66 +1249,22 @@ class ImportPlugin(plugins.ImportPluginBase):
             self.options["shipvend"] = False
             self.options["upvend"] = False
         
-        # Download required files and update tables.
-        if self.getOption("upgrade"):
-            if self.downloadFile(UPGRADES, self.upgradesPath) or self.getOption("force"):
-                self.importUpgrades()
-                self.commit()
-        
-        if self.getOption("ship"):
-            if self.downloadFile(SHIPS_URL, self.shipsPath) or self.getOption("force"):
-                self.importShips()
-                self.commit()
-        
-        if self.getOption("systemfull"):
-            if self.downloadFile(SYS_FULL, self.sysFullPath) or self.getOption("force"):
-                self.importAllSystems(self.sysFullPath)
-                self.commit()
-        
-        if self.getOption("systemrec"):
-            if self.downloadFile(SYS_RECENT, self.sysRecentPath) or self.getOption("force"):
-                self.importAllSystems(self.sysRecentPath)
-                self.commit()
-        
-        if self.getOption("system"):
-            if self.downloadFile(SYS_POP, self.sysPopPath) or self.getOption("force"):
-                self.importSystems()
-                self.commit()
-        
-        if self.getOption("station"):
-            if self.downloadFile(STATIONS, self.stationsPath) or self.getOption("force"):
-                self.importStations()
-                self.commit()
-        
-        if self.getOption("purge"):
-                self.purgeSystems()
-                self.commit()
-        
-        if self.getOption("item"):
-            if self.downloadFile(COMMODITIES, self.commoditiesPath) or self.getOption("force"):
-                self.importCommodities()
-                self.commit()
-        
-        # Remake the .csv files with the updated info.
-        self.regenerate()
-        
-        # (Re)make the RareItem table.
-        cache.processImportFile(tdenv, tdb.getDB(), tdb.dataPath / Path('RareItem.csv'), 'RareItem')
-        
-        if self.getOption("listings"):
-            if self.downloadFile(LISTINGS, self.listingsPath) or self.getOption("force"):
-                self.importListings(self.listingsPath)
-            if not self.getOption("fallback") and (self.downloadFile(LIVE_LISTINGS, self.liveListingsPath) or self.getOption("force")):
-                self.importListings(self.liveListingsPath)
+        # Download everything first, so that the DB isn't held
+        # exclusively by a bulk load while waiting on the network.
+        downloaded = self.downloadFiles()
+        if self.getOption("all"):
+            # Most of the DB gets rewritten, so load it in bulk.
+            with cache.bulkLoad(tdb.getDB(), ('System', 'Station', 'StationItem')):
+                self.updateTables(downloaded)
+        else:
+            self.updateTables(downloaded)
         
-        self.commit()
+        if self.updated['Listings']:
+            # The .prices file is regenerated when something needs it.
+            cache.markPricesStale(tdb)
         
         tdb.close()
         
-        if self.updated['Listings']:
-            tdenv.NOTE("Regenerating .prices file.")
-            cache.regeneratePricesFile(tdb, tdenv)
-        
         tdenv.NOTE("Import completed.")
         
         # TD doesn't need to do anything, tell it to just quit.
@@ -11,10 +11,14 @@
 
 from __future__ import absolute_import, with_statement, print_function, division, unicode_literals
 
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import sys
 import os
 import re
 import sqlite3
+import struct
 
 
 class Element(object):
@@ -25,6 +29,227 @@ class Element(object):
     blanks    = (1 <<31)
 
 
+class PriceFormatter(object):
+    """
+    Reads and formats the station blocks of a .prices file, a batch
+    of stations at a time. It is cheap to send to the worker processes
+    of dumpPrices(workers=N), each of which reads its batches through
+    its own connection to the DB.
+    """
+    
+    levelDesc = "?0LMH"
+    maxCrWidth = 7
+    levelWidth = 9
+    
+    def __init__(self, dbPath, items, itemOrder, withTimes, defaultZero, now,
+            getBlanks=False):
+        """
+        Arguments:
+            dbPath
+                The DB to read StationItem from
+            items
+                {item_id: (name, category_id, category name)}
+            itemOrder
+                [item_id] in the order they are listed
+            withTimes
+                Whether rows end in their timestamp
+            defaultZero
+                Write unknown demand/supply as n/a rather than unknown
+            now
+                Timestamp for rows without one
+            getBlanks
+                List every item, even those a station has no prices for
+        """
+        self.dbPath = str(dbPath)
+        self.itemOrder = itemOrder
+        self.getBlanks = getBlanks
+        self.conn = None
+        
+        longestNameLen = max(len(name) for name, _, _ in items.values())
+        self.outFmt = (
+            "      {{:<{width}}}"
+            " {{:>{crwidth}}}"
+            " {{:>{crwidth}}}"
+            "  {{:>{lvlwidth}}}"
+            " {{:>{lvlwidth}}}".format(
+                width=longestNameLen,
+                crwidth=self.maxCrWidth,
+                lvlwidth=self.levelWidth,
+            )
+        )
+        if withTimes:
+            self.outFmt += "  {}"
+        self.outFmt += "\n"
+        
+        # Everything up to the prices only depends on the item.
+        self.itemRank = { ID: rank for rank, ID in enumerate(itemOrder) }
+        self.itemCols = {
+            ID: "      " + name.ljust(longestNameLen)
+            for ID, (name, _, _) in items.items()
+        }
+        self.categories = {
+            ID: (catID, "   + {}\n".format(category))
+            for ID, (_, catID, category) in items.items()
+        }
+        self.rowFmt = "%s %{cr}s %{cr}s  %{lvl}s %{lvl}s".format(
+            cr=self.maxCrWidth, lvl=self.levelWidth,
+        ) + ("  %s\n" if withTimes else "\n")
+        self.withTimes = withTimes
+        self.defaultDemandVal = 0 if defaultZero else -1
+        self.defIQL = "?" if not defaultZero else "-"
+        self.now = now
+    
+    def __getstate__(self):
+        # Connections stay with the process that opened them.
+        state = dict(self.__dict__)
+        state['conn'] = None
+        return state
+    
+    def columnHeadings(self):
+        output = self.outFmt.format(
+            "Item Name",
+            "SellCr", "BuyCr",
+            "Demand", "Supply",
+            "Timestamp",
+        )
+        return '#' + output[1:]
+    
+    def stationRows(self, stations):
+        """
+        Generator of (stationLine, rows) for stations, a list of
+        (station_id, stationLine) in station_id order, with the rows
+        in item order as block() expects them.
+        """
+        if not self.conn:
+            self.conn = sqlite3.connect(self.dbPath)
+        
+        prices = {}
+        stmt = """
+            SELECT  station_id, item_id,
+                    demand_price, supply_price,
+                    demand_units, demand_level,
+                    supply_units, supply_level,
+                    modified
+              FROM  StationItem
+             WHERE  station_id BETWEEN ? AND ?
+             ORDER  BY station_id
+        """
+        for row in self.conn.execute(stmt, [stations[0][0], stations[-1][0]]):
+            try:
+                prices[row[0]].append(row[1:])
+            except KeyError:
+                prices[row[0]] = [ row[1:] ]
+        
+        itemRank = self.itemRank
+        if self.getBlanks:
+            blank = (0, 0) + (self.defaultDemandVal,) * 4 + (None,)
+        for stnID, stationLine in stations:
+            rows = prices.get(stnID, [])
+            if self.getBlanks:
+                have = { row[0]: row for row in rows }
+                rows = [
+                    have.get(ID) or (ID,) + blank for ID in self.itemOrder
+                ]
+            else:
+                rows = [ row for row in rows if row[0] in itemRank ]
+                rows.sort(key=lambda row: itemRank[row[0]])
+            yield stationLine, rows
+    
+    def block(self, stationLine, rows):
+        """
+        Returns the text for a station, given its "@ SYSTEM/Station"
+        line and its rows of
+            (item_id, demand_price, supply_price,
+             demand_units, demand_level, supply_units, supply_level,
+             modified)
+        in item order.
+        """
+        naIQL, unkIQL, defIQL = "-", "?", self.defIQL
+        levelDesc, now, withTimes = self.levelDesc, self.now, self.withTimes
+        itemCols, categories, rowFmt = self.itemCols, self.categories, self.rowFmt
+        
+        output = [ stationLine ]
+        lastCat = None
+        for (itemID, fromStn, toStn, demand, demandLevel, supply, supplyLevel, modified) in rows:
+            catID, catLine = categories[itemID]
+            if catID != lastCat:
+                output.append(catLine)
+                lastCat = catID
+            
+            # Is this item on sale?
+            if toStn > 0:
+                # Zero demand-price gets default demand, which will
+                # be either unknown or zero depending on -0.
+                # If there is a price, always default to unknown
+                # because it can be sold here but the demand is just
+                # not useful as data.
+                demandStr = defIQL if fromStn <= 0 else unkIQL
+                if supplyLevel == 0:
+                    supplyStr = naIQL
+                elif supplyLevel < 0 and supply <= 0:
+                    supplyStr = defIQL
+                else:
+                    units = "?" if supply < 0 else str(supply)
+                    level = levelDesc[supplyLevel + 1]
+                    supplyStr = units + level
+            else:
+                if fromStn == 0 or demandLevel == 0:
+                    demandStr = naIQL
+                elif demandLevel < 0 and demand <= 0:
+                    demandStr = defIQL
+                else:
+                    units = "?" if demand < 0 else str(demand)
+                    level = levelDesc[demandLevel + 1]
+                    demandStr = units + level
+                supplyStr = naIQL
+            if withTimes:
+                output.append(rowFmt % (
+                    itemCols[itemID],
+                    fromStn, toStn,
+                    demandStr, supplyStr,
+                    modified or now,
+                ))
+            else:
+                output.append(rowFmt % (
+                    itemCols[itemID],
+                    fromStn, toStn,
+                    demandStr, supplyStr,
+                ))
+        return "".join(output)
+    
+    def blocks(self, stations):
+        """ The text of the blocks for a batch of stationRows(). """
+        return "".join(
+            self.block(stationLine, rows)
+            for stationLine, rows in self.stationRows(stations)
+        )
+
+
+def priceBlocks(formatter, batches, workers=1):
+    """
+        Generator of the text of each batch of stations, in order,
+        formatted by a pool of 'workers' processes when there's more
+        than one, each with a batch queued behind it.
+    """
+    if workers <= 1:
+        for batch in batches:
+            yield formatter.blocks(batch)
+        return
+    
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            for batch in batches:
+                pending.append(pool.submit(formatter.blocks, batch))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 ######################################################################
 # Main
 
@@ -34,11 +259,17 @@ def dumpPrices(
             stationID=None,     # limits to one station
             file=None,          # file handle to write to
             defaultZero=False,
-            debug=0
+            debug=0,
+            since=None,         # limits to stations with newer prices
+            workers=1,          # processes formatting stations, None for all CPUs
+            batchSize=1000,     # stations formatted at a time
+            bufferSize=1 << 20, # characters written at a time
     ):
     """
         Generate a prices list using data from the DB.
         If stationID is not none, only the specified station is dumped.
+        If since is not none, only stations with prices modified after
+        it are dumped.
         If file is not none, outputs to the given file handle.
     """
     
@@ -61,10 +292,14 @@ def dumpPrices(
         for (ID, name, catID)
         in cur.execute("SELECT item_id, name, category_id FROM Item")
     }
-    
-    # find longest item name
-    longestName = max(items.values(), key=lambda ent: len(ent[0]))
-    longestNameLen = len(longestName[0])
+    itemOrder = [
+        ID for (ID,) in cur.execute("""
+            SELECT  itm.item_id
+              FROM  Category AS cat
+                    INNER JOIN Item AS itm USING (category_id)
+             ORDER  BY cat.name, itm.ui_order
+        """)
+    ]
     
     if stationID:
         # check if there are prices for the station
@@ -76,49 +311,29 @@ def dumpPrices(
         if not cur.fetchone()[0]:
             getBlanks = True
     
-    defaultDemandVal = 0 if defaultZero else -1
+    # The stations to list: every one when listing blanks, otherwise
+    # those with prices.
     if stationID:
-        stationWhere = "WHERE stn.station_id = {}".format(stationID)
-    else:
-        stationWhere = ""
-    
-    if getBlanks:
-        itemJoin = "LEFT OUTER"
+        stmt, binds = "SELECT station_id FROM Station WHERE station_id = ?", [stationID]
+    elif getBlanks:
+        stmt, binds = "SELECT station_id FROM Station", []
     else:
-        itemJoin = "INNER"
+        stmt, binds = "SELECT DISTINCT station_id FROM StationItem", []
+    if since:
+        stmt += """
+            {} station_id IN (
+                SELECT station_id FROM StationItem WHERE modified > ?
+            )
+        """.format("AND" if binds else "WHERE")
+        binds.append(since)
+    stmt += " ORDER BY station_id"
+    if debug:
+        print(stmt)
+    stationIDs = [ ID for (ID,) in cur.execute(stmt, binds) ]
     
     cur.execute("SELECT CURRENT_TIMESTAMP")
     now = cur.fetchone()[0]
-    
-    stmt = """
-        SELECT  stn.station_id, itm.item_id
-                , IFNULL(si.demand_price, 0)
-                , IFNULL(si.supply_price, 0)
-                , IFNULL(si.demand_units, {defDemand})
-                , IFNULL(si.demand_level, {defDemand})
-                , IFNULL(si.supply_units, {defDemand})
-                , IFNULL(si.supply_level, {defDemand})
-                , si.modified
-          FROM  Station stn,
-                Category AS cat
-                INNER JOIN Item AS itm USING (category_id)
-                {itemJoin} JOIN StationItem AS si
-                    ON (si.station_id = stn.station_id
-                        AND si.item_id = itm.item_id)
-                {stationWhere}
-         ORDER  BY stn.station_id, cat.name, itm.ui_order
-    """
-    
-    sql = stmt.format(
-        stationWhere=stationWhere,
-        defDemand=defaultDemandVal,
-        itemJoin=itemJoin,
-    )
-    if debug:
-        print(sql)
-    cur.execute(sql)
-    
-    lastSys, lastStn, lastCat = None, None, None
+    conn.close()
     
     if not file: file = sys.stdout
     
@@ -146,85 +361,160 @@ def dumpPrices(
             stationSet
     ))
     
-    levelDesc = "?0LMH"
-    maxCrWidth = 7
-    levelWidth = 9
-    
-    outFmt = (
-        "      {{:<{width}}}"
-        " {{:>{crwidth}}}"
-        " {{:>{crwidth}}}"
-        "  {{:>{lvlwidth}}}"
-        " {{:>{lvlwidth}}}".format(
-            width=longestNameLen,
-            crwidth=maxCrWidth,
-            lvlwidth=levelWidth,
-        )
+    formatter = PriceFormatter(
+        dbPath, items, itemOrder, withTimes, defaultZero, now,
+        getBlanks=getBlanks,
     )
-    if withTimes:
-        outFmt += "  {}"
-    outFmt += "\n"
-    output = outFmt.format(
-        "Item Name",
-        "SellCr", "BuyCr",
-        "Demand", "Supply",
-        "Timestamp",
-    )
-    file.write('#' + output[1:])
-    
-    naIQL = "-"
-    unkIQL = "?"
-    defIQL = "?" if not defaultZero else "-"
-    
-    output = ""
-    for (stnID, itemID, fromStn, toStn, demand, demandLevel, supply, supplyLevel, modified) in cur:
-        modified = modified or now
-        station, system = stations[stnID]
-        item, catID, category = items[itemID]
-        if stnID != lastStn:
-            file.write(output)
-            output = "\n\n@ {}/{}\n".format(system.upper(), station)
-            lastStn = stnID
-            lastCat = None
-        
-        if catID is not lastCat:
-            output += "   + {}\n".format(category)
-            lastCat = catID
-        
-        # Is this item on sale?
-        if toStn > 0:
-            # Zero demand-price gets default demand, which will
-            # be either unknown or zero depending on -0.
-            # If there is a price, always default to unknown
-            # because it can be sold here but the demand is just
-            # not useful as data.
-            demandStr = defIQL if fromStn <= 0 else unkIQL
-            if supplyLevel == 0:
-                supplyStr = naIQL
-            elif supplyLevel < 0 and supply <= 0:
-                supplyStr = defIQL
-            else:
-                units = "?" if supply < 0 else str(supply)
-                level = levelDesc[supplyLevel + 1]
-                supplyStr = units + level
-        else:
-            if fromStn == 0 or demandLevel == 0:
-                demandStr = naIQL
-            elif demandLevel < 0 and demand <= 0:
-                demandStr = defIQL
-            else:
-                units = "?" if demand < 0 else str(demand)
-                level = levelDesc[demandLevel + 1]
-                demandStr = units + level
-            supplyStr = naIQL
-        output += outFmt.format(
-                    item,
-                    fromStn, toStn,
-                    demandStr, supplyStr,
-                    modified
-                )
+    file.write(formatter.columnHeadings())
+    
+    batches = []
+    for first in range(0, len(stationIDs), batchSize):
+        batches.append([
+            (ID, "\n\n@ {}/{}\n".format(stations[ID][1].upper(), stations[ID][0]))
+            for ID in stationIDs[first:first + batchSize]
+        ])
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(batches))
+    
+    # Collect the blocks into large writes.
+    output, outputLen = [], 0
+    for text in priceBlocks(formatter, batches, workers):
+        output.append(text)
+        outputLen += len(text)
+        if outputLen >= bufferSize:
+            file.write("".join(output))
+            output, outputLen = [], 0
+    file.write("".join(output))
+
+
+######################################################################
+# Binary prices
+#
+# A compact alternative to the .prices text, for loading large amounts
+# of prices without parsing text: StationItem rows keyed by station_id
+# and item_id, with modified as unix epoch seconds. The file is a
+# header, binaryMagic and the format version, followed by blocks of
+# rows; each block is its number of rows followed by the values of
+# each of binaryColumns in turn, as little-endian arrays.
+
+binaryMagic = b"TDPRICES"
+binaryVersion = 1
+binarySuffix = ".tdprices"
+
+# (column, bytes per value)
+binaryColumns = (
+    ('station_id', 8),
+    ('item_id', 8),
+    ('demand_price', 4),
+    ('demand_units', 4),
+    ('demand_level', 1),
+    ('supply_price', 4),
+    ('supply_units', 4),
+    ('supply_level', 1),
+    ('modified', 8),
+)
+
+binaryHeader = struct.Struct("<8sI")
+binaryBlockHeader = struct.Struct("<I")
+
+# array typecodes by their size, preferring the smallest type
+binaryTypecodes = { array(code).itemsize: code for code in "qlihb" }
+
+
+def isBinaryPrices(path):
+    """ True if the file at 'path' is a binary prices file. """
+    with open(str(path), "rb") as fh:
+        return fh.read(len(binaryMagic)) == binaryMagic
+
+
+def dumpPricesBinary(
+            dbPath,             # Path() or str
+            file,               # binary file handle to write to
+            stationID=None,     # limits to one station
+            since=None,         # limits to stations with newer prices
+            blockSize=1 << 16,  # rows per block
+    ):
+    """
+        Writes the prices in the DB as a binary prices file.
+    """
     
-    file.write(output)
+    conn = sqlite3.connect(str(dbPath))
+    where, binds = [], []
+    if stationID:
+        where.append("station_id = ?")
+        binds.append(stationID)
+    if since:
+        where.append("""
+            station_id IN (
+                SELECT station_id FROM StationItem WHERE modified > ?
+            )
+        """)
+        binds.append(since)
+    stmt = """
+        SELECT  station_id, item_id,
+                demand_price, demand_units, demand_level,
+                supply_price, supply_units, supply_level,
+                CAST(strftime('%s', modified) AS INTEGER)
+          FROM  StationItem
+                {where}
+         ORDER  BY station_id
+    """.format(where="WHERE " + " AND ".join(where) if where else "")
+    cur = conn.execute(stmt, binds)
+    
+    file.write(binaryHeader.pack(binaryMagic, binaryVersion))
+    while True:
+        rows = cur.fetchmany(blockSize)
+        if not rows:
+            break
+        file.write(binaryBlockHeader.pack(len(rows)))
+        for (_, size), values in zip(binaryColumns, zip(*rows)):
+            values = array(binaryTypecodes[size], values)
+            if sys.byteorder != "little":
+                values.byteswap()
+            file.write(values.tobytes())
+    conn.close()
+
+
+def readPricesBinary(file):
+    """
+        Generator of the rows of a binary prices file, as tuples of
+        the values of binaryColumns.
+    """
+    
+    def readHeader(header):
+        data = file.read(header.size)
+        if len(data) < header.size:
+            if not data and header is binaryBlockHeader:
+                return None
+            raise EOFError("{} is truncated".format(file.name))
+        return header.unpack(data)
+    
+    magic, version = readHeader(binaryHeader)
+    if magic != binaryMagic:
+        raise ValueError("{} is not a binary prices file".format(file.name))
+    if version != binaryVersion:
+        raise ValueError("{}: unsupported binary prices version {}".format(
+            file.name, version
+        ))
+    
+    while True:
+        header = readHeader(binaryBlockHeader)
+        if header is None:
+            break
+        numRows, = header
+        columns = []
+        for _, size in binaryColumns:
+            values = array(binaryTypecodes[size])
+            try:
+                values.fromfile(file, numRows)
+            except EOFError:
+                raise EOFError("{} is truncated".format(file.name)) from None
+            if sys.byteorder != "little":
+                values.byteswap()
+            columns.append(values)
+        yield from zip(*columns)
+
 
 if __name__ == "__main__":
     import tradedb
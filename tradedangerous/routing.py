@@ -0,0 +1,602 @@
+# --------------------------------------------------------------------
+# Copyright (C) Oliver 'kfsone' Smith 2014 <oliver@kfs.org>:
+# Copyright (C) Bernd 'Gazelle' Gollesch 2016, 2017
+# Copyright (C) Jonathan 'eyeonus' Jones 2018, 2019
+#
+# You are free to use, redistribute, or even print and eat a copy of
+# this software so long as you include this copyright notice.
+# I guarantee there is at least one bug neither of us knew about.
+# --------------------------------------------------------------------
+# TradeDangerous :: Modules :: Routing
+#
+"""
+Route finding between Systems for TradeDB.getRoute.
+
+Searches run over a JumpGraph, the adjacency of each System to the
+Systems within one jump of it. The graph is shared by every search
+with the same jump range, so each System's neighbours are only
+looked up once.
+
+A JumpGraph can be backed by a CompactJumpGraph, a compressed sparse
+row adjacency of every System built for a range rounded up to a
+multiple of jumpBucketLy, so that e.g. 24.73ly and 25ly share one
+graph that is filtered down when it is read. TradeDB can keep these
+in the DB for later runs (see --persist-jumps).
+
+A compact graph can also carry Landmarks, the distances and jump
+counts from a few landmark Systems to every other, which give
+searches a much tighter lower bound than the straight-line distance
+where routes have to detour (see --landmarks).
+
+A route is either the shortest in light years or, with fewestJumps,
+the one with the fewest jumps (ties broken on light years). In both
+cases the straight-line distance to the target, scaled to the cost
+of covering it, is an admissible and consistent A* heuristic.
+
+findRoute searches from both ends at once; findRouteWithStops is a
+single-direction search used when stations are required at regular
+intervals, which depends on the direction of travel. findRoutesFrom
+grows one shortest-path tree from an origin until it reaches every
+one of many destinations, for batches of routes (TradeDB.getRoutes).
+"""
+
+from array import array
+import heapq
+import math
+
+__all__ = [
+    'JumpGraph', 'CompactJumpGraph', 'Landmarks', 'bucketLy',
+    'findRoute', 'findRouteWithStops', 'findRoutesFrom',
+]
+
+# With fewestJumps, the cost of a jump is 1 plus this much per jump
+# range covered, which is never enough to outweigh an extra jump.
+jumpTieBreak = 1e-6
+
+# Compact graphs are built for jump ranges rounded up to a multiple
+# of this, so that similar ranges can share one.
+jumpBucketLy = 5.
+
+
+def bucketLy(maxLy):
+    """ Returns the range of the compact graph that serves maxLy. """
+    return math.ceil(maxLy / jumpBucketLy) * jumpBucketLy
+
+
+class CompactJumpGraph(object):
+    """
+    Compressed sparse row adjacency of a fixed list of Systems: the
+    neighbours of systems[i] are targets[offsets[i]:offsets[i+1]],
+    positions in systems, at the float32 distances in the same slice
+    of distances, nearest first.
+    """
+    
+    def __init__(self, bucketLy, systems, offsets, targets, distances):
+        self.bucketLy = bucketLy
+        self.systems = systems
+        self.slots = {system: slot for slot, system in enumerate(systems)}
+        self.offsets = offsets
+        self.targets = targets
+        self.distances = distances
+    
+    def __len__(self):
+        return len(self.targets)
+    
+    @classmethod
+    def build(cls, systems, bucketLy, systemsInRange):
+        """
+        Builds the graph of 'systems' within bucketLy of each other;
+        systemsInRange(system, ly) is TradeDB.genSystemsInRange.
+        """
+        systems = sorted(systems, key=lambda system: system.ID)
+        slots = {system: slot for slot, system in enumerate(systems)}
+        offsets, targets, distances = array('q', [0]), array('i'), array('f')
+        for system in systems:
+            for nSys, nDist in systemsInRange(system, bucketLy):
+                targets.append(slots[nSys])
+                distances.append(nDist)
+            offsets.append(len(targets))
+        return cls(bucketLy, systems, offsets, targets, distances)
+    
+    @classmethod
+    def fromBlobs(
+            cls, bucketLy, systemByID,
+            idBlob, offsetBlob, targetBlob, distanceBlob,
+            ):
+        """
+        Rebuilds a graph saved with toBlobs(), or returns None if it
+        doesn't match the Systems in systemByID.
+        """
+        systemIDs = array('q')
+        systemIDs.frombytes(idBlob)
+        if len(systemIDs) != len(systemByID):
+            return None
+        try:
+            systems = [systemByID[ID] for ID in systemIDs]
+        except KeyError:
+            return None
+        offsets, targets, distances = array('q'), array('i'), array('f')
+        offsets.frombytes(offsetBlob)
+        targets.frombytes(targetBlob)
+        distances.frombytes(distanceBlob)
+        if len(offsets) != len(systems) + 1 or \
+                len(targets) != len(distances) or \
+                offsets[-1] != len(targets):
+            return None
+        return cls(bucketLy, systems, offsets, targets, distances)
+    
+    def toBlobs(self):
+        """ Returns (systemIDs, offsets, targets, distances) as bytes. """
+        return (
+            array('q', (system.ID for system in self.systems)).tobytes(),
+            self.offsets.tobytes(),
+            self.targets.tobytes(),
+            self.distances.tobytes(),
+        )
+    
+    def neighbours(self, system, maxLy):
+        """
+        Returns the list of (neighbour, distLy) within maxLy of system,
+        nearest first, or None if system isn't in the graph.
+        """
+        slot = self.slots.get(system)
+        if slot is None:
+            return None
+        # Allow for float32 rounding, then check exactly.
+        limit = maxLy * 1.000001
+        lySq = maxLy ** 2
+        sysX, sysY, sysZ = system.posX, system.posY, system.posZ
+        systems, targets, distances = self.systems, self.targets, self.distances
+        neighbours = []
+        for edge in range(self.offsets[slot], self.offsets[slot + 1]):
+            if distances[edge] > limit:
+                break
+            nSys = systems[targets[edge]]
+            distSq = (
+                (nSys.posX - sysX) ** 2 +
+                (nSys.posY - sysY) ** 2 +
+                (nSys.posZ - sysZ) ** 2
+            )
+            if distSq <= lySq:
+                neighbours.append((nSys, distSq ** 0.5))
+        return neighbours
+
+
+class Landmarks(object):
+    """
+    ALT (A*, Landmarks, Triangle inequality) lower bounds: for every
+    System of a CompactJumpGraph, the route distance and the number
+    of jumps from each of a few landmark Systems.
+    
+    No route from 'here' to 'there' is shorter than
+    |d(L, there) - d(L, here)| for any landmark L. The compact graph
+    has every link of the narrower ranges filtered from it, so the
+    bounds hold for those as well.
+    """
+    
+    # The distances are summed from float32 links, allow for that.
+    roundingSlack = 1e-7
+    
+    def __init__(self, compact, landmarkSlots, distances, jumps):
+        self.compact = compact
+        self.landmarkSlots = landmarkSlots
+        self.distances = distances
+        self.jumps = jumps
+    
+    def __len__(self):
+        return len(self.landmarkSlots)
+    
+    @property
+    def systems(self):
+        """ The landmark Systems. """
+        systems = self.compact.systems
+        return [systems[slot] for slot in self.landmarkSlots]
+    
+    @classmethod
+    def build(cls, compact, count):
+        """ Picks 'count' landmarks and measures the graph from them. """
+        landmarkSlots = cls.pickLandmarks(compact, count)
+        distances, jumps = [], []
+        for slot in landmarkSlots:
+            distances.append(cls._routeDistances(compact, slot))
+            jumps.append(cls._jumpCounts(compact, slot))
+        return cls(compact, landmarkSlots, distances, jumps)
+    
+    @classmethod
+    def fromRows(cls, compact, rows):
+        """
+        Rebuilds Landmarks saved with toRows(), or returns None if
+        they don't fit the compact graph.
+        """
+        numSystems = len(compact.systems)
+        slotByID = {
+            system.ID: slot for slot, system in enumerate(compact.systems)
+        }
+        landmarkSlots, distances, jumps = [], [], []
+        for landmarkID, distanceBlob, jumpBlob in rows:
+            slot = slotByID.get(landmarkID)
+            landmarkDistances, landmarkJumps = array('d'), array('i')
+            landmarkDistances.frombytes(distanceBlob)
+            landmarkJumps.frombytes(jumpBlob)
+            if slot is None or \
+                    len(landmarkDistances) != numSystems or \
+                    len(landmarkJumps) != numSystems:
+                return None
+            landmarkSlots.append(slot)
+            distances.append(landmarkDistances)
+            jumps.append(landmarkJumps)
+        return cls(compact, landmarkSlots, distances, jumps)
+    
+    def toRows(self):
+        """ Returns (landmarkID, distances, jumps) rows as bytes. """
+        return [
+            (system.ID, distances.tobytes(), jumps.tobytes())
+            for system, distances, jumps in zip(
+                self.systems, self.distances, self.jumps
+            )
+        ]
+    
+    @staticmethod
+    def pickLandmarks(compact, count):
+        """
+        Spreads the landmarks out: each is the linked System furthest
+        from the landmarks picked so far, starting with the one
+        furthest from the middle of the graph.
+        """
+        offsets, systems = compact.offsets, compact.systems
+        linked = [
+            slot for slot in range(len(systems))
+            if offsets[slot + 1] > offsets[slot]
+        ]
+        if not linked:
+            return []
+        midX = sum(systems[slot].posX for slot in linked) / len(linked)
+        midY = sum(systems[slot].posY for slot in linked) / len(linked)
+        midZ = sum(systems[slot].posZ for slot in linked) / len(linked)
+        nearest = {
+            slot: (
+                (systems[slot].posX - midX) ** 2 +
+                (systems[slot].posY - midY) ** 2 +
+                (systems[slot].posZ - midZ) ** 2
+            )
+            for slot in linked
+        }
+        landmarkSlots = []
+        while nearest and len(landmarkSlots) < count:
+            landmark = max(nearest, key=nearest.get)
+            landmarkSlots.append(landmark)
+            del nearest[landmark]
+            system = systems[landmark]
+            for slot, distSq in nearest.items():
+                newDistSq = system.distToSq(systems[slot])
+                if newDistSq < distSq:
+                    nearest[slot] = newDistSq
+        return landmarkSlots
+    
+    @staticmethod
+    def _routeDistances(compact, source):
+        """ Dijkstra; unreachable Systems get -1. """
+        offsets, targets, linkLy = compact.offsets, compact.targets, compact.distances
+        distances = array('d', [-1.]) * len(compact.systems)
+        distances[source] = 0.
+        openSet = [(0., source)]
+        heappop, heappush = heapq.heappop, heapq.heappush
+        while openSet:
+            dist, slot = heappop(openSet)
+            if dist > distances[slot]:
+                continue
+            for edge in range(offsets[slot], offsets[slot + 1]):
+                newDist = dist + linkLy[edge]
+                target = targets[edge]
+                oldDist = distances[target]
+                if oldDist < 0 or newDist < oldDist:
+                    distances[target] = newDist
+                    heappush(openSet, (newDist, target))
+        return distances
+    
+    @staticmethod
+    def _jumpCounts(compact, source):
+        """ Breadth first search; unreachable Systems get -1. """
+        offsets, targets = compact.offsets, compact.targets
+        jumps = array('i', [-1]) * len(compact.systems)
+        jumps[source] = 0
+        ring, count = [source], 0
+        while ring:
+            count += 1
+            nextRing = []
+            for slot in ring:
+                for edge in range(offsets[slot], offsets[slot + 1]):
+                    target = targets[edge]
+                    if jumps[target] < 0:
+                        jumps[target] = count
+                        nextRing.append(target)
+            ring = nextRing
+        return jumps
+    
+    def bounds(self, here, there):
+        """
+        Returns (lyBound, jumpBound), lower bounds on the length and
+        the number of jumps of any route between two Systems.
+        """
+        slots = self.compact.slots
+        hereSlot, thereSlot = slots.get(here), slots.get(there)
+        if hereSlot is None or thereSlot is None:
+            return 0., 0
+        slack = self.roundingSlack
+        lyBound, jumpBound = 0., 0
+        for distances, jumps in zip(self.distances, self.jumps):
+            hereLy, thereLy = distances[hereSlot], distances[thereSlot]
+            if hereLy < 0 or thereLy < 0:
+                continue
+            ly = abs(thereLy - hereLy) - slack * (thereLy + hereLy)
+            if ly > lyBound:
+                lyBound = ly
+            numJumps = abs(jumps[thereSlot] - jumps[hereSlot])
+            if numJumps > jumpBound:
+                jumpBound = numJumps
+        return lyBound, jumpBound
+
+
+class JumpGraph(object):
+    """
+    Lazily populated adjacency of Systems to the Systems within
+    maxLy of them, as (neighbour, distLy) lists, read from a
+    CompactJumpGraph if one is given.
+    """
+    
+    def __init__(self, tdb, maxLy, compact=None, landmarks=None):
+        self.tdb = tdb
+        self.maxLy = maxLy
+        self.compact = compact
+        self.landmarks = landmarks
+        self.adjacency = {}
+    
+    def __len__(self):
+        return len(self.adjacency)
+    
+    def neighbours(self, system):
+        """ Returns the list of (neighbour, distLy) for system. """
+        try:
+            return self.adjacency[system]
+        except KeyError:
+            pass
+        neighbours = None
+        if self.compact is not None:
+            neighbours = self.compact.neighbours(system, self.maxLy)
+        if neighbours is None:
+            neighbours = list(self.tdb.genSystemsInRange(system, self.maxLy))
+        self.adjacency[system] = neighbours
+        return neighbours
+    
+    def costs(self, fewestJumps):
+        """
+        Returns (jumpCost, lyCost, estimateScale): the cost of a jump is
+        jumpCost + lyCost * distLy, and no route between two systems
+        costs less than estimateScale * their distance.
+        """
+        if fewestJumps:
+            jumpCost, lyCost = 1., jumpTieBreak / self.maxLy
+        else:
+            jumpCost, lyCost = 0., 1.
+        return jumpCost, lyCost, jumpCost / self.maxLy + lyCost
+    
+    def estimator(self, fewestJumps):
+        """
+        Returns estimate(system, target), a consistent lower bound on
+        the cost of any route between two Systems: the straight-line
+        distance or, with landmarks, the better of that and their
+        bounds.
+        """
+        jumpCost, lyCost, scale = self.costs(fewestJumps)
+        landmarks = self.landmarks
+        if not landmarks:
+            return lambda system, target: scale * system.distanceTo(target)
+        
+        def estimate(system, target):
+            lyBound, jumpBound = landmarks.bounds(system, target)
+            return max(
+                scale * system.distanceTo(target),
+                jumpCost * jumpBound + lyCost * lyBound,
+            )
+        
+        return estimate
+
+
+def _walkBack(prevs, system):
+    path = []
+    while system is not None:
+        path.append(system)
+        system = prevs[system]
+    return path
+
+
+def findRoute(graph, origin, dest, avoiding=(), fewestJumps=False):
+    """
+    Bidirectional A* search for the cheapest route from origin to
+    dest. Both searches use the average of the two straight-line
+    potentials, which keeps the heuristic consistent from either end
+    so the search can stop as soon as the two frontiers prove no
+    cheaper meeting point is left.
+    
+    Returns the list of Systems from origin to dest, or None if
+    there is no route that avoids the 'avoiding' Systems.
+    """
+    if origin is dest:
+        return [origin]
+    
+    jumpCost, lyCost, _ = graph.costs(fewestJumps)
+    estimate = graph.estimator(fewestJumps)
+    potentials = {}
+    
+    def potential(system):
+        """ Forward potential; the reverse one is its negation. """
+        try:
+            return potentials[system]
+        except KeyError:
+            pass
+        value = potentials[system] = (
+            estimate(system, dest) - estimate(system, origin)
+        ) / 2
+        return value
+    
+    blocked = set(avoiding)
+    blocked.discard(origin)
+    neighbours = graph.neighbours
+    heappop, heappush = heapq.heappop, heapq.heappush
+    
+    dists = ({origin: 0.}, {dest: 0.})
+    prevs = ({origin: None}, {dest: None})
+    done = (set(), set())
+    heaps = (
+        [(potential(origin), origin.ID, origin)],
+        [(-potential(dest), dest.ID, dest)],
+    )
+    best, meet = float("inf"), None
+    
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+        # Expand whichever frontier is smaller.
+        side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+        sign = 1 - side * 2
+        _, _, system = heappop(heaps[side])
+        if system in done[side]:
+            continue
+        done[side].add(system)
+        
+        myDists, otherDists = dists[side], dists[1 - side]
+        myPrevs, myHeap = prevs[side], heaps[side]
+        sysDist = myDists[system]
+        for nSys, nDist in neighbours(system):
+            if nSys in blocked:
+                continue
+            newDist = sysDist + jumpCost + lyCost * nDist
+            if newDist >= myDists.get(nSys, best):
+                continue
+            myDists[nSys] = newDist
+            myPrevs[nSys] = system
+            heappush(myHeap, (newDist + sign * potential(nSys), nSys.ID, nSys))
+            otherDist = otherDists.get(nSys)
+            if otherDist is not None and newDist + otherDist < best:
+                best, meet = newDist + otherDist, nSys
+    
+    if meet is None:
+        return None
+    path = _walkBack(prevs[0], meet)
+    path.reverse()
+    path.extend(_walkBack(prevs[1], meet)[1:])
+    return path
+
+
+def findRouteWithStops(
+        graph, origin, dest, stationInterval, hasStation,
+        avoiding=(), fewestJumps=False,
+        ):
+    """
+    A* search for a route from origin to dest on which there is a
+    system with a suitable station, per hasStation(system), at least
+    every stationInterval jumps.
+    
+    As with the original search, each system keeps only the first,
+    cheapest, label it is reached with, so this finds a good route
+    rather than guaranteeing the cheapest one.
+    
+    Returns the list of Systems from origin to dest, or None.
+    """
+    if origin is dest:
+        return [origin]
+    
+    jumpCost, lyCost, _ = graph.costs(fewestJumps)
+    estimate = graph.estimator(fewestJumps)
+    blocked = set(avoiding)
+    blocked.discard(origin)
+    neighbours = graph.neighbours
+    heappop, heappush = heapq.heappop, heapq.heappush
+    
+    dists = {origin: 0.}
+    prevs = {origin: None}
+    done = set()
+    openSet = [(estimate(origin, dest), origin.ID, origin, 0)]
+    
+    while openSet:
+        _, _, system, stnDist = heappop(openSet)
+        if system is dest:
+            path = _walkBack(prevs, dest)
+            path.reverse()
+            return path
+        if system in done:
+            continue
+        done.add(system)
+        
+        candidates = neighbours(system)
+        if hasStation(system):
+            stnDist = 0
+        else:
+            stnDist += 1
+            if stnDist >= stationInterval:
+                candidates = [
+                    (nSys, nDist) for nSys, nDist in candidates
+                    if hasStation(nSys)
+                ]
+        
+        sysDist = dists[system]
+        for nSys, nDist in candidates:
+            if nSys in blocked or nSys in done:
+                continue
+            newDist = sysDist + jumpCost + lyCost * nDist
+            if newDist >= dists.get(nSys, float("inf")):
+                continue
+            dists[nSys] = newDist
+            prevs[nSys] = system
+            heappush(openSet, (
+                newDist + estimate(nSys, dest),
+                nSys.ID, nSys, stnDist,
+            ))
+    
+    return None
+
+
+def findRoutesFrom(graph, origin, dests, avoiding=(), fewestJumps=False):
+    """
+    Dijkstra search from origin that stops once every one of 'dests'
+    is reached, so that all of their routes come from a single tree.
+    
+    Returns {dest: [origin, ..., dest]} with None for each dest that
+    can't be reached without going through the 'avoiding' Systems.
+    """
+    jumpCost, lyCost, _ = graph.costs(fewestJumps)
+    blocked = set(avoiding)
+    blocked.discard(origin)
+    neighbours = graph.neighbours
+    heappop, heappush = heapq.heappop, heapq.heappush
+    
+    routes = dict.fromkeys(dests)
+    remaining = set(routes)
+    remaining.difference_update(blocked)
+    dists = {origin: 0.}
+    prevs = {origin: None}
+    done = set()
+    openSet = [(0., origin.ID, origin)]
+    
+    while openSet and remaining:
+        sysDist, _, system = heappop(openSet)
+        if system in done:
+            continue
+        done.add(system)
+        if system in remaining:
+            remaining.discard(system)
+            path = _walkBack(prevs, system)
+            path.reverse()
+            routes[system] = path
+        
+        for nSys, nDist in neighbours(system):
+            if nSys in blocked or nSys in done:
+                continue
+            newDist = sysDist + jumpCost + lyCost * nDist
+            if newDist >= dists.get(nSys, float("inf")):
+                continue
+            dists[nSys] = newDist
+            prevs[nSys] = system
+            heappush(openSet, (newDist, nSys.ID, nSys))
+    
+    return routes
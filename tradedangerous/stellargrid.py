@@ -0,0 +1,446 @@
+# --------------------------------------------------------------------
+# Copyright (C) Oliver 'kfsone' Smith 2014 <oliver@kfs.org>:
+# Copyright (C) Bernd 'Gazelle' Gollesch 2016, 2017
+# Copyright (C) Jonathan 'eyeonus' Jones 2018, 2019
+#
+# You are free to use, redistribute, or even print and eat a copy of
+# this software so long as you include this copyright notice.
+# I guarantee there is at least one bug neither of us knew about.
+# --------------------------------------------------------------------
+# TradeDangerous :: Modules :: Stellar Grid
+#
+"""
+Spatial indexes used by TradeDB to find the Systems within a given
+radius of another System.
+
+Three index types are provided:
+
+    grid
+        Pure-Python: buckets systems into 32ly cubes held in a dict.
+    
+    morton
+        NumPy-backed: the systems are stored in flat arrays sorted by
+        the Morton (z-order) code of their 32ly cube, so a radius query
+        is a handful of binary searches plus one vectorised distance
+        check. Requires numpy.
+    
+    rtree
+        SQLite-backed: bounding-box queries against the SystemPosition
+        R*Tree in the cache DB, which triggers keep in step with the
+        System table. Nothing is built in memory up front.
+
+All support incremental add/remove/move so that the index does not
+have to be rebuilt every time a System is added or relocated.
+
+Use makeStellarIndex() to construct one by name.
+"""
+
+from .tradeexcept import TradeException
+
+haveNumpy = False
+try:
+    import numpy
+    haveNumpy = True
+except (KeyError, ImportError):
+    pass
+
+__all__ = [
+    'makeStellarGridKey', 'makeStellarIndex',
+    'StellarGrid', 'MortonIndex', 'RTreeIndex', 'indexTypes',
+    'boundingBoxSQL',
+]
+
+
+def makeStellarGridKey(x, y, z):
+    """
+    The Stellar Grid is a map of systems based on their Stellar
+    co-ordinates rounded down to 32lys. This makes it much easier
+    to find stars within rectangular volumes.
+    """
+    return (int(x) >> 5, int(y) >> 5, int(z) >> 5)
+
+
+class StellarGrid(object):
+    """
+    Divides the galaxy into a fixed-sized grid allowing us to
+    aggregate small numbers of stars by locality.
+    """
+    
+    name = 'grid'
+    
+    def __init__(self, systems=()):
+        self.cells = {}
+        self.keys = {}
+        for system in systems:
+            self.add(system)
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def __contains__(self, system):
+        return system in self.keys
+    
+    def add(self, system):
+        """ Adds a System to the grid at its current position. """
+        key = makeStellarGridKey(system.posX, system.posY, system.posZ)
+        self.keys[system] = key
+        try:
+            cell = self.cells[key]
+        except KeyError:
+            cell = self.cells[key] = []
+        cell.append(system)
+    
+    def remove(self, system):
+        """ Removes a System from the grid. """
+        key = self.keys.pop(system)
+        cell = self.cells[key]
+        cell.remove(system)
+        if not cell:
+            del self.cells[key]
+    
+    def move(self, system):
+        """
+        Re-files a System whose position has changed since it was
+        added to the grid.
+        """
+        newKey = makeStellarGridKey(system.posX, system.posY, system.posZ)
+        if self.keys[system] != newKey:
+            self.remove(system)
+            self.add(system)
+    
+    def query(self, system, ly):
+        """
+        Yields (candidate, distLy) for every System within ly of
+        'system', excluding system itself.
+        """
+        sysX, sysY, sysZ = system.posX, system.posY, system.posZ
+        lwrBound = makeStellarGridKey(sysX - ly, sysY - ly, sysZ - ly)
+        uprBound = makeStellarGridKey(sysX + ly, sysY + ly, sysZ + ly)
+        lySq = ly ** 2
+        cells = self.cells
+        for x in range(lwrBound[0], uprBound[0]+1):
+            for y in range(lwrBound[1], uprBound[1]+1):
+                for z in range(lwrBound[2], uprBound[2]+1):
+                    try:
+                        grid = cells[(x, y, z)]
+                    except KeyError:
+                        continue
+                    for candidate in grid:
+                        distSq = (candidate.posX - sysX) ** 2
+                        if distSq > lySq:
+                            continue
+                        distSq += (candidate.posY - sysY) ** 2
+                        if distSq > lySq:
+                            continue
+                        distSq += (candidate.posZ - sysZ) ** 2
+                        if distSq > lySq:
+                            continue
+                        if candidate is not system:
+                            yield candidate, distSq ** 0.5
+
+
+######################################################################
+# Morton-ordered index
+
+# Cell co-ordinates are biased by this much so that they are positive
+# before being interleaved; 21 bits per axis fits 63 bits in an int64.
+mortonBias = 1 << 20
+mortonMask = (1 << 21) - 1
+
+
+def _spreadBits(v):
+    """
+    Spreads the low 21 bits of v so there are two zero bits between
+    each of them. Works on ints and numpy integer arrays alike.
+    """
+    v = v & mortonMask
+    v = (v | v << 32) & 0x1f00000000ffff
+    v = (v | v << 16) & 0x1f0000ff0000ff
+    v = (v | v << 8) & 0x100f00f00f00f00f
+    v = (v | v << 4) & 0x10c30c30c30c30c3
+    v = (v | v << 2) & 0x1249249249249249
+    return v
+
+
+def mortonCode(cellX, cellY, cellZ):
+    """
+    Returns the Morton (z-order) code of a stellar grid cell.
+    """
+    return (
+        _spreadBits(cellX + mortonBias) |
+        _spreadBits(cellY + mortonBias) << 1 |
+        _spreadBits(cellZ + mortonBias) << 2
+    )
+
+
+class MortonIndex(object):
+    """
+    NumPy-backed spatial index. Systems are kept in arrays sorted by
+    the Morton code of their stellar grid cell; each cell of a query's
+    bounding cube maps to a contiguous slice that is found with
+    numpy.searchsorted, and the distances of every candidate in those
+    slices are computed in one vectorised pass.
+    
+    Additions and moves go into a small StellarGrid overlay, removals
+    simply mark the array slot dead. Once either grows past a fraction
+    of the index, the arrays are rebuilt on the next query.
+    """
+    
+    name = 'morton'
+    
+    def __init__(self, systems=()):
+        if not haveNumpy:
+            raise TradeException(
+                "The 'morton' stellar index requires numpy"
+            )
+        self._build(list(systems))
+    
+    def _build(self, systems):
+        count = len(systems)
+        pos = numpy.empty((count, 3), dtype=numpy.float64)
+        for i, system in enumerate(systems):
+            pos[i] = (system.posX, system.posY, system.posZ)
+        # Same truncation as makeStellarGridKey.
+        cells = pos.astype(numpy.int64) >> 5
+        codes = mortonCode(cells[:, 0], cells[:, 1], cells[:, 2])
+        order = numpy.argsort(codes, kind='stable')
+        self.codes = codes[order]
+        self.pos = pos[order]
+        self.systems = [systems[i] for i in order.tolist()]
+        self.slots = {system: i for i, system in enumerate(self.systems)}
+        self.alive = numpy.ones(count, dtype=bool)
+        self.deadCount = 0
+        self.pending = StellarGrid()
+    
+    def _rebuild(self):
+        systems = [
+            system for system, slot in self.slots.items()
+            if self.alive[slot]
+        ]
+        systems.extend(self.pending.keys)
+        self._build(systems)
+    
+    def _needsRebuild(self):
+        limit = max(64, len(self.systems) >> 4)
+        return self.deadCount > limit or len(self.pending) > limit
+    
+    def __len__(self):
+        return len(self.systems) - self.deadCount + len(self.pending)
+    
+    def __contains__(self, system):
+        slot = self.slots.get(system)
+        if slot is not None and self.alive[slot]:
+            return True
+        return system in self.pending
+    
+    def add(self, system):
+        """ Adds a System to the index at its current position. """
+        self.pending.add(system)
+    
+    def remove(self, system):
+        """ Removes a System from the index. """
+        slot = self.slots.get(system)
+        if slot is not None and self.alive[slot]:
+            self.alive[slot] = False
+            self.deadCount += 1
+        else:
+            self.pending.remove(system)
+    
+    def move(self, system):
+        """
+        Re-files a System whose position has changed since it was
+        added to the index.
+        """
+        self.remove(system)
+        self.add(system)
+    
+    def _cellSlices(self, lwrBound, uprBound):
+        """
+        Returns the (starts, ends) of the array slices covering the
+        cells between lwrBound and uprBound inclusive.
+        """
+        axes = [
+            numpy.arange(lwr, upr + 1, dtype=numpy.int64) + mortonBias
+            for lwr, upr in zip(lwrBound, uprBound)
+        ]
+        cellCodes = (
+            _spreadBits(axes[0])[:, None, None] |
+            (_spreadBits(axes[1]) << 1)[None, :, None] |
+            (_spreadBits(axes[2]) << 2)[None, None, :]
+        ).ravel()
+        cellCodes.sort()
+        starts = numpy.searchsorted(self.codes, cellCodes, 'left')
+        ends = numpy.searchsorted(self.codes, cellCodes, 'right')
+        occupied = ends > starts
+        return starts[occupied], ends[occupied]
+    
+    def query(self, system, ly):
+        """
+        Yields (candidate, distLy) for every System within ly of
+        'system', excluding system itself.
+        """
+        if self._needsRebuild():
+            self._rebuild()
+        
+        sysX, sysY, sysZ = system.posX, system.posY, system.posZ
+        lwrBound = makeStellarGridKey(sysX - ly, sysY - ly, sysZ - ly)
+        uprBound = makeStellarGridKey(sysX + ly, sysY + ly, sysZ + ly)
+        lySq = ly ** 2
+        numCells = 1
+        for lwr, upr in zip(lwrBound, uprBound):
+            numCells *= upr - lwr + 1
+        
+        if numCells >= len(self.systems):
+            # Cheaper to just test everything.
+            indexes = numpy.arange(len(self.systems))
+        else:
+            starts, ends = self._cellSlices(lwrBound, uprBound)
+            lengths = ends - starts
+            # Expand the [start, end) pairs into one index array.
+            offsets = numpy.cumsum(lengths) - lengths
+            indexes = (
+                numpy.arange(lengths.sum()) -
+                numpy.repeat(offsets, lengths) +
+                numpy.repeat(starts, lengths)
+            )
+        
+        if len(indexes):
+            delta = self.pos[indexes] - (sysX, sysY, sysZ)
+            distSq = (
+                delta[:, 0] * delta[:, 0] +
+                delta[:, 1] * delta[:, 1] +
+                delta[:, 2] * delta[:, 2]
+            )
+            # Over-select slightly, then re-check the survivors with the
+            # same arithmetic StellarGrid uses so both agree to the bit.
+            inRange = (distSq <= lySq * 1.000001) & self.alive[indexes]
+            systems = self.systems
+            for slot in indexes[inRange].tolist():
+                candidate = systems[slot]
+                distSq = (
+                    (candidate.posX - sysX) ** 2 +
+                    (candidate.posY - sysY) ** 2 +
+                    (candidate.posZ - sysZ) ** 2
+                )
+                if distSq <= lySq and candidate is not system:
+                    yield candidate, distSq ** 0.5
+        
+        if self.pending.keys:
+            yield from self.pending.query(system, ly)
+
+
+######################################################################
+# SQLite R*Tree index
+
+
+def boundingBoxSQL(system, ly):
+    """
+    Returns (where, bindValues) selecting the rows of SystemPosition
+    whose point lies within the cube of ly around system. The cube is
+    a superset of the sphere, callers still check the exact distance.
+    """
+    sysX, sysY, sysZ = system.posX, system.posY, system.posZ
+    where = (
+        "max_x >= ? AND min_x <= ?"
+        " AND max_y >= ? AND min_y <= ?"
+        " AND max_z >= ? AND min_z <= ?"
+    )
+    bindValues = [
+        sysX - ly, sysX + ly,
+        sysY - ly, sysY + ly,
+        sysZ - ly, sysZ + ly,
+    ]
+    return where, bindValues
+
+
+class RTreeIndex(object):
+    """
+    Spatial index that defers to the SystemPosition R*Tree of the
+    cache DB. The R*Tree is maintained by triggers on System, so add,
+    remove and move only have to track which System object an ID
+    refers to.
+    
+    getDB is called for the connection to use on every query, so the
+    index can be queried from any thread TradeDB.getDB() serves.
+    """
+    
+    name = 'rtree'
+    
+    def __init__(self, systems=(), getDB=None):
+        if getDB is None:
+            raise TradeException(
+                "The 'rtree' stellar index requires a database"
+            )
+        self.getDB = getDB
+        self.systemByID = {system.ID: system for system in systems}
+    
+    def __len__(self):
+        return len(self.systemByID)
+    
+    def __contains__(self, system):
+        return self.systemByID.get(system.ID) is system
+    
+    def add(self, system):
+        """ Adds a System to the index. """
+        self.systemByID[system.ID] = system
+    
+    def remove(self, system):
+        """ Removes a System from the index. """
+        del self.systemByID[system.ID]
+    
+    def move(self, system):
+        """ Position changes are picked up from the DB. """
+        pass
+    
+    def query(self, system, ly):
+        """
+        Yields (candidate, distLy) for every System within ly of
+        'system', excluding system itself.
+        """
+        where, bindValues = boundingBoxSQL(system, ly)
+        stmt = "SELECT system_id FROM SystemPosition WHERE " + where
+        sysX, sysY, sysZ = system.posX, system.posY, system.posZ
+        lySq = ly ** 2
+        systemByID = self.systemByID
+        for (ID,) in self.getDB().execute(stmt, bindValues):
+            candidate = systemByID.get(ID)
+            if candidate is None or candidate is system:
+                continue
+            distSq = (
+                (candidate.posX - sysX) ** 2 +
+                (candidate.posY - sysY) ** 2 +
+                (candidate.posZ - sysZ) ** 2
+            )
+            if distSq <= lySq:
+                yield candidate, distSq ** 0.5
+
+
+# Index types that can be selected by name.
+indexTypes = {
+    StellarGrid.name: StellarGrid,
+    MortonIndex.name: MortonIndex,
+    RTreeIndex.name: RTreeIndex,
+}
+
+
+def makeStellarIndex(indexType, systems, getDB=None):
+    """
+    Constructs a spatial index of the given type over 'systems'.
+    
+    indexType may be one of the names in indexTypes, or None/'auto'
+    to pick the fastest in-memory type available. getDB returns the
+    connection the 'rtree' index queries, e.g. TradeDB.getDB.
+    """
+    if not indexType or indexType == 'auto':
+        indexType = MortonIndex.name if haveNumpy else StellarGrid.name
+    try:
+        indexClass = indexTypes[indexType]
+    except KeyError:
+        raise TradeException(
+            "Unknown stellar index type '{}', expected one of: {}".format(
+                indexType, ", ".join(sorted(indexTypes))
+            )
+        )
+    if indexClass is RTreeIndex:
+        return indexClass(systems, getDB)
+    return indexClass(systems)
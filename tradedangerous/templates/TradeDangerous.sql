@@ -59,6 +59,179 @@ CREATE TABLE System
 CREATE INDEX idx_system_by_pos ON System (pos_x, pos_y, pos_z, system_id);
 
 
+--
+-- SystemRange persists the neighbourhood TradeDB.genSystemsInRange
+-- computed for a system, so that frequently used origins don't have
+-- to be re-probed by every invocation. neighbour_ids and distances
+-- are packed arrays (int64 and double) sorted by distance, covering
+-- everything within probed_ly.
+--
+-- The triggers drop every cached neighbourhood that reaches a system
+-- which is added, moved or removed. They walk SystemRange, which is
+-- small, rather than System, and do nothing while it is empty, so bulk
+-- loads of System don't pay for them.
+--
+
+CREATE TABLE SystemRange
+ (
+   system_id INTEGER PRIMARY KEY,
+   probed_ly DOUBLE NOT NULL,
+   neighbour_ids BLOB NOT NULL,
+   distances BLOB NOT NULL,
+
+   FOREIGN KEY (system_id) REFERENCES System(system_id)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE
+ );
+
+CREATE TRIGGER system_range_on_insert AFTER INSERT ON System
+ WHEN EXISTS (SELECT 1 FROM SystemRange)
+BEGIN
+  DELETE FROM SystemRange
+   WHERE system_id IN (
+          SELECT  r.system_id
+            FROM  SystemRange AS r
+                  CROSS JOIN System AS s USING (system_id)
+           WHERE  (s.pos_x - NEW.pos_x) * (s.pos_x - NEW.pos_x)
+                + (s.pos_y - NEW.pos_y) * (s.pos_y - NEW.pos_y)
+                + (s.pos_z - NEW.pos_z) * (s.pos_z - NEW.pos_z)
+                  <= r.probed_ly * r.probed_ly
+         );
+END;
+
+CREATE TRIGGER system_range_on_update AFTER UPDATE OF pos_x, pos_y, pos_z ON System
+ WHEN EXISTS (SELECT 1 FROM SystemRange)
+BEGIN
+  DELETE FROM SystemRange
+   WHERE system_id = OLD.system_id
+      OR system_id IN (
+          SELECT  r.system_id
+            FROM  SystemRange AS r
+                  CROSS JOIN System AS s USING (system_id)
+           WHERE  (s.pos_x - OLD.pos_x) * (s.pos_x - OLD.pos_x)
+                + (s.pos_y - OLD.pos_y) * (s.pos_y - OLD.pos_y)
+                + (s.pos_z - OLD.pos_z) * (s.pos_z - OLD.pos_z)
+                  <= r.probed_ly * r.probed_ly
+              OR  (s.pos_x - NEW.pos_x) * (s.pos_x - NEW.pos_x)
+                + (s.pos_y - NEW.pos_y) * (s.pos_y - NEW.pos_y)
+                + (s.pos_z - NEW.pos_z) * (s.pos_z - NEW.pos_z)
+                  <= r.probed_ly * r.probed_ly
+         );
+END;
+
+CREATE TRIGGER system_range_on_delete AFTER DELETE ON System
+ WHEN EXISTS (SELECT 1 FROM SystemRange)
+BEGIN
+  DELETE FROM SystemRange
+   WHERE system_id = OLD.system_id
+      OR system_id IN (
+          SELECT  r.system_id
+            FROM  SystemRange AS r
+                  CROSS JOIN System AS s USING (system_id)
+           WHERE  (s.pos_x - OLD.pos_x) * (s.pos_x - OLD.pos_x)
+                + (s.pos_y - OLD.pos_y) * (s.pos_y - OLD.pos_y)
+                + (s.pos_z - OLD.pos_z) * (s.pos_z - OLD.pos_z)
+                  <= r.probed_ly * r.probed_ly
+         );
+END;
+
+
+--
+-- JumpGraph persists the compact (CSR) adjacency built by TradeDB for
+-- routing, one row per jump range bucket: system_ids (int64) lists
+-- the systems, offsets (int64) indexes the start of each system's
+-- neighbours in targets (int32 positions in system_ids) and
+-- distances (float32), which are sorted by distance.
+--
+-- Any change to the systems invalidates every graph.
+--
+
+CREATE TABLE JumpGraph
+ (
+   bucket_ly DOUBLE PRIMARY KEY,
+   system_ids BLOB NOT NULL,
+   offsets BLOB NOT NULL,
+   targets BLOB NOT NULL,
+   distances BLOB NOT NULL
+ );
+
+--
+-- JumpLandmark holds the routing.Landmarks of each JumpGraph: the route
+-- distances (float64) and jump counts (int32) from a landmark system
+-- to every system, in system_ids order, -1 where it is unreachable.
+--
+
+CREATE TABLE JumpLandmark
+ (
+   bucket_ly DOUBLE NOT NULL,
+   landmark_id INTEGER NOT NULL,
+   distances BLOB NOT NULL,
+   jumps BLOB NOT NULL,
+
+   PRIMARY KEY (bucket_ly, landmark_id)
+ ) WITHOUT ROWID
+;
+
+CREATE TRIGGER jump_graph_on_insert AFTER INSERT ON System
+BEGIN
+  DELETE FROM JumpGraph;
+  DELETE FROM JumpLandmark;
+END;
+
+CREATE TRIGGER jump_graph_on_update AFTER UPDATE OF system_id, pos_x, pos_y, pos_z ON System
+BEGIN
+  DELETE FROM JumpGraph;
+  DELETE FROM JumpLandmark;
+END;
+
+CREATE TRIGGER jump_graph_on_delete AFTER DELETE ON System
+BEGIN
+  DELETE FROM JumpGraph;
+  DELETE FROM JumpLandmark;
+END;
+
+
+--
+-- SystemPosition is an R*Tree over the System co-ordinates, used to
+-- narrow range queries ("--near") down to a bounding box in SQL
+-- before the exact distance check. It is kept in step with System
+-- by the triggers below.
+--
+
+CREATE VIRTUAL TABLE SystemPosition USING rtree(
+   system_id,
+   min_x, max_x,
+   min_y, max_y,
+   min_z, max_z
+);
+
+CREATE TRIGGER system_position_on_insert AFTER INSERT ON System
+BEGIN
+  INSERT OR REPLACE INTO SystemPosition VALUES (
+      NEW.system_id,
+      NEW.pos_x, NEW.pos_x,
+      NEW.pos_y, NEW.pos_y,
+      NEW.pos_z, NEW.pos_z
+  );
+END;
+
+CREATE TRIGGER system_position_on_update AFTER UPDATE OF system_id, pos_x, pos_y, pos_z ON System
+BEGIN
+  DELETE FROM SystemPosition WHERE system_id = OLD.system_id;
+  INSERT OR REPLACE INTO SystemPosition VALUES (
+      NEW.system_id,
+      NEW.pos_x, NEW.pos_x,
+      NEW.pos_y, NEW.pos_y,
+      NEW.pos_z, NEW.pos_z
+  );
+END;
+
+CREATE TRIGGER system_position_on_delete AFTER DELETE ON System
+BEGIN
+  DELETE FROM SystemPosition WHERE system_id = OLD.system_id;
+END;
+
+
 CREATE TABLE Station
  (
    station_id INTEGER PRIMARY KEY,
@@ -231,6 +404,72 @@ CREATE INDEX si_mod_stn_itm ON StationItem(modified, station_id, item_id);
 CREATE INDEX si_itm_dmdpr ON StationItem(item_id, demand_price) WHERE demand_price > 0;
 CREATE INDEX si_itm_suppr ON StationItem(item_id, supply_price) WHERE supply_price > 0;
 
+--
+-- StationMarketSummary keeps, for each station with market data, the
+-- number of StationItem rows and the oldest, mean and newest of their
+-- modified times (as unix epoch seconds), so loading the DB doesn't
+-- have to aggregate the whole StationItem table. It is refreshed by
+-- the code that writes StationItem (cache.updateStationMarketSummary).
+--
+
+CREATE TABLE StationMarketSummary
+ (
+   station_id INTEGER PRIMARY KEY,
+   item_count INTEGER NOT NULL,
+   min_modified INTEGER NOT NULL,
+   avg_modified DOUBLE NOT NULL,
+   max_modified INTEGER NOT NULL,
+
+   FOREIGN KEY (station_id) REFERENCES Station(station_id)
+    ON UPDATE CASCADE ON DELETE CASCADE
+ );
+
+--
+-- ItemPriceStats summarises the non-zero demand (station buying) and
+-- supply (station selling) prices of each item in StationItem: how
+-- many there are, their mean, and their minimum, quartiles and
+-- maximum. Items without any prices have no row. It is refreshed by
+-- the code that writes StationItem (cache.updateItemPriceStats).
+--
+
+CREATE TABLE ItemPriceStats
+ (
+   item_id INTEGER PRIMARY KEY,
+   demand_count INTEGER NOT NULL,
+   demand_avg DOUBLE,
+   demand_min INTEGER,
+   demand_p25 INTEGER,
+   demand_median INTEGER,
+   demand_p75 INTEGER,
+   demand_max INTEGER,
+   supply_count INTEGER NOT NULL,
+   supply_avg DOUBLE,
+   supply_min INTEGER,
+   supply_p25 INTEGER,
+   supply_median INTEGER,
+   supply_p75 INTEGER,
+   supply_max INTEGER,
+
+   FOREIGN KEY (item_id) REFERENCES Item(item_id)
+    ON UPDATE CASCADE ON DELETE CASCADE
+ );
+
+--
+-- FileStamp records, for files the cache is loaded from or exported
+-- to, the modification time (unix epoch seconds) the file had when
+-- the cache last matched it, and whether the cache has changes that
+-- have not been written to the file yet (stale). It is maintained by
+-- cache.py; the .prices file is regenerated from StationItem only
+-- when it is stale and something needs to read it.
+--
+
+CREATE TABLE FileStamp
+ (
+   name VARCHAR(40) PRIMARY KEY,
+   modified DOUBLE,
+   stale INTEGER DEFAULT 0 NOT NULL
+ );
+
 CREATE VIEW StationBuying AS
 SELECT  station_id,
         item_id,
@@ -915,20 +915,26 @@ class TradeCalc(object):
                     )
         
         else:
-            getDestinations = tdb.getDestinations
+            # Expand the destinations of every system we could depart
+            # from in one batch rather than one route at a time.
+            stationsSelling = self.stationsSelling
+            destinationTable = tdb.getDestinationTable(
+                set(
+                    route.lastStation.system for route in routes
+                    if route.lastStation.ID in stationsSelling
+                ),
+                maxJumps = maxJumpsPer,
+                maxLyPer = maxLyPer,
+                avoidPlaces = avoidPlaces,
+                maxPadSize = maxPadSize,
+                maxLsFromStar = maxLsFromStar,
+                noPlanet = noPlanet,
+                planetary = planetary,
+                fleet = fleet,
+            )
             
             def station_iterator(srcStation):
-                yield from getDestinations(
-                    srcStation,
-                    maxJumps = maxJumpsPer,
-                    maxLyPer = maxLyPer,
-                    avoidPlaces = avoidPlaces,
-                    maxPadSize = maxPadSize,
-                    maxLsFromStar = maxLsFromStar,
-                    noPlanet = noPlanet,
-                    planetary = planetary,
-                    fleet = fleet,
-                )
+                return destinationTable[srcStation.system]
         
         prog = pbar.Progress(len(routes), 25)
         connections = 0
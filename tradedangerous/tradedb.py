@@ -17,7 +17,7 @@ TradeDB, System, Station, Ship, Item, RareItem and Trade.
 These classes are primarily for describing the database.
 
 Simplistic use might be:
-    
+
     import tradedb
     
     # Create an instance: You can specify a debug level as a
@@ -51,13 +51,15 @@ Simplistic use might be:
 # Imports
 
 
+from array import array
 from collections import namedtuple, defaultdict
+from contextlib import contextmanager
 from pathlib import Path
 from .tradeenv import TradeEnv
 from .tradeexcept import TradeException
 
-from . import cache, fs
-import heapq
+from . import cache, dbpool, fs, nameindex, routing, stellargrid
+from .stellargrid import makeStellarGridKey
 import itertools
 import locale
 import math
@@ -65,6 +67,8 @@ import os
 import re
 import sqlite3
 import sys
+import threading
+import time
 
 haveNumpy = False
 try:
@@ -106,6 +110,14 @@ class AmbiguityError(TradeException):
     def __str__(self):
         anyMatch, key = self.anyMatch, self.key
         if len(anyMatch) > 10:
+            # Only ten are listed, make them the closest ones.
+            searchGrams = nameindex.trigrams(
+                str(self.searchKey).translate(TradeDB.normalizeTrans)
+            )
+            anyMatch = sorted(anyMatch, key=lambda c: -nameindex.similarity(
+                searchGrams,
+                nameindex.trigrams(str(key(c)).translate(TradeDB.normalizeTrans)),
+            ))
             opportunities = ", ".join([
                 key(c) for c in anyMatch[:10]
             ] + ["..."])
@@ -119,6 +131,52 @@ class AmbiguityError(TradeException):
             opportunities
         )
 
+class NameNotFoundError(LookupError):
+    """
+        Raised when a search key does not match anything.
+        Attributes:
+            lookupType  - description of what was being queried,
+            searchKey   - the key given to the search routine,
+            suggestions - the most similar candidates, best first,
+            key         - retrieve the display string for a candidate
+        The suggestions are only looked for when first used.
+    """
+    def __init__(
+            self, message, lookupType, searchKey,
+            suggest=None, key=lambda item: item
+            ):
+        super().__init__(message)
+        self.message = message
+        self.lookupType = lookupType
+        self.searchKey = searchKey
+        self.key = key
+        self._suggest = suggest
+        self._suggestions = None
+    
+    @property
+    def suggestions(self):
+        if self._suggestions is None:
+            self._suggestions = list(self._suggest()) if self._suggest else []
+        return self._suggestions
+    
+    def didYouMean(self):
+        """ Returns 'did you mean ...?' text, or '' if there's nothing close. """
+        suggestions, key = self.suggestions, self.key
+        if not suggestions:
+            return ""
+        if len(suggestions) == 1:
+            return "did you mean {}?".format(key(suggestions[0]))
+        return "did you mean {} or {}?".format(
+            ", ".join(key(c) for c in suggestions[:-1]),
+            key(suggestions[-1]),
+        )
+    
+    def __str__(self):
+        hint = self.didYouMean()
+        if hint:
+            return "{} ({})".format(self.message, hint)
+        return self.message
+
 class SystemNotStationError(TradeException):
     """
         Raised when a station lookup matched a System but
@@ -129,14 +187,6 @@ class SystemNotStationError(TradeException):
 ######################################################################
 
 
-def makeStellarGridKey(x, y, z):
-    """
-    The Stellar Grid is a map of systems based on their Stellar
-    co-ordinates rounded down to 32lys. This makes it much easier
-    to find stars within rectangular volumes.
-    """
-    return (int(x) >> 5, int(y) >> 5, int(z) >> 5)
-
 class System(object):
     """
     Describes a star system which may contain one or more Station objects.
@@ -277,6 +327,28 @@ class DestinationNode(namedtuple('DestinationNode', [
         ])):
     pass
 
+class PriceStats(namedtuple('PriceStats', [
+        'count', 'avg', 'min', 'p25', 'median', 'p75', 'max'
+        ])):
+    """ Statistics of the non-zero prices of one side of an item's market. """
+    pass
+
+class ItemPriceStats(namedtuple('ItemPriceStats', [
+        'demand', 'supply'
+        ])):
+    """ PriceStats of what stations pay for an item and charge for it. """
+    pass
+
+class ConnectionProfile(namedtuple('ConnectionProfile', [
+        'readOnly', 'pragmas'
+        ])):
+    """
+    How TradeDB.getDB opens the DB: read-only through a "mode=ro" URI
+    or not, and the (pragma, value) settings applied to each new
+    connection.
+    """
+    pass
+
 class Station(object):
     """
     Describes a station (trading or otherwise) in a system.
@@ -575,6 +647,10 @@ class TradeDB(object):
         calculateDistance(lx, ly, lz, rx, ry, rz)
             Returns the distance in ly between two points.
         
+        systemsNearSQL(system, ly, column)
+            Returns an SQL clause and bind values limiting a system_id
+            column to the bounding cube of ly around system.
+        
         listSearch(...)
             Performs partial and ambiguity matching of a word from a list
             of potential values.
@@ -621,6 +697,45 @@ class TradeDB(object):
     padSizes = {'?': '?', 'S': 'Sml', 'M': 'Med', 'L': 'Lrg'}
     padSizesExt = {'?': 'Unk', 'S': 'Sml', 'M': 'Med', 'L': 'Lrg'}
     
+    # SQLite connection settings, picked with tdenv.dbProfile
+    # (--db-profile):
+    #   default:  the historical settings.
+    #   wal:      switches the DB to write-ahead logging so that queries
+    #             and an import don't block each other, waits for locks
+    #             rather than failing, and memory maps the file.
+    #   readonly: connections that can only query. They don't block an
+    #             import on a WAL DB; one 'wal' run sets the DB up.
+    # journal_mode is a property of the DB file, so once one connection
+    # has switched to WAL every later one uses it too.
+    connectionProfiles = {
+        'default': ConnectionProfile(False, (
+            ('synchronous', 'OFF'),
+            ('temp_store', 'MEMORY'),
+        )),
+        'wal': ConnectionProfile(False, (
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('temp_store', 'MEMORY'),
+            ('busy_timeout', 30000),
+            ('mmap_size', 256 * 1024 * 1024),
+            ('cache_size', -64 * 1024),
+        )),
+        'readonly': ConnectionProfile(True, (
+            ('query_only', 'ON'),
+            ('temp_store', 'MEMORY'),
+            ('busy_timeout', 30000),
+            ('mmap_size', 256 * 1024 * 1024),
+            ('cache_size', -64 * 1024),
+        )),
+    }
+    
+    # Tables derived from other data, or about the cache itself, that
+    # are never exported
+    derivedTables = (
+        'SystemRange', 'SystemPosition', 'JumpGraph', 'JumpLandmark',
+        'StationMarketSummary', 'ItemPriceStats', 'FileStamp',
+    )
+    
     def __init__(
             self,
             tdenv=None,
@@ -629,11 +744,30 @@ class TradeDB(object):
             ):
         self.conn = None
         self.cur = None
+        self.connThread = None
+        self.readPool = None
+        self.readPoolLock = threading.Lock()
         self.tradingCount = None
+        self.stellarGrid = None
+        self.maxProbedLy = 0.
+        self.persistedRanges = None
+        self.pendingRanges = {}
+        self.systemNameIndex = None
+        self.stationNameIndex = None
+        self.jumpGraphs = {}
+        self.compactJumpGraphs = {}
+        self.jumpLandmarks = {}
         
         tdenv = tdenv or TradeEnv(debug=(debug or 0))
         self.tdenv = tdenv
         
+        self.dbProfile = tdenv.dbProfile or 'default'
+        if self.dbProfile not in self.connectionProfiles:
+            raise TradeException(
+                "Unknown DB connection profile '{}', expected one of: {}"
+                .format(self.dbProfile, ", ".join(self.connectionProfiles))
+            )
+        
         self.templatePath = Path(tdenv.templateDir).resolve()
         self.dataPath = dataPath = fs.ensurefolder(tdenv.dataDir)
         
@@ -643,7 +777,9 @@ class TradeDB(object):
         
         self.dbPath = Path(tdenv.dbFilename or dataPath / TradeDB.defaultDB)
         self.sqlPath = dataPath / Path(tdenv.sqlFilename or TradeDB.defaultSQL)
-        pricePath = Path(tdenv.pricesFilename or TradeDB.defaultPrices)
+        pricePath = Path(
+            tdenv.pricesFilename or os.environ.get('TD_PRICES') or TradeDB.defaultPrices
+        )
         self.pricesPath = dataPath / pricePath
         self.importTables = [
             (str(dataPath / Path(fn)), tn)
@@ -656,6 +792,7 @@ class TradeDB(object):
         self.pricesFilename = str(self.pricesPath)
         
         self.avgSelling, self.avgBuying = None, None
+        self.itemPriceStats = None
         self.tradingStationCount = 0
         
         if load:
@@ -673,6 +810,21 @@ class TradeDB(object):
         distSq = (dX ** 2) + (dY ** 2) + (dZ ** 2)
         return distSq
     
+    @staticmethod
+    def systemsNearSQL(system, ly, column='system_id'):
+        """
+        Returns (clause, bindValues) for an SQL condition limiting
+        'column' to the IDs of systems inside the cube of ly around
+        system, using the SystemPosition R*Tree. The exact distance
+        still has to be checked by the caller.
+        """
+        where, bindValues = stellargrid.boundingBoxSQL(system, ly)
+        clause = (
+            "{} IN (SELECT system_id FROM SystemPosition WHERE {})"
+            .format(column, where)
+        )
+        return clause, bindValues
+    
     @staticmethod
     def calculateDistance(lx, ly, lz, rx, ry, rz):
         """
@@ -687,17 +839,65 @@ class TradeDB(object):
     ############################################################
     # Access to the underlying database.
     
-    def getDB(self):
-        if self.conn:
-            return self.conn
-        self.tdenv.DEBUG1("Connecting to DB")
-        conn = sqlite3.connect(self.dbFilename)
+    def getDB(self, profile=None):
+        """
+        Returns the loaded connection or, if there isn't one or a
+        specific profile (a key of connectionProfiles) is asked for,
+        a new connection configured by that profile.
+        
+        The loaded connection belongs to the thread that loaded the
+        DB; other threads get a read-only connection of their own
+        from the read pool instead, see getReadPool().
+        """
+        if self.conn and not profile:
+            if self.connThread == threading.get_ident():
+                return self.conn
+            return self.getReadPool().threadConnection()
+        return self.__connect(profile or self.dbProfile)
+    
+    def __connect(self, profile, shared=False):
+        """
+        Opens a connection with the given profile; 'shared' ones can
+        be handed between threads and keep more prepared statements.
+        """
+        readOnly, pragmas = self.connectionProfiles[profile]
+        self.tdenv.DEBUG1("Connecting to DB ({})", profile)
+        kwargs = {}
+        if shared:
+            kwargs = {'check_same_thread': False, 'cached_statements': 256}
+        if readOnly:
+            conn = sqlite3.connect(
+                self.dbPath.resolve().as_uri() + "?mode=ro", uri=True,
+                **kwargs
+            )
+        else:
+            conn = sqlite3.connect(self.dbFilename, **kwargs)
         conn.execute("PRAGMA foreign_keys=ON")
-        conn.execute("PRAGMA synchronous=OFF")
-        conn.execute("PRAGMA temp_store=MEMORY")
+        for pragma, value in pragmas:
+            conn.execute("PRAGMA {}={}".format(pragma, value))
         conn.create_function('dist2', 6, TradeDB.calculateDistance2)
         return conn
     
+    def getReadPool(self):
+        """
+        Returns the dbpool.ReadConnectionPool of read-only connections
+        for threads other than the one that loaded the DB, e.g. when
+        TradeDB is embedded in a threaded server:
+        
+            with tdb.getReadPool().connection() as conn:
+                conn.execute(...)
+        
+        The loaded Systems, Stations, Items etc are shared by every
+        thread and must be treated as read-only; writes belong on the
+        loading thread's connection.
+        """
+        with self.readPoolLock:
+            if self.readPool is None:
+                self.readPool = dbpool.ReadConnectionPool(
+                    lambda: self.__connect('readonly', shared=True)
+                )
+            return self.readPool
+    
     def query(self, *args):
         """ Perform an SQL query on the DB and return the cursor. """
         conn = self.getDB()
@@ -707,47 +907,78 @@ class TradeDB(object):
     
     def queryColumn(self, *args):
         """ perform an SQL query and return a single column. """
-        return self.query(args).fetchone()[0]
+        return self.query(*args).fetchone()[0]
     
     def reloadCache(self):
         """
-        Checks if the .sql, .prices or *.csv files are newer than the cache.
+        Checks if the .sql or *.csv files are newer than the cache, or
+        the .prices file has changed since the cache last loaded it.
+        
+        A newer .sql file rebuilds the cache; newer .csv files only reload
+        their tables and the tables that depend on them.
         """
         
         if self.dbPath.exists():
             dbFileStamp = self.dbPath.stat().st_mtime
             
-            paths = [self.sqlPath]
-            paths += [Path(f) for (f, _) in self.importTables]
+            def changed(path):
+                return path.exists() and path.stat().st_mtime > dbFileStamp
             
-            changedPaths = [
-                [path, path.stat().st_mtime]
-                for path in paths
-                if path.exists() and path.stat().st_mtime > dbFileStamp
-            ]
+            pricesChanged = cache.pricesFileChanged(self, self.getDB())
             
-            if not changedPaths:
+            if not changed(self.sqlPath):
+                changedTables = [
+                    tableName
+                    for (fileName, tableName) in self.importTables
+                    if changed(Path(fileName))
+                ]
+                if changedTables:
+                    self.tdenv.DEBUG0(
+                        "Reloading DB Cache tables [{}]", changedTables
+                    )
+                    with self.writableDB():
+                        cache.reloadTables(
+                            self, self.tdenv, changedTables, pricesChanged
+                        )
+                    return
+                
                 # Do we need to reload the .prices file?
                 if not self.pricesPath.exists():
                     self.tdenv.DEBUG1("No .prices file to load")
                     return
                 
-                pricesStamp = self.pricesPath.stat().st_mtime
-                if pricesStamp <= dbFileStamp:
+                if not pricesChanged:
                     self.tdenv.DEBUG1("DB Cache is up to date.")
                     return
                 
                 self.tdenv.DEBUG0(".prices has changed: re-importing")
-                cache.importDataFromFile(
-                    self, self.tdenv, self.pricesPath, reset=True
-                )
+                with self.writableDB():
+                    cache.importDataFromFile(
+                        self, self.tdenv, self.pricesPath, reset=True
+                    )
                 return
             
-            self.tdenv.DEBUG0("Rebuilding DB Cache [{}]", str(changedPaths))
+            self.tdenv.DEBUG0("Rebuilding DB Cache [{}]", str(self.sqlPath))
         else:
             self.tdenv.DEBUG0("Building DB Cache")
         
-        cache.buildCache(self, self.tdenv)
+        with self.writableDB():
+            cache.buildCache(self, self.tdenv)
+    
+    @contextmanager
+    def writableDB(self):
+        """
+        Context in which getDB() connections can write even when the
+        profile is read-only, for rebuilding the cache.
+        """
+        profile = self.dbProfile
+        if self.connectionProfiles[profile].readOnly:
+            self.tdenv.DEBUG0("The DB needs writing, not opening it read-only")
+            self.dbProfile = 'default'
+        try:
+            yield
+        finally:
+            self.dbProfile = profile
     
     ############################################################
     # Load "added" data.
@@ -800,6 +1031,27 @@ class TradeDB(object):
         
         self.systemByID, self.systemByName = systemByID, systemByName
         self.tdenv.DEBUG1("Loaded {:n} Systems", len(systemByID))
+        self.stellarGrid = None
+        self.maxProbedLy = 0.
+        self.persistedRanges = None
+        self.pendingRanges = {}
+        self.systemNameIndex = None
+        self.jumpGraphs = {}
+        self.compactJumpGraphs = {}
+        self.jumpLandmarks = {}
+    
+    def getSystemNameIndex(self):
+        """
+        Returns the NameIndex of System names, building it if the
+        Systems have changed since it was last used.
+        """
+        if self.systemNameIndex is None:
+            self.systemNameIndex = nameindex.NameIndex(
+                self.systemByID.values(),
+                lambda system: system.dbname,
+                TradeDB.normalizeTrans, TradeDB.trimTrans,
+            )
+        return self.systemNameIndex
     
     def lookupSystem(self, key):
         """
@@ -811,7 +1063,8 @@ class TradeDB(object):
             return key.system
         
         return TradeDB.listSearch(
-            "System", key, self.systems(), key=lambda system: system.dbname
+            "System", key, self.systems(), key=lambda system: system.dbname,
+            index=self.getSystemNameIndex(),
         )
     
     def addLocalSystem(
@@ -843,14 +1096,16 @@ class TradeDB(object):
         system = System(ID, name.upper(), x, y, z, 0)
         self.systemByID[ID] = system
         self.systemByName[system.dbname] = system
+        self.systemNameIndex = None
         if commit:
             db.commit()
         self.tdenv.NOTE(
             "Added new system #{}: {} [{},{},{}]",
             ID, name, x, y, z
         )
-        # Invalidate the grid
-        self.stellarGrid = None
+        if self.stellarGrid is not None:
+            self.stellarGrid.add(system)
+        self.__invalidateRangeCaches(system)
         return system
     
     def updateLocalSystem(
@@ -885,6 +1140,17 @@ class TradeDB(object):
         ])
         if commit:
             db.commit()
+        system.dbname = dbname
+        self.systemNameIndex = None
+        if (system.posX, system.posY, system.posZ) != (x, y, z):
+            # Drop the neighbours of both the old and new position.
+            self.__invalidateRangeCaches(system)
+            system.posX, system.posY, system.posZ = x, y, z
+            if haveNumpy:
+                system.pos = numpy.array([x, y, z], numpy.float32)
+            if self.stellarGrid is not None:
+                self.stellarGrid.move(system)
+            self.__invalidateRangeCaches(system)
         self.tdenv.NOTE(
             "{} (#{}) updated in {}: {}, {}, {}, {}, {}, {}",
             oldname, system.ID,
@@ -902,7 +1168,7 @@ class TradeDB(object):
             commit=True,
         ):
         """ Removes a system and it's stations from the local DB. """
-        for stn in self.stations:
+        for stn in system.stations:
             self.removeLocalStation(stn, commit=False)
         db = self.getDB()
         db.execute("""
@@ -912,8 +1178,12 @@ class TradeDB(object):
         ])
         if commit:
             db.commit()
+        self.__invalidateRangeCaches(system)
+        if self.stellarGrid is not None:
+            self.stellarGrid.remove(system)
         del self.systemByName[system.dbname]
         del self.systemByID[system.ID]
+        self.systemNameIndex = None
         
         self.tdenv.NOTE(
             "{} (#{}) deleted from {}",
@@ -926,17 +1196,42 @@ class TradeDB(object):
     
     def __buildStellarGrid(self):
         """
-        Divides the galaxy into a fixed-sized grid allowing us to
-        aggregate small numbers of stars by locality.
+        Builds the spatial index used to find systems by locality;
+        the index type is selected by tdenv.stellarIndex.
         """
-        stellarGrid = self.stellarGrid = dict()
-        for system in self.systemByID.values():
-            key = makeStellarGridKey(system.posX, system.posY, system.posZ)
-            try:
-                grid = stellarGrid[key]
-            except KeyError:
-                grid = stellarGrid[key] = []
-            grid.append(system)
+        self.stellarGrid = stellargrid.makeStellarIndex(
+            self.tdenv.stellarIndex, self.systemByID.values(),
+            getDB=self.getDB,
+        )
+        self.tdenv.DEBUG1(
+            "Built '{}' stellar index of {:n} Systems",
+            self.stellarGrid.name, len(self.stellarGrid)
+        )
+    
+    def __invalidateRangeCaches(self, system):
+        """
+        Drops the cached neighbour list of 'system' and of every system
+        whose cached neighbourhood reaches system's current position,
+        leaving the rest of the range caches intact.
+        """
+        system._rangeCache = None
+        self.pendingRanges.pop(system.ID, None)
+        self.jumpGraphs.clear()
+        self.compactJumpGraphs.clear()
+        self.jumpLandmarks.clear()
+        if self.persistedRanges:
+            self.persistedRanges.pop(system.ID, None)
+        if not self.maxProbedLy:
+            return
+        if self.stellarGrid is None:
+            self.__buildStellarGrid()
+        for candidate, dist in self.stellarGrid.query(
+                system, self.maxProbedLy
+                ):
+            cache = candidate._rangeCache
+            if cache and cache.probedLy >= dist:
+                candidate._rangeCache = None
+                self.pendingRanges.pop(candidate.ID, None)
     
     def genStellarGrid(self, system, ly):
         """
@@ -949,46 +1244,110 @@ class TradeDB(object):
                 The radius of the search around system,
         
         Yields:
-            (candidate, distLySq)
+            (candidate, distLy)
                 candidate:
                     System that was found,
-                distLySq:
-                    The *SQUARE* of the distance in light-years
-                    between system and candidate.
+                distLy:
+                    The distance in light-years between system
+                    and candidate.
         """
         if self.stellarGrid is None:
             self.__buildStellarGrid()
         
-        sysX, sysY, sysZ = system.posX, system.posY, system.posZ
-        lwrBound = makeStellarGridKey(sysX - ly, sysY - ly, sysZ - ly)
-        uprBound = makeStellarGridKey(sysX + ly, sysY + ly, sysZ + ly)
-        lySq = ly ** 2
-        stellarGrid = self.stellarGrid
-        for x in range(lwrBound[0], uprBound[0]+1):
-            for y in range(lwrBound[1], uprBound[1]+1):
-                for z in range(lwrBound[2], uprBound[2]+1):
-                    try:
-                        grid = stellarGrid[(x, y, z)]
-                    except KeyError:
-                        continue
-                    for candidate in grid:
-                        distSq = (candidate.posX - sysX) ** 2
-                        if distSq > lySq:
-                            continue
-                        distSq += (candidate.posY - sysY) ** 2
-                        if distSq > lySq:
-                            continue
-                        distSq += (candidate.posZ - sysZ) ** 2
-                        if distSq > lySq:
-                            continue
-                        if candidate is not system:
-                            yield candidate, distSq ** 0.5
+        yield from self.stellarGrid.query(system, ly)
+    
+    def __loadPersistedRange(self, system, cache, ly):
+        """
+        Populates 'cache' from the SystemRange table if it holds a
+        neighbourhood of at least ly for system.
+        
+        Returns:
+            True if the cache was populated, otherwise False.
+        """
+        if not self.tdenv.persistRanges:
+            return False
+        persisted = self.persistedRanges
+        try:
+            if persisted is None:
+                persisted = self.persistedRanges = {
+                    ID: probedLy
+                    for ID, probedLy in self.query("""
+                        SELECT system_id, probed_ly FROM SystemRange
+                    """)
+                }
+                self.tdenv.DEBUG1(
+                    "{:n} persisted system ranges", len(persisted)
+                )
+            if persisted.get(system.ID, 0.) < ly:
+                return False
+            row = self.query("""
+                SELECT probed_ly, neighbour_ids, distances
+                  FROM SystemRange
+                 WHERE system_id = ?
+            """, [system.ID]).fetchone()
+        except sqlite3.OperationalError as e:
+            self.tdenv.DEBUG0("Persisted system ranges unavailable: {}", e)
+            self.persistedRanges = {}
+            return False
+        if not row:
+            # Invalidated by the DB since we loaded the list.
+            del persisted[system.ID]
+            return False
+        
+        probedLy, idBlob, distBlob = row
+        neighbourIDs, distances = array('q'), array('d')
+        neighbourIDs.frombytes(idBlob)
+        distances.frombytes(distBlob)
+        sysByID = self.systemByID
+        cache.systems = [
+            (sysByID[ID], dist)
+            for ID, dist in zip(neighbourIDs, distances)
+            if ID in sysByID
+        ]
+        cache.probedLy = probedLy
+        return True
+    
+    def flushPersistedRanges(self):
+        """
+        Writes the neighbourhoods probed in this session to the
+        SystemRange table (see --persist-ranges).
+        """
+        pending, self.pendingRanges = self.pendingRanges, {}
+        if not pending:
+            return
+        rows = [
+            (
+                ID, cache.probedLy,
+                array('q', (nSys.ID for nSys, _ in cache.systems)).tobytes(),
+                array('d', (dist for _, dist in cache.systems)).tobytes(),
+            )
+            for ID, cache in pending.items()
+        ]
+        db = self.getDB()
+        try:
+            db.executemany("""
+                INSERT OR REPLACE INTO SystemRange (
+                    system_id, probed_ly, neighbour_ids, distances
+                ) VALUES (
+                    ?, ?, ?, ?
+                )
+            """, rows)
+            db.commit()
+        except sqlite3.OperationalError as e:
+            self.tdenv.DEBUG0("Could not persist system ranges: {}", e)
+            return
+        if self.persistedRanges is not None:
+            self.persistedRanges.update(
+                (ID, cache.probedLy) for ID, cache in pending.items()
+            )
+        self.tdenv.DEBUG1("Persisted {:n} system ranges", len(rows))
     
     def genSystemsInRange(self, system, ly, includeSelf=False):
         """
         Yields Systems within a given radius of a specified System.
         Results are sorted by distance and cached for subsequent
-        queries in the same run.
+        queries in the same run; with tdenv.persistRanges they are
+        also kept in the SystemRange table for subsequent runs.
         
         Args:
             system:
@@ -1012,12 +1371,18 @@ class TradeDB(object):
         cachedSystems = cache.systems
         
         if ly > cache.probedLy:
-            # Consult the database for stars we haven't seen.
-            cachedSystems = cache.systems = list(
-                self.genStellarGrid(system, ly)
-            )
-            cachedSystems.sort(key=lambda ent: ent[1])
-            cache.probedLy = ly
+            if not self.__loadPersistedRange(system, cache, ly):
+                # Consult the database for stars we haven't seen.
+                cachedSystems = cache.systems = list(
+                    self.genStellarGrid(system, ly)
+                )
+                cachedSystems.sort(key=lambda ent: ent[1])
+                cache.probedLy = ly
+                if self.tdenv.persistRanges:
+                    self.pendingRanges[system.ID] = cache
+            cachedSystems = cache.systems
+            if cache.probedLy > self.maxProbedLy:
+                self.maxProbedLy = cache.probedLy
         
         if includeSelf:
             yield system, 0.
@@ -1031,7 +1396,143 @@ class TradeDB(object):
             # No need to be conditional inside the loop
             yield from cachedSystems
     
-    def getRoute(self, origin, dest, maxJumpLy, avoiding=[], stationInterval=0):
+    def __getCompactJumpGraph(self, maxJumpLy):
+        """
+        Returns the routing.CompactJumpGraph covering maxJumpLy, from
+        the JumpGraph table if it has one for the current systems,
+        otherwise building and storing it.
+        """
+        bucketLy = routing.bucketLy(maxJumpLy)
+        try:
+            return self.compactJumpGraphs[bucketLy]
+        except KeyError:
+            pass
+        
+        db = self.getDB()
+        try:
+            row = db.execute("""
+                SELECT  system_ids, offsets, targets, distances
+                  FROM  JumpGraph
+                 WHERE  bucket_ly = ?
+            """, [bucketLy]).fetchone()
+        except sqlite3.OperationalError as e:
+            self.tdenv.DEBUG0("Can't use the JumpGraph table: {}", e)
+            row = None
+        graph = None
+        if row:
+            graph = routing.CompactJumpGraph.fromBlobs(
+                bucketLy, self.systemByID, *row
+            )
+        if graph:
+            self.tdenv.DEBUG1(
+                "Loaded {}ly jump graph, {:n} links", bucketLy, len(graph)
+            )
+        else:
+            graph = routing.CompactJumpGraph.build(
+                self.systemByID.values(), bucketLy, self.genSystemsInRange
+            )
+            self.tdenv.DEBUG1(
+                "Built {}ly jump graph, {:n} links", bucketLy, len(graph)
+            )
+            try:
+                db.execute("""
+                    INSERT OR REPLACE INTO JumpGraph (
+                        bucket_ly, system_ids, offsets, targets, distances
+                    ) VALUES (
+                        ?, ?, ?, ?, ?
+                    )
+                """, [bucketLy, *graph.toBlobs()])
+                db.execute("""
+                    DELETE FROM JumpLandmark WHERE bucket_ly = ?
+                """, [bucketLy])
+                db.commit()
+            except sqlite3.OperationalError as e:
+                self.tdenv.DEBUG0("Could not persist the jump graph: {}", e)
+        
+        self.compactJumpGraphs[bucketLy] = graph
+        return graph
+    
+    def __getLandmarks(self, compact, count):
+        """
+        Returns 'count' routing.Landmarks for a compact jump graph,
+        from the JumpLandmark table if it has them, otherwise picking
+        and storing new ones.
+        """
+        bucketLy = compact.bucketLy
+        landmarks = self.jumpLandmarks.get(bucketLy)
+        if landmarks is not None and len(landmarks) == count:
+            return landmarks
+        
+        db = self.getDB()
+        try:
+            rows = db.execute("""
+                SELECT  landmark_id, distances, jumps
+                  FROM  JumpLandmark
+                 WHERE  bucket_ly = ?
+            """, [bucketLy]).fetchall()
+        except sqlite3.OperationalError as e:
+            self.tdenv.DEBUG0("Can't use the JumpLandmark table: {}", e)
+            rows = []
+        landmarks = None
+        if len(rows) == count:
+            landmarks = routing.Landmarks.fromRows(compact, rows)
+        if landmarks is not None:
+            self.tdenv.DEBUG1(
+                "Loaded {:n} landmarks for the {}ly jump graph",
+                len(landmarks), bucketLy
+            )
+        else:
+            landmarks = routing.Landmarks.build(compact, count)
+            self.tdenv.DEBUG1(
+                "Picked {:n} landmarks for the {}ly jump graph: {}",
+                len(landmarks), bucketLy,
+                ", ".join(system.name() for system in landmarks.systems)
+            )
+            try:
+                db.execute("""
+                    DELETE FROM JumpLandmark WHERE bucket_ly = ?
+                """, [bucketLy])
+                db.executemany("""
+                    INSERT INTO JumpLandmark (
+                        bucket_ly, landmark_id, distances, jumps
+                    ) VALUES (
+                        ?, ?, ?, ?
+                    )
+                """, [[bucketLy, *row] for row in landmarks.toRows()])
+                db.commit()
+            except sqlite3.OperationalError as e:
+                self.tdenv.DEBUG0("Could not persist the landmarks: {}", e)
+        
+        self.jumpLandmarks[bucketLy] = landmarks
+        return landmarks
+    
+    def getJumpGraph(self, maxJumpLy):
+        """
+        Returns the routing.JumpGraph of systems within maxJumpLy of
+        each other, shared by every route search with that range.
+        With tdenv.persistJumps it is backed by a compact graph that
+        is kept in the DB for subsequent runs, with tdenv.landmarks
+        that graph also carries that many routing.Landmarks.
+        """
+        try:
+            return self.jumpGraphs[maxJumpLy]
+        except KeyError:
+            pass
+        compact, landmarks = None, None
+        numLandmarks = self.tdenv.landmarks
+        if self.tdenv.persistJumps or numLandmarks:
+            compact = self.__getCompactJumpGraph(maxJumpLy)
+        if numLandmarks:
+            landmarks = self.__getLandmarks(compact, numLandmarks)
+        graph = self.jumpGraphs[maxJumpLy] = routing.JumpGraph(
+            self, maxJumpLy, compact, landmarks
+        )
+        return graph
+    
+    def getRoute(
+            self, origin, dest, maxJumpLy,
+            avoiding=[], stationInterval=0, fewestJumps=False,
+            ):
         """
         Find a shortest route between two systems with an additional
         constraint that each system be a maximum of maxJumpLy from
@@ -1048,6 +1549,8 @@ class TradeDB(object):
                 List of systems being avoided
             stationInterval:
                 If non-zero, require a station at least this many jumps,
+            fewestJumps:
+                Minimize the number of jumps rather than the distance,
             tdenv.padSize:
                 Controls the pad size of stations for refuelling
         
@@ -1062,13 +1565,13 @@ class TradeDB(object):
         Example:
             If there are systems A, B and C such
             that A->B is 7ly and B->C is 8ly then:
-                
+            
                 origin = lookupPlace("A")
                 dest = lookupPlace("C")
                 route = tdb.getRoute(origin, dest, 9)
             
             The route should be:
-                
+            
                 [(System(A), 0), (System(B), 7), System(C), 15)]
         
         """
@@ -1081,93 +1584,112 @@ class TradeDB(object):
         if origin == dest:
             return ((origin, 0), (dest, 0))
         
-        # openSet is the list of nodes we want to visit, which will be
-        # used as a priority queue (heapq).
-        # Each element is a tuple of the 'priority' (the combination of
-        # the total distance to the node and the distance left from the
-        # node to the destination.
-        openSet = [(0, 0, origin.ID, 0)]
-        # Track predecessor nodes for everwhere we visit
-        distances = {origin: (None, 0)}
-        
-        if avoiding:
-            if dest in avoiding:
-                raise ValueError("Destination is in avoidance list")
-            for avoid in avoiding:
-                if isinstance(avoid, System):
-                    distances[avoid] = (None, -1)
-        
-        systemsInRange = self.genSystemsInRange
-        heappop  = heapq.heappop
-        heappush = heapq.heappush
-        distTo = float("inf")
-        defaultDist = (None, distTo)
-        getDist  = distances.get
-        
-        destID = dest.ID
-        sysByID = self.systemByID
-        
-        maxPadSize = self.tdenv.padSize
-        if not maxPadSize:
-            checkStations = lambda system: bool(system.stations())
+        avoiding = [
+            avoid for avoid in avoiding if isinstance(avoid, System)
+        ]
+        if dest in avoiding:
+            raise ValueError("Destination is in avoidance list")
+        
+        graph = self.getJumpGraph(maxJumpLy)
+        if stationInterval:
+            maxPadSize = self.tdenv.padSize
+            if not maxPadSize:
+                checkStations = lambda system: bool(system.stations)
+            else:
+                checkStations = lambda system: any(
+                    stn for stn in system.stations
+                    if stn.checkPadSize(maxPadSize)
+                )
+            systems = routing.findRouteWithStops(
+                graph, origin, dest, stationInterval, checkStations,
+                avoiding=avoiding, fewestJumps=fewestJumps,
+            )
         else:
-            checkStations = lambda system: any(
-                stn for stn in system.stations
-                if stn.checkPadSize(maxPadSize)
+            systems = routing.findRoute(
+                graph, origin, dest,
+                avoiding=avoiding, fewestJumps=fewestJumps,
             )
         
-        while openSet:
-            weight, curDist, curSysID, stnDist = heappop(openSet)
-            # If we reached 'goal' we've found the shortest path.
-            if curSysID == destID:
-                break
-            if curDist >= distTo:
-                continue
-            curSys = sysByID[curSysID]
-            # A node might wind up multiple times on the open list,
-            # so check if we've already found a shorter distance to
-            # the system and if so, ignore it this time.
-            if curDist > distances[curSys][1]:
-                continue
-            
-            system_iter = iter(systemsInRange(curSys, maxJumpLy))
-            if stationInterval:
-                if checkStations(curSys):
-                    stnDist = 0
-                else:
-                    stnDist += 1
-                    if stnDist >= stationInterval:
-                        system_iter = iter(
-                            v for v in system_iter if checkStations(v[0])
-                        )
-            
-            distFn = curSys.distanceTo
-            for nSys, nDist in system_iter:
-                newDist = curDist + nDist
-                if getDist(nSys, defaultDist)[1] <= newDist:
-                    continue
-                distances[nSys] = (curSys, newDist)
-                weight = distFn(nSys)
-                nID = nSys.ID
-                heappush(openSet, (newDist + weight, newDist, nID, stnDist))
-                if nID == destID:
-                    distTo = newDist
-        
-        if dest not in distances:
+        return self.__routePath(systems)
+    
+    @staticmethod
+    def __routePath(systems):
+        """ [System, ...] -> [(System, distanceSoFar), ...] or None. """
+        if not systems:
             return None
         
-        path = []
+        path, dist, prevSys = [], 0., systems[0]
+        for system in systems:
+            dist += prevSys.distanceTo(system)
+            path.append((system, dist))
+            prevSys = system
         
-        while True:
-            (prevSys, dist) = getDist(dest)
-            path.append((dest, dist))
-            if dest == origin:
-                break
-            dest = prevSys
+        return path
+    
+    def getRoutes(
+            self, pairs,
+            avoiding=[], stationInterval=0, fewestJumps=False,
+            ):
+        """
+        Finds the routes for many (origin, dest, maxJumpLy) queries,
+        as getRoute would. Queries from the same origin system with
+        the same range share a single search tree from that origin.
         
-        path.reverse()
+        Args:
+            pairs:
+                Iterable of (origin, dest, maxJumpLy), where origin and
+                dest are Systems or Stations,
+            avoiding, stationInterval, fewestJumps:
+                As for getRoute.
         
-        return path
+        Returns:
+            A generator of ((origin, dest, maxJumpLy), route) where
+            route is as returned by getRoute, or None when there is
+            no route or dest is being avoided. The results come in
+            groups by origin and range, in the order the groups first
+            appear in pairs.
+        """
+        
+        def systemOf(place):
+            return place.system if isinstance(place, Station) else place
+        
+        groups = {}
+        for pair in pairs:
+            origin, _, maxJumpLy = pair
+            groups.setdefault((systemOf(origin), maxJumpLy), []).append(pair)
+        
+        avoiding = [
+            avoid for avoid in avoiding if isinstance(avoid, System)
+        ]
+        avoidSet = set(avoiding)
+        for (origin, maxJumpLy), group in groups.items():
+            dests = {
+                systemOf(dest) for _, dest, _ in group
+            }
+            dests.discard(origin)
+            dests.difference_update(avoidSet)
+            if stationInterval or len(dests) < 2:
+                for pair in group:
+                    if systemOf(pair[1]) in avoidSet:
+                        yield pair, None
+                        continue
+                    yield pair, self.getRoute(
+                        *pair, avoiding,
+                        stationInterval=stationInterval,
+                        fewestJumps=fewestJumps,
+                    )
+                continue
+            
+            routes = routing.findRoutesFrom(
+                self.getJumpGraph(maxJumpLy), origin, dests,
+                avoiding=avoiding, fewestJumps=fewestJumps,
+            )
+            for pair in group:
+                dest = systemOf(pair[1])
+                if dest is origin:
+                    yield pair, ((origin, 0), (dest, 0))
+                else:
+                    yield pair, self.__routePath(routes.get(dest))
     
     ############################################################
     # Station data.
@@ -1210,24 +1732,47 @@ class TradeDB(object):
             stationByID[ID] = station
         
         tradingCount = 0
-        stmt = """
-            SELECT  station_id,
-                    COUNT(*) AS item_count,
-                    AVG(JULIANDAY('now') - JULIANDAY(modified))
-              FROM  StationItem
-             GROUP  BY 1
-             HAVING item_count > 0
-        """
-        for ID, itemCount, dataAge in self.cur.execute(stmt):
+        try:
+            summaries = self.cur.execute("""
+                SELECT  station_id, item_count, avg_modified
+                  FROM  StationMarketSummary
+                 WHERE  item_count > 0
+            """).fetchall()
+        except sqlite3.OperationalError as e:
+            self.tdenv.DEBUG0("Can't use StationMarketSummary: {}", e)
+            stmt = """
+                SELECT  station_id,
+                        COUNT(*) AS item_count,
+                        AVG(CAST(STRFTIME('%s', modified) AS INTEGER))
+                  FROM  StationItem
+                 GROUP  BY 1
+                 HAVING item_count > 0
+            """
+            summaries = self.cur.execute(stmt).fetchall()
+        now = time.time()
+        for ID, itemCount, avgModified in summaries:
             station = stationByID[ID]
             station.itemCount = itemCount
-            station.dataAge = dataAge
+            station.dataAge = (now - avgModified) / 86400
             tradingCount += 1
         
         self.stationByID = stationByID
+        self.stationNameIndex = None
         self.tradingStationCount = tradingCount
         self.tdenv.DEBUG1("Loaded {:n} Stations", len(stationByID))
-        self.stellarGrid = None
+    
+    def getStationNameIndex(self):
+        """
+        Returns the NameIndex of Station names, building it if the
+        Stations have changed since it was last used.
+        """
+        if self.stationNameIndex is None:
+            self.stationNameIndex = nameindex.NameIndex(
+                self.stationByID.values(),
+                lambda station: station.dbname,
+                TradeDB.normalizeTrans, TradeDB.trimTrans,
+            )
+        return self.stationNameIndex
     
     def addLocalStation(
             self,
@@ -1306,6 +1851,7 @@ class TradeDB(object):
             itemCount=0, dataAge=0,
         )
         self.stationByID[ID] = station
+        self.stationNameIndex = None
         if commit:
             db.commit()
         self.tdenv.NOTE(
@@ -1352,6 +1898,7 @@ class TradeDB(object):
             if force or name.upper() != station.dbname.upper():
                 _changed("name", station.dbname, name)
                 station.dbname = name
+                self.stationNameIndex = None
         
         if lsFromStar is not None:
             assert lsFromStar >= 0
@@ -1436,18 +1983,30 @@ class TradeDB(object):
         
         # Remove reference from my system
         system = station.system
-        system.stations.remove(station)
+        system.stations = tuple(
+            stn for stn in system.stations if stn is not station
+        )
         
         # Remove the ID lookup
         del self.stationByID[station.ID]
+        self.stationNameIndex = None
         
-        # Delete database entry
+        # Delete database entry, its prices go with it.
         db = self.getDB()
+        itemIDs = [
+            ID for (ID,) in db.execute("""
+                SELECT item_id FROM StationItem WHERE station_id = ?
+            """, [station.ID])
+        ]
         db.execute("""
             DELETE FROM Station
              WHERE system_id = ? AND station_id = ?
         """, [system.ID, station.ID]
         )
+        if itemIDs:
+            cache.updateItemPriceStats(db, itemIDs)
+            self.itemPriceStats = None
+            self.avgSelling, self.avgBuying = None, None
         if commit:
             db.commit()
         
@@ -1508,11 +2067,14 @@ class TradeDB(object):
         wordMatch = []
         anyMatch = []
         
+        normTrans = TradeDB.normalizeTrans
+        trimTrans = TradeDB.trimTrans
+        
         def lookup(name, candidates):
-            """ Search candidates for the given name """
-            
-            normTrans = TradeDB.normalizeTrans
-            trimTrans = TradeDB.trimTrans
+            """
+            Search candidates for the given name; candidates is either
+            a NameIndex or a list of places.
+            """
             
             nameNorm = name.translate(normTrans)
             nameTrimmed = nameNorm.translate(trimTrans)
@@ -1521,9 +2083,17 @@ class TradeDB(object):
             nameNormLen = len(nameNorm)
             nameTrimmedLen = len(nameTrimmed)
             
-            for place in candidates:
+            if isinstance(candidates, nameindex.NameIndex):
+                # Only names containing the trimmed name can match.
+                entries = candidates.entries(nameTrimmed)
+            else:
+                entries = (
+                    (place, place.dbname.translate(normTrans))
+                    for place in candidates
+                )
+            
+            for place, placeNameNorm in entries:
                 placeName = place.dbname
-                placeNameNorm = placeName.translate(normTrans)
                 placeNameNormLen = len(placeNameNorm)
                 
                 if nameTrimmedLen > placeNameNormLen:
@@ -1577,7 +2147,7 @@ class TradeDB(object):
                 sys = self.systemByName[sysName]
                 exactMatch = [sys]
             except KeyError:
-                lookup(sysName, self.systemByID.values())
+                lookup(sysName, self.getSystemNameIndex())
         if stnName:
             # Are we considering the name as a station?
             # (we don't if they type, e,g '@aulin')
@@ -1599,7 +2169,7 @@ class TradeDB(object):
                 anyMatch = []
             else:
                 # Consider against all station names
-                stationCandidates = self.stationByID.values()
+                stationCandidates = self.getStationNameIndex()
             lookup(stnName, stationCandidates)
         
         # consult the match sets in ranking order for a single
@@ -1615,7 +2185,20 @@ class TradeDB(object):
             # Note: this was a TradeException and may need to be again,
             # but then we need to catch that error in commandenv
             # when we process avoids
-            raise LookupError("Unrecognized place: {}".format(name))
+            def suggest():
+                scored = []
+                # With "system/station" it was the station that failed.
+                if sysName and not slashPos > nameOff + 1:
+                    scored += self.getSystemNameIndex().suggest(sysName)
+                if stnName:
+                    scored += self.getStationNameIndex().suggest(stnName)
+                scored.sort(key=lambda entry: -entry[0])
+                return [place for _, place in scored[:5]]
+            raise NameNotFoundError(
+                "Unrecognized place: {}".format(name),
+                'System/Station', name, suggest,
+                key=lambda place: place.name()
+            )
         
         # More than one match
         raise AmbiguityError(
@@ -1651,14 +2234,16 @@ class TradeDB(object):
         try:
             system = TradeDB.listSearch(
                 "System", name, self.systemByID.values(),
-                key=lambda system: system.dbname
+                key=lambda system: system.dbname,
+                index=self.getSystemNameIndex(),
             )
         except LookupError:
             pass
         try:
             station = TradeDB.listSearch(
                 "Station", name, self.stationByID.values(),
-                key=lambda station: station.dbname
+                key=lambda station: station.dbname,
+                index=self.getStationNameIndex(),
             )
         except LookupError:
             pass
@@ -1708,11 +2293,115 @@ class TradeDB(object):
         Limits to stations we are trading with if trading is True.
         """
         
+        origSys = origin.system if isinstance(origin, Station) else origin
+        yield from self.getDestinationTable(
+            (origSys,),
+            maxJumps=maxJumps,
+            maxLyPer=maxLyPer,
+            avoidPlaces=avoidPlaces,
+            maxPadSize=maxPadSize,
+            maxLsFromStar=maxLsFromStar,
+            noPlanet=noPlanet,
+            planetary=planetary,
+            fleet=fleet,
+        )[origSys]
+    
+    def getDestinationTable(
+            self,
+            origins,
+            maxJumps=None,
+            maxLyPer=None,
+            avoidPlaces=None,
+            maxPadSize=None,
+            maxLsFromStar=0,
+            noPlanet=False,
+            planetary=None,
+            fleet=None,
+            ):
+        """
+        Batched getDestinations: expands the destinations of a whole
+        set of origins (Systems or Stations) at once, with the same
+        constraints.
+        
+        Each distinct origin system is expanded once however many
+        origins share it, all of them share the jump graph, and which
+        stations of a system pass the station constraints is only
+        worked out once for the whole batch.
+        
+        Returns:
+            {System: (Destination, ...)} for each origin's system, in
+            the order getDestinations would yield them.
+        """
+        
         if maxJumps is None:
             maxJumps = sys.maxsize
         maxLyPer = maxLyPer or self.maxSystemLinkLy
         if avoidPlaces is None:
             avoidPlaces = ()
+        avoidSystems = [
+            system for system in avoidPlaces if isinstance(system, System)
+        ]
+        avoidStations = set(
+            station for station in avoidPlaces if isinstance(station, Station)
+        )
+        neighbours = self.getJumpGraph(maxLyPer).neighbours
+        
+        # We have a system-to-system path list, and we'll need stations
+        # to terminate at; filter each system's stations just once.
+        eligibleStations = {}
+        
+        def stationsIn(system):
+            try:
+                return eligibleStations[system]
+            except KeyError:
+                pass
+            stations = system.stations
+            if noPlanet:
+                stations = [stn for stn in stations if stn.planetary == 'N']
+            if avoidStations:
+                stations = [stn for stn in stations if stn not in avoidStations]
+            if maxPadSize:
+                stations = [
+                    stn for stn in stations if stn.checkPadSize(maxPadSize)
+                ]
+            if planetary:
+                stations = [
+                    stn for stn in stations if stn.checkPlanetary(planetary)
+                ]
+            if fleet:
+                stations = [stn for stn in stations if stn.checkFleet(fleet)]
+            if maxLsFromStar:
+                stations = [
+                    stn for stn in stations
+                    if stn.lsFromStar > 0 and stn.lsFromStar <= maxLsFromStar
+                ]
+            stations = eligibleStations[system] = tuple(stations)
+            return stations
+        
+        table = {}
+        for origin in origins:
+            origSys = origin.system if isinstance(origin, Station) else origin
+            if origSys in table:
+                continue
+            pathList = self.__destinationPaths(
+                origSys, maxJumps, neighbours, avoidSystems
+            )
+            table[origSys] = tuple(
+                Destination(node.system, station, node.via, node.distLy)
+                for node in pathList.values()
+                if node.distLy >= 0.0
+                for station in stationsIn(node.system)
+            )
+        
+        return table
+    
+    @staticmethod
+    def __destinationPaths(origSys, maxJumps, neighbours, avoidSystems):
+        """
+        Returns {systemID: DestinationNode} of the shortest path found
+        to each system within maxJumps of origSys, with a negative
+        distLy for the avoided systems.
+        """
         
         # The open list is the list of nodes we should consider next for
         # potential destinations.
@@ -1721,7 +2410,6 @@ class TradeDB(object):
         # The closed list is the list of nodes we've already been to (so
         # that we don't create loops A->B->C->A->B->C->...)
         
-        origSys = origin.system if isinstance(origin, Station) else origin
         openList = [DestinationNode(origSys, [origSys], 0)]
         # I don't want to have to consult both the pathList
         # AND the avoid list every time I'm considering a
@@ -1733,8 +2421,7 @@ class TradeDB(object):
         # pass through en-route.
         pathList = {
             system.ID: DestinationNode(system, None, -1.0)
-            for system in avoidPlaces
-            if isinstance(system, System)
+            for system in avoidSystems
         }
         if origSys.ID not in pathList:
             pathList[origSys.ID] = openList[0]
@@ -1752,9 +2439,7 @@ class TradeDB(object):
             ring.sort(key=lambda dn: dn.distLy)
             
             for node in ring:
-                for (destSys, destDist) in self.genSystemsInRange(
-                        node.system, maxLyPer, False
-                        ):
+                for (destSys, destDist) in neighbours(node.system):
                     dist = node.distLy + destDist
                     # If we already have a shorter path, do nothing
                     try:
@@ -1773,47 +2458,7 @@ class TradeDB(object):
                     # list so that it serves as the via list for all next-hops.
                     openList.append(destNode)
         
-        # We have a system-to-system path list, now we
-        # need stations to terminate at.
-        def path_iter_fn():
-            for node in pathList.values():
-                if node.distLy >= 0.0:
-                    for station in node.system.stations:
-                        yield node, station
-        
-        path_iter = iter(path_iter_fn())
-        if noPlanet:
-            path_iter = iter(
-                (node, station) for (node, station) in path_iter
-                if station.planetary == 'N'
-            )
-        if avoidPlaces:
-            path_iter = iter(
-                (node, station) for (node, station) in path_iter
-                if station not in avoidPlaces
-            )
-        if maxPadSize:
-            path_iter = iter(
-                (node, station) for (node, station) in path_iter
-                if station.checkPadSize(maxPadSize)
-            )
-        if planetary:
-            path_iter = iter(
-                (node, station) for (node, station) in path_iter
-                if station.checkPlanetary(planetary)
-            )
-        if fleet:
-            path_iter = iter(
-                (node, station) for (node, station) in path_iter
-                if station.checkFleet(fleet)
-            )
-        if maxLsFromStar:
-            path_iter = iter(
-                (node, stn) for (node, stn) in path_iter
-                if stn.lsFromStar > 0 and stn.lsFromStar <= maxLsFromStar
-            )
-        for node, stn in path_iter:
-            yield Destination(node.system, stn, node.via, node.distLy)
+        return pathList
     
     ############################################################
     # Ship data.
@@ -1931,6 +2576,32 @@ class TradeDB(object):
             val=lambda kvTup: kvTup[1]
         )
     
+    def getItemPriceStats(self):
+        """
+        Returns {itemID: ItemPriceStats} for the items with any prices,
+        read from the ItemPriceStats table.
+        """
+        if self.itemPriceStats is None:
+            try:
+                rows = self.getDB().execute("""
+                    SELECT  item_id,
+                            demand_count, demand_avg, demand_min,
+                            demand_p25, demand_median, demand_p75, demand_max,
+                            supply_count, supply_avg, supply_min,
+                            supply_p25, supply_median, supply_p75, supply_max
+                      FROM  ItemPriceStats
+                """).fetchall()
+            except sqlite3.OperationalError as e:
+                self.tdenv.DEBUG0("Can't use ItemPriceStats: {}", e)
+                rows = cache.itemPriceStatsRows(self.getDB())
+            self.itemPriceStats = {
+                row[0]: ItemPriceStats(
+                    PriceStats(*row[1:8]), PriceStats(*row[8:15])
+                )
+                for row in rows
+            }
+        return self.itemPriceStats
+    
     def getAverageSelling(self):
         """
         Query the database for average selling prices of all items.
@@ -1938,16 +2609,9 @@ class TradeDB(object):
         if not self.avgSelling:
             self.avgSelling = {itemID: 0 for itemID in self.itemByID.keys()}
             self.avgSelling.update({
-                ID: int(cr)
-                for ID, cr in self.getDB().execute("""
-                    SELECT  i.item_id, IFNULL(AVG(supply_price), 0)
-                      FROM  Item AS i
-                            LEFT OUTER JOIN StationItem AS si ON (
-                                i.item_id = si.item_id AND si.supply_price > 0
-                            )
-                     WHERE  supply_price > 0
-                     GROUP  BY 1
-                """)
+                ID: int(stats.supply.avg)
+                for ID, stats in self.getItemPriceStats().items()
+                if stats.supply.count
             })
         return self.avgSelling
     
@@ -1958,16 +2622,9 @@ class TradeDB(object):
         if not self.avgBuying:
             self.avgBuying = {itemID: 0 for itemID in self.itemByID.keys()}
             self.avgBuying.update({
-                ID: int(cr)
-                for ID, cr in self.getDB().execute("""
-                    SELECT  i.item_id, IFNULL(AVG(demand_price), 0)
-                      FROM  Item AS i
-                            LEFT OUTER JOIN StationItem AS si ON (
-                                i.item_id = si.item_id AND si.demand_price > 0
-                            )
-                     WHERE  demand_price > 0
-                     GROUP  BY 1
-                """)
+                ID: int(stats.demand.avg)
+                for ID, stats in self.getItemPriceStats().items()
+                if stats.demand.count
             })
         return self.avgBuying
     
@@ -2010,10 +2667,15 @@ class TradeDB(object):
     # Price data.
     
     def close(self):
+        self.flushPersistedRanges()
         self.cur = None
         if self.conn:
             self.conn.close()
         self.conn = None
+        with self.readPoolLock:
+            if self.readPool:
+                self.readPool.close()
+            self.readPool = None
     
     def load(self, maxSystemLinkLy=None):
         """
@@ -2028,6 +2690,7 @@ class TradeDB(object):
         self.tdenv.DEBUG1("Loading data")
         
         self.conn = conn = self.getDB()
+        self.connThread = threading.get_ident()
         self.cur = conn.cursor()
         
         self._loadAdded()
@@ -2050,12 +2713,16 @@ class TradeDB(object):
     def listSearch(
             listType, lookup, values,
             key=lambda item: item,
-            val=lambda item: item
+            val=lambda item: item,
+            index=None,
             ):
         """
         Searches [values] for 'lookup' for least-ambiguous matches,
         return the matching value as stored in [values].
         
+        If 'index' is a NameIndex built over [values] with the same
+        key, only the values it finds for 'lookup' are examined.
+        
         GIVEN [values] contains "bread", "water", "biscuits and "It",
         searching "ea" will return "bread", "WaT" will return "water"
         and "i" will return "biscuits".
@@ -2071,6 +2738,14 @@ class TradeDB(object):
         normTrans = TradeDB.normalizeTrans
         trimTrans = TradeDB.trimTrans
         needle = lookup.translate(normTrans).translate(trimTrans)
+        if index is not None:
+            exactMatch = index.exact(needle)
+            if exactMatch:
+                return val(exactMatch[0])
+            values = index.search(needle)
+        else:
+            # Keep hold of them in case we need to make suggestions.
+            values = list(values)
         partialMatch, wordMatch = [], []
         # make a regex to match whole words
         wordRe = re.compile(r'\b{}\b'.format(lookup), re.IGNORECASE)
@@ -2104,8 +2779,20 @@ class TradeDB(object):
                 )
             return partialMatch[0].value
         # No matches
-        raise LookupError(
-            "Error: '%s' doesn't match any %s" % (lookup, listType)
+        def suggest():
+            suggestIndex = index
+            if suggestIndex is None:
+                suggestIndex = nameindex.NameIndex(
+                    values, key, normTrans, trimTrans
+                )
+            return [
+                ListSearchMatch(key(entry), val(entry))
+                for _, entry in suggestIndex.suggest(lookup)
+            ]
+        raise NameNotFoundError(
+            "Error: '%s' doesn't match any %s" % (lookup, listType),
+            listType, lookup, suggest,
+            key=lambda item: item.key,
         )
     
     @staticmethod